@@ -32,6 +32,37 @@ FULLSERVICE_ADDRESS = os.getenv("FULLSERVICE_ADDRESS", "127.0.0.1")
 FULLSERVICE_PORT = os.getenv("FULLSERVICE_PORT", "9090")
 FULLSERVICE_URL = f"http://{FULLSERVICE_ADDRESS}:{FULLSERVICE_PORT}/wallet"
 CONCURRENCY_WARNING_MESSAGE_THRESHOLD = os.getenv("CONCURRENCY_WARNING_MESSAGE_THRESHOLD", 10)
+# Incoming payments still unconfirmed after this long are marked failed
+PAYMENT_VERIFICATION_TIMEOUT_SECONDS = int(os.getenv("PAYMENT_VERIFICATION_TIMEOUT_SECONDS", 300))
+# Customer MobileCoin addresses from signald profiles are cached in memory for this long, for up to this many customers
+PAYMENTS_ADDRESS_CACHE_TTL_SECONDS = float(os.getenv("PAYMENTS_ADDRESS_CACHE_TTL_SECONDS", 300))
+PAYMENTS_ADDRESS_CACHE_SIZE = int(os.getenv("PAYMENTS_ADDRESS_CACHE_SIZE", 10000))
+# ... and on the Customer for this long, so other processes can reuse them; 0 disables persistence
+PAYMENTS_ADDRESS_PERSIST_TTL_SECONDS = float(os.getenv("PAYMENTS_ADDRESS_PERSIST_TTL_SECONDS", 3600))
+# Each process checks for addresses invalidated by another this often, dropping its in-memory copies
+PAYMENTS_ADDRESS_SYNC_SECONDS = float(os.getenv("PAYMENTS_ADDRESS_SYNC_SECONDS", 1))
+# How stale our in-memory view of upcoming and active drops can get, for changes made by other processes
+DROP_SCHEDULE_REFRESH_SECONDS = float(os.getenv("DROP_SCHEDULE_REFRESH_SECONDS", 30))
+# How stale our in-memory view of the wallet balance can get before it's refreshed from full-service
+PAYMENTS_BALANCE_RECONCILE_SECONDS = float(os.getenv("PAYMENTS_BALANCE_RECONCILE_SECONDS", 30))
+# Payouts are collected for this long and sent as one multi-recipient transaction; 0 sends each on its own
+PAYOUT_BATCH_WINDOW_SECONDS = float(os.getenv("PAYOUT_BATCH_WINDOW_SECONDS", 0.5))
+# Keep the wallet split into this many TXOs of PAYOUT_TXO_VALUE_MOB, so concurrent payouts have their own inputs; 0 disables
+PAYOUT_TXO_POOL_SIZE = int(os.getenv("PAYOUT_TXO_POOL_SIZE", 0))
+PAYOUT_TXO_VALUE_MOB = os.getenv("PAYOUT_TXO_VALUE_MOB", "1")
+# Threads sending queued replies to signald; 0 sends replies inline in the handler
+SIGNAL_SENDER_WORKERS = int(os.getenv("SIGNAL_SENDER_WORKERS", 8))
+# Replies from one handler are held until it finishes, then sent as one 'burst' with one DB write each for messages
+# and responses, or 'join'ed into a single message; 'off' sends each reply as it's made
+REPLY_BUFFERING = os.getenv("REPLY_BUFFERING", "burst")
+# How often each process publishes its per-message timing histograms for the admin; 0 keeps them in-process
+INSTRUMENTATION_PUBLISH_SECONDS = float(os.getenv("INSTRUMENTATION_PUBLISH_SECONDS", 10))
+# Bearer token Prometheus sends to scrape /metrics; unset, only staff users can see it
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Warn customers who've gone quiet mid-session, then cancel (or refund) their session
+SESSION_TIMEOUTS_ENABLED = os.getenv("SESSION_TIMEOUTS_ENABLED", "false").lower() == "true"
+SESSION_IDLE_TIMEOUT_SECONDS = int(os.getenv("SESSION_IDLE_TIMEOUT_SECONDS", 60))
+SESSION_CANCEL_TIMEOUT_SECONDS = int(os.getenv("SESSION_CANCEL_TIMEOUT_SECONDS", 300))
 
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -39,6 +70,15 @@ DEBUG = os.environ.get('DEBUG', False)
 
 DATABASE = os.environ.get('DATABASE', 'postgresql')
 
+# How the listener wakes subscribers when a message is stored: 'postgresql' (LISTEN/NOTIFY), 'local' (in-process,
+# so only when the listener and subscribers share a process, as in tests) or 'none' (subscribers just poll)
+MESSAGE_NOTIFIER = os.getenv("MESSAGE_NOTIFIER", "postgresql" if DATABASE == "postgresql" else "none")
+# Safety-net poll interval for subscribers when no notification arrives; short when there are no notifications
+MESSAGE_POLL_INTERVAL_SECONDS = float(os.getenv("MESSAGE_POLL_INTERVAL_SECONDS",
+                                                1 if MESSAGE_NOTIFIER == "none" else 5))
+# Messages left processing longer than this (e.g. by a crashed worker) no longer hold up their customer's queue
+MESSAGE_PROCESSING_TIMEOUT_SECONDS = int(os.getenv("MESSAGE_PROCESSING_TIMEOUT_SECONDS", 300))
+
 ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', '127.0.0.1').split(',')
 
 # Application definition
@@ -125,6 +165,9 @@ if DATABASE == "postgresql":
     DATABASE_PORT = os.environ.get("DATABASE_PORT", "5432")
     DATABASE_SSL_MODE = os.environ.get("DATABASE_SSL_MODE", "prefer")
     DATABASE_SSL_ROOT_CERT = os.environ.get("DATABASE_SSL_ROOT_CERT", "")
+    # Seconds each worker thread may reuse its connection across messages. Defaults to 0, reconnecting for every
+    # message as before, so connection reuse is off unless this is set (the chart sets it for the client)
+    DATABASE_CONN_MAX_AGE = int(os.environ.get("DATABASE_CONN_MAX_AGE", 0))
 
     DATABASES = {
         'default': {
@@ -141,6 +184,8 @@ if DATABASE == "postgresql":
             'TEST': {
                 'NAME': f"{DATABASE_NAME}_test"
             },
+            # Seconds to keep a connection open for reuse across messages; 0 reconnects for every message
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
         },
     }
     CACHES = {
@@ -18,6 +18,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from mobot_client import views
+
 urlpatterns = [
+    path('metrics', views.metrics, name='metrics'),
+    path('admin/instrumentation/', views.instrumentation_summary, name='instrumentation'),
     path('admin/', admin.site.urls),
 ]
@@ -5,7 +5,9 @@ from .models import (
     Store,
     Customer,
     Drop,
+    DropCounters,
     Item,
+    MetricsSnapshot,
     CustomerStorePreferences,
     CustomerDropRefunds,
     DropSession,
@@ -114,7 +116,18 @@ class DropAdmin(admin.ModelAdmin):
 
     @admin.display(description='Total Spent (MOB)')
     def total_spent(self, obj: Drop):
-        return obj.initial_mob_disbursed() + obj.bonus_mob_disbursed()
+        counts = obj.counts()
+        return counts.initial_sent * obj.initial_coin_amount_mob + counts.bonus_mob_disbursed
+
+
+class DropCountersAdmin(admin.ModelAdmin):
+    list_display = ('drop', 'slot', 'initial_sent', 'bonus_sent', 'bonus_mob_disbursed', 'initial_coin_limit')
+    list_filter = ('drop',)
+
+
+class MetricsSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('process', 'updated')
+    readonly_fields = ('process', 'updated', 'metrics', 'gauges')
 
 
 class PaymentAdmin(admin.ModelAdmin):
@@ -166,7 +179,9 @@ class RawSignalMessageAdmin(admin.ModelAdmin):
 admin.site.register(Store, StoreAdmin)
 admin.site.register(Customer, CustomerAdmin)
 admin.site.register(Drop, DropAdmin)
+admin.site.register(DropCounters, DropCountersAdmin)
 admin.site.register(Item, ItemAdmin)
+admin.site.register(MetricsSnapshot, MetricsSnapshotAdmin)
 admin.site.register(ChatbotSettings, ChatbotSettingsAdmin)
 admin.site.register(CustomerStorePreferences, CustomerStorePreferencesAdmin)
 admin.site.register(CustomerDropRefunds, CustomerDropRefundsAdmin)
@@ -6,3 +6,7 @@ from django.apps import AppConfig
 class MobotClientConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "mobot_client"
+
+    def ready(self):
+        # Hook DB connections for per-message query counts before any are opened
+        from mobot_client import instrumentation  # noqa: F401
@@ -1,3 +1,4 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 
-from .auto_cleanup_executor import AutoCleanupExecutor
\ No newline at end of file
+from .auto_cleanup_executor import AutoCleanupExecutor
+from .aio import AsyncProxy, blocking
@@ -0,0 +1,36 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import functools
+from typing import Any, Awaitable, Callable
+
+from asgiref.sync import sync_to_async
+
+from mobot_client.core.context import release_connection
+
+
+def blocking(func: Callable) -> Callable[..., Awaitable]:
+    """Make a blocking function awaitable. It runs on the event loop's default executor with the caller's context
+    variables, and hands back its worker thread's DB connection when it's done, since nothing else will in that thread.
+    """
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_connection()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+class AsyncProxy:
+    """Wraps a blocking client (messenger, payments, etc.) so its methods can be awaited.
+
+    Calls run on the event loop's default executor with the caller's context variables, so the current ChatContext
+    is still available to the wrapped method.
+    """
+    def __init__(self, wrapped: Any):
+        self._wrapped = wrapped
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._wrapped, name)
+        if callable(attribute):
+            return blocking(attribute)
+        return attribute
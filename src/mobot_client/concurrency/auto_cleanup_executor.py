@@ -20,6 +20,15 @@ class AutoCleanupExecutor(ThreadPoolExecutor):
         fut.add_done_callback(done_callback)
         return fut
 
+    @property
+    def in_flight(self) -> int:
+        """Number of submitted futures not yet finished, running or queued"""
+        return len(self._futures)
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
     def _finish(self):
         for future in as_completed(self._futures):
             future.done()
@@ -1,12 +1,16 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 from __future__ import annotations
-import threading
+import contextvars
 import logging
+from typing import List, Optional
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.db import connection
 from mobot_client.models.messages import Message, MessageStatus, ProcessingError
 
-Context = threading.local()
+# A context variable rather than a thread local, so the current context follows both worker threads and asyncio tasks
+Context: contextvars.ContextVar = contextvars.ContextVar("chat_context")
 
 
 class ContextNotFoundException(Exception):
@@ -15,40 +19,104 @@ class ContextNotFoundException(Exception):
 
 
 def get_current_context():
-    if hasattr(Context, "current"):
-        return Context.current
+    if current := Context.get(None):
+        return current
     else:
         raise ContextNotFoundException("No current context for this thread")
 
 
+def release_connection():
+    """Done with the DB for this message. Keeps this thread's connection open for the next message if it's healthy
+    and younger than CONN_MAX_AGE, so we don't pay for a fresh connection and TLS handshake every time; otherwise
+    closes it.
+    """
+    try:
+        connection.close_if_unusable_or_obsolete()
+    except Exception as e:
+        logging.getLogger("MessageContext").exception("Exception closing DB connection")
+
+
 class ChatContext:
-    def __init__(self, message: Message):
+    BUFFERING_MODES = ("off", "burst", "join")
+
+    def __init__(self, message: Message, reply_buffering: Optional[str] = None, record_status: bool = True):
+        """
+            :param record_status: Mark the message processed (or errored) on leaving; off when replying to a
+                message that's already been handled
+        """
         self._logger = logging.getLogger("MessageContext")
         self.message = message
+        self.record_status = record_status
         self.customer = self.message.customer
+        self.reply_buffering = reply_buffering if reply_buffering is not None else settings.REPLY_BUFFERING
+        if self.reply_buffering not in self.BUFFERING_MODES:
+            raise ValueError(f"Unknown reply buffering mode {self.reply_buffering}")
+        self._replies: List[tuple] = []
         self.set_context()
 
     @staticmethod
     def get_current_context() -> ChatContext:
-        if hasattr(Context, "current"):
-            return Context.current
-        else:
-            raise ContextNotFoundException("No current context for this thread")
+        return get_current_context()
 
     def set_context(self):
-        Context.current = self
+        Context.set(self)
 
     def unset_context(self):
-        if hasattr(Context, 'current'):
-            del Context.current
+        Context.set(None)
 
     def __enter__(self):
         self.set_context()
         return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def buffer_reply(self, messenger, text: str, attachments: list) -> bool:
+        """Hold a reply until the handler's done, if we're buffering.
+
+            :return: True if the reply was buffered, False if it should be sent now
+        """
+        if self.reply_buffering == "off":
+            return False
+        self._replies.append((messenger, text, attachments))
+        return True
+
+    def _joined(self, replies: List[tuple]) -> List[tuple]:
+        """Join runs of consecutive text-only replies into one message each"""
+        joined = []
+        for messenger, text, attachments in replies:
+            if joined and not attachments and not joined[-1][2] and joined[-1][0] is messenger:
+                joined[-1] = (messenger, f"{joined[-1][1]}\n\n{text}", attachments)
+            else:
+                joined.append((messenger, text, attachments))
+        return joined
+
+    def flush_replies(self, wait: bool = True):
+        """Send any buffered replies, in order; e.g. before sending something that isn't buffered.
+
+            :param: wait: Wait until they've actually been sent, if the messenger queues replies for its senders
+        """
+        replies, self._replies = self._replies, []
+        if self.reply_buffering == "join":
+            replies = self._joined(replies)
+        while replies:
+            messenger = replies[0][0]
+            burst = []
+            while replies and replies[0][0] is messenger:
+                _, text, attachments = replies.pop(0)
+                burst.append((text, attachments))
+            messenger.log_and_send_messages(self.customer, burst, self.message)
+            if wait:
+                messenger.drain(self.customer)
+
+    def _finish(self, exc_type, exc_tb):
+        """Send buffered replies, and record the outcome of processing the message"""
         self._logger.info("Leaving message response context")
         try:
+            # The senders keep them in order, so the worker needn't wait for them
+            self.flush_replies(wait=False)
+        except Exception:
+            self._logger.exception("Error sending buffered replies")
+        try:
+            if not self.record_status:
+                return
             if exc_type:
                 self.message.status = MessageStatus.ERROR
                 ProcessingError.objects.create(
@@ -63,13 +131,20 @@ class ChatContext:
             self._logger.exception("Error leaving message context")
             raise e
         finally:
-            try:
-                connection.close()
-            except Exception as e:
-                self._logger.exception("Exception closing DB connection")
-            self.unset_context()
-
-
+            release_connection()
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self._finish(exc_type, exc_tb)
+        finally:
+            self.unset_context()
 
+    async def __aenter__(self):
+        self.set_context()
+        return self
 
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            await sync_to_async(self._finish, thread_sensitive=False)(exc_type, exc_tb)
+        finally:
+            self.unset_context()
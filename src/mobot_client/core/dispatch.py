@@ -0,0 +1,81 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import attr
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Callable, Optional, Any, List, Dict, Pattern
+
+from mobot_client.core.context import ChatContext
+
+
+@attr.s
+class ChatHandler:
+    regex = attr.ib(type=str)
+    callable = attr.ib(type=Callable[[ChatContext], Any])
+    order = attr.ib(type=Optional[int], default=100)
+    name = attr.ib(type=Optional[str], default=None)
+
+
+class ChatDispatcher:
+    """
+    Routes message text to the first matching chat handler, by order then registration order.
+
+    All handler regexes are compiled into a single pattern of anchored lookaheads, one alternative per handler, so
+    the regex engine tries them in priority order in one pass and stops at the first that would match anywhere in
+    the text - the same result as calling re.search on each in turn.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("ChatDispatcher")
+        self._handlers: List[ChatHandler] = []
+        self._pattern: Optional[Pattern] = None
+        self._lock = threading.Lock()
+        self._match_counts = Counter()
+
+    def register(self, handler: ChatHandler):
+        # Validate early, so a bad regex fails at registration rather than on the first message
+        re.compile(handler.regex, re.I)
+        with self._lock:
+            # Use only the order to sort so that declaration order doesn't change.
+            self._handlers = sorted(self._handlers + [handler], key=lambda h: h.order)
+            self._pattern = None
+
+    def _compile(self) -> Optional[Pattern]:
+        alternatives = [f"(?=(?s:.*?)(?:{handler.regex}))(?P<h{index}>)" for index, handler in enumerate(self._handlers)]
+        try:
+            return re.compile(f"(?:{'|'.join(alternatives)})", re.I)
+        except re.error:
+            # e.g. the same named group used by two handlers; fall back to searching one at a time
+            self.logger.warning("Unable to combine chat handler regexes; matching handlers one at a time")
+            return None
+
+    def _find_sequential(self, text: str) -> Optional[int]:
+        for index, handler in enumerate(self._handlers):
+            if re.search(handler.regex, text, re.I):
+                return index
+        return None
+
+    def find(self, text: str) -> Optional[ChatHandler]:
+        """Find the highest priority handler whose regex matches the text"""
+        with self._lock:
+            if self._pattern is None:
+                self._pattern = self._compile() or False
+            pattern, handlers = self._pattern, self._handlers
+        if pattern:
+            match = pattern.match(text)
+            index = int(match.lastgroup[1:]) if match else None
+        else:
+            index = self._find_sequential(text)
+        if index is None:
+            return None
+        handler = handlers[index]
+        with self._lock:
+            self._match_counts[handler.name or handler.regex] += 1
+        return handler
+
+    @property
+    def match_counts(self) -> Dict[str, int]:
+        """Number of messages routed to each handler, by handler name"""
+        with self._lock:
+            return dict(self._match_counts)
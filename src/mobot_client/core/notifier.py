@@ -0,0 +1,130 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+"""
+Wakeup channels between the SignalLogger, which stores incoming messages, and the Subscriber, which processes them.
+
+A notification only says "there may be new messages for this store"; subscribers always re-query the DB to claim work,
+so a lost or duplicated notification costs at most one poll interval or one empty query.
+"""
+import logging
+import select
+import threading
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.db import connections
+
+from mobot_client.models import Store
+
+
+class MessageNotifier:
+    """Base notifier; never wakes early, so subscribers fall back to plain polling"""
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @staticmethod
+    def channel_name(store: Store) -> str:
+        return f"mobot_messages_{store.pk}"
+
+    def notify(self, store: Store):
+        """Signal that a new message for the store has been stored"""
+        pass
+
+    def wait(self, store: Store, timeout: float) -> bool:
+        """Block until a message is signalled for the store, or timeout elapses.
+
+            :return: True if woken by a notification, False on timeout
+        """
+        threading.Event().wait(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class LocalMessageNotifier(MessageNotifier):
+    """In-process notifier, for when the listener and subscriber share a process (and for tests)"""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._events: Dict[str, threading.Event] = {}
+
+    def _event(self, store: Store) -> threading.Event:
+        with self._lock:
+            return self._events.setdefault(self.channel_name(store), threading.Event())
+
+    def notify(self, store: Store):
+        self._event(store).set()
+
+    def wait(self, store: Store, timeout: float) -> bool:
+        event = self._event(store)
+        woken = event.wait(timeout)
+        event.clear()
+        return woken
+
+
+class PostgresMessageNotifier(MessageNotifier):
+    """Cross-process notifier built on Postgres LISTEN/NOTIFY.
+
+    Notifications are sent over Django's connection, so they're delivered when the storing transaction commits.
+    Listening uses a dedicated autocommit connection, since Django's connections are closed between messages.
+    """
+
+    def __init__(self, using: str = 'default'):
+        super().__init__()
+        self._using = using
+        self._listen_connection = None
+        self._channels = set()
+
+    def notify(self, store: Store):
+        with connections[self._using].cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, '')", [self.channel_name(store)])
+
+    def _get_listen_connection(self, channel: str):
+        if self._listen_connection is None or self._listen_connection.closed:
+            import psycopg2
+            from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+            params = connections[self._using].get_connection_params()
+            self._listen_connection = psycopg2.connect(**params)
+            self._listen_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            self._channels = set()
+        if channel not in self._channels:
+            with self._listen_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{channel}";')
+            self._channels.add(channel)
+        return self._listen_connection
+
+    def wait(self, store: Store, timeout: float) -> bool:
+        try:
+            conn = self._get_listen_connection(self.channel_name(store))
+            readable, _, _ = select.select([conn], [], [], timeout)
+            if not readable:
+                return False
+            conn.poll()
+            woken = bool(conn.notifies)
+            conn.notifies.clear()
+            return woken
+        except Exception:
+            self.logger.exception("Error waiting on message notification; falling back to polling")
+            self.close()
+            return super().wait(store, timeout)
+
+    def close(self):
+        if self._listen_connection is not None:
+            try:
+                self._listen_connection.close()
+            except Exception:
+                self.logger.exception("Exception closing listen connection")
+            self._listen_connection = None
+
+
+def get_message_notifier(backend: Optional[str] = None) -> MessageNotifier:
+    """Build the configured notifier. One of 'postgresql', 'local' or 'none'"""
+    backend = backend or settings.MESSAGE_NOTIFIER
+    if backend == 'postgresql':
+        return PostgresMessageNotifier()
+    elif backend == 'local':
+        return LocalMessageNotifier()
+    else:
+        return MessageNotifier()
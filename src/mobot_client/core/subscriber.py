@@ -1,27 +1,26 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
-import attr
+import asyncio
+import functools
 import logging
-import re
+import threading
 import time
 from halo import Halo
-from typing import Callable, Optional, Any
+from typing import Callable, Optional, Any, List, Dict
 from concurrent.futures import as_completed, ThreadPoolExecutor, Future
+from django.db.models import prefetch_related_objects
 from django.conf import settings
+from django.utils import timezone
 
 from mobot_client.chat_strings import ChatStrings
-from mobot_client.concurrency import AutoCleanupExecutor
+from mobot_client.concurrency import AutoCleanupExecutor, AsyncProxy, blocking
 from mobot_client.core import ConfigurationException
 from mobot_client.logger import SignalMessenger
 from mobot_client.models import Store
 from mobot_client.models.messages import Message
 from mobot_client.core.context import ChatContext
-
-
-@attr.s
-class ChatHandler:
-    regex = attr.ib(type=str)
-    callable = attr.ib(type=Callable[[ChatContext], Any])
-    order = attr.ib(type=Optional[int], default=100)
+from mobot_client.core.dispatch import ChatDispatcher, ChatHandler
+from mobot_client.core.notifier import MessageNotifier, get_message_notifier
+from mobot_client.instrumentation import instrumentation
 
 
 class Subscriber:
@@ -29,23 +28,43 @@ class Subscriber:
     Base class for all bots that subscribe to the Messages table
     """
 
-    def __init__(self, store: Store, messenger: SignalMessenger):
+    def __init__(self, store: Store, messenger: SignalMessenger, notifier: Optional[MessageNotifier] = None,
+                 shard_index: int = 0, shard_count: int = 1):
         self._run = True
-        self._chat_handlers = []
+        self._dispatcher = ChatDispatcher()
         self._payment_handlers = []
         self.store: Store = store
         if not self.store:
             raise ConfigurationException("No store found!")
-        self.logger = logging.getLogger(f"Subscriber({self.store})")
+        if not 0 <= shard_index < shard_count:
+            raise ConfigurationException(f"Shard index {shard_index} out of range for {shard_count} shards")
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.logger = logging.getLogger(f"Subscriber({self.store}, shard {shard_index + 1}/{shard_count})")
         self.messenger = messenger
+        self.async_messenger = AsyncProxy(messenger)
+        self.notifier = notifier if notifier is not None else get_message_notifier()
+        self.poll_interval = settings.MESSAGE_POLL_INTERVAL_SECONDS
 
         self._number_processed = 0
         self._futures = {}
+        self.max_workers = 8
+        self._slots = threading.BoundedSemaphore(self.max_workers)
 
     def _get_pool(self):
-        return AutoCleanupExecutor(max_workers=8)
+        return AutoCleanupExecutor(max_workers=self.max_workers)
 
     def _isolated_handler(self, func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def isolated(*args, **kwargs):
+                try:
+                    await func(*args, **kwargs)
+                except Exception as e:
+                    self.logger.exception(f"Chat exception while processing: --- {func.__name__}({args}, {kwargs})\n")
+            return isolated
+
+        @functools.wraps(func)
         def isolated(*args, **kwargs):
             try:
                 func(*args, **kwargs)
@@ -54,12 +73,12 @@ class Subscriber:
         return isolated
 
     def register_chat_handler(self, regex, func, order=100):
+        """Register a handler for messages matching regex. Handlers may be plain functions or coroutine functions."""
         self.logger.info(f"Registering chat handler for {regex if regex else 'default'}")
-        regex = re.compile(regex, re.I)
-
-        self._chat_handlers.append((order, regex, self._isolated_handler(func)))
-        # Use only the first value to sort so that declaration order doesn't change.
-        self._chat_handlers.sort(key=lambda x: x[0])
+        self._dispatcher.register(ChatHandler(regex=regex,
+                                              callable=self._isolated_handler(func),
+                                              order=order,
+                                              name=getattr(func, '__name__', regex)))
 
     def register_payment_handler(self, func):
         isolated = self._isolated_handler(func)
@@ -68,13 +87,19 @@ class Subscriber:
 
     def _find_handler(self, message: Message) -> Callable:
         """Perform a regex match search to find an appropriate handler for an incoming message"""
-        self.logger.info(f"Finding handler for message {message}")
+        self.logger.debug(f"Finding handler for message {message}")
         if message.text is None:
             return self._payment_handlers[0]
         else:
-            filtered = list(filter(lambda handler: re.search(handler[1], message.text), self._chat_handlers))[0]
-            _, _, func = filtered
-            return func
+            handler = self._dispatcher.find(message.text)
+            if handler is None:
+                raise ConfigurationException(f"No chat handler registered for message {message}")
+            return handler.callable
+
+    @property
+    def handler_match_counts(self) -> Dict[str, int]:
+        """Number of messages routed to each chat handler since startup"""
+        return self._dispatcher.match_counts
 
     def _should_acknowledge_payment(self, message: Message) -> bool:
         return message.payment is not None
@@ -85,10 +110,13 @@ class Subscriber:
     def _ack_payment(self):
         self.logger.info("Acknowledging payment...")
         self.messenger.log_and_send_message(ChatStrings.PAYMENT_RECEIVED)
+        # Acks go out now, not when the handler's done
+        ChatContext.get_current_context().flush_replies(wait=False)
 
     def _ack_heavy_load(self):
         self.logger.info("Acknowledging heavy load...")
         self.messenger.log_and_send_message(ChatStrings.MOBOT_HEAVY_LOAD)
+        ChatContext.get_current_context().flush_replies(wait=False)
 
     def process_message(self, message: Message) -> Message:
         """Enter a chat context to manage which message/payment we're currently replying to
@@ -97,55 +125,100 @@ class Subscriber:
             :return: The processed message
             :rtype: Message
         """
-        with ChatContext(message) as ctx:
+        with instrumentation.message() as timings, ChatContext(message) as ctx:
             try:
                 if self._should_acknowledge_payment(message):
                     self._ack_payment()
                 if self._should_acknowledge_load():
                     self._ack_heavy_load()
                 handler = self._find_handler(message)
+                timings.handler = handler.__name__
                 result = handler(ctx)
+                if asyncio.iscoroutine(result):
+                    asyncio.run(result)
                 self.logger.info(f"Message handled: {message.customer}:{message.text}:{message.payment}")
                 return message
             except Exception as e:
                 self.logger.exception("Processing message failed!")
                 raise e
 
-    def _get_next_message(self) -> Message:
+    def _claim_batch(self, limit: int) -> List[Message]:
+        """Claim up to limit messages, timing the claim and how long each claimed message waited in the queue"""
+        start = time.perf_counter()
+        messages = Message.objects.claim_batch(self.store, limit,
+                                               shard_index=self.shard_index,
+                                               shard_count=self.shard_count)
+        instrumentation.observe("message_claim_seconds", time.perf_counter() - start)
+        now = timezone.now()
+        for message in messages:
+            instrumentation.observe("message_queue_seconds", (now - message.date).total_seconds())
+        return messages
+
+    def _register_gauges(self, runtime: str, in_flight: Callable[[], int], capacity: int):
+        instrumentation.register_gauge("worker_in_flight", in_flight, runtime)
+        instrumentation.register_gauge("worker_capacity", lambda: capacity, runtime)
+        instrumentation.register_gauge("reply_queue_depth", lambda: self.messenger.queue_depth)
+
+    def _unregister_gauges(self, runtime: str):
+        instrumentation.unregister_gauge("worker_in_flight", runtime)
+        instrumentation.unregister_gauge("worker_capacity", runtime)
+        instrumentation.unregister_gauge("reply_queue_depth")
+
+    def _get_next_messages(self, limit: int) -> List[Message]:
         """
-        Get a message off the DB, show a spinner while waiting
+        Claim a batch of messages off the DB, show a spinner while waiting.
+        Blocks on the notifier between attempts, so polling is only a fallback.
 
-        :return: The next available message to process
-        :rtype: Message
+        :param limit: Maximum number of messages to claim
+        :return: The next available messages to process, at most one per customer
+        :rtype: List[Message]
         """
         with Halo(text='Waiting for next message...', spinner='dots') as spinner:
             while self._run:
                 try:
-                    message = Message.objects.get_message(self.store)
-                    if message:
-                        return message
+                    messages = self._claim_batch(limit)
+                    if messages:
+                        return messages
                     else:
-                        time.sleep(1)
+                        self.notifier.wait(self.store, self.poll_interval)
                 except Exception as e:
                     self.logger.exception("Exception getting message!")
                     raise e
+        return []
+
+    def _acquire_slots(self, limit: int) -> int:
+        """Block until at least one worker is free, then take as many free workers as are available, up to limit"""
+        self._slots.acquire()
+        acquired = 1
+        while acquired < limit and self._slots.acquire(blocking=False):
+            acquired += 1
+        return acquired
 
-    def _get_and_process(self, pool: ThreadPoolExecutor) -> Future[Message]:
+    def _get_and_process(self, pool: ThreadPoolExecutor, limit: int) -> List[Future[Message]]:
+        """Fill free workers with a single batch claim"""
+        acquired = self._acquire_slots(limit)
+        futures = []
         try:
-            message: Message = self._get_next_message()
-            self.logger.info("Got message!")
-            process_fut = pool.submit(self.process_message, message)
-            process_fut.add_done_callback(self._done)
-            return process_fut
+            messages = self._get_next_messages(acquired)
+            self.logger.info(f"Got {len(messages)} message(s)!")
+            for message in messages:
+                process_fut = pool.submit(self.process_message, message)
+                process_fut.add_done_callback(self._done)
+                futures.append(process_fut)
         except Exception as e:
             self.logger.exception(f"Exception processing messages.")
+        finally:
+            for _ in range(acquired - len(futures)):
+                self._slots.release()
+        return futures
 
     def _done(self, fut: Future[Message]):
         """
-        Clean up future list
+        Clean up future list, and free up the worker for the next claim
         :param fut: The message future
         :return: None
         """
+        self._slots.release()
         try:
             result = fut.result()
             self.logger.info(f"Finished processing: {result}")
@@ -159,11 +232,125 @@ class Subscriber:
                 :param process_max: Number of messages to process before stopping, if > 0
         """
         self._run = True
+        instrumentation.start_publishing()
+        self._slots = threading.BoundedSemaphore(self.max_workers)
         with self._get_pool() as pool:
-            while self._run:
-                processed = self._get_and_process(pool)
-                processed.add_done_callback(self._done)
-                self._number_processed += 1
-                if 0 < process_max == self._number_processed:
-                    self._run = False
+            self._register_gauges("threads", lambda: pool.in_flight, pool.max_workers)
+            try:
+                while self._run:
+                    limit = self.max_workers
+                    if process_max > 0:
+                        limit = min(limit, process_max - self._number_processed)
+                    processed = self._get_and_process(pool, limit)
+                    self._number_processed += len(processed)
+                    if 0 < process_max <= self._number_processed:
+                        self._run = False
+            finally:
+                self._unregister_gauges("threads")
+        self.notifier.close()
+        return self._number_processed
+
+    # --- asyncio runtime --- #
+
+    def _claim_for_async(self, limit: int) -> List[Message]:
+        """Claim messages and load everything the event loop will touch, since it can't query the DB itself"""
+        messages = self._claim_batch(limit)
+        prefetch_related_objects(messages, 'customer', 'payment')
+        return messages
+
+    async def process_message_async(self, message: Message) -> Message:
+        """Like process_message, but runs coroutine handlers on the event loop, and anything blocking in a worker
+            thread from the loop's default executor.
+
+            :param: message: Message to process, with customer and payment already loaded
+            :return: The processed message
+        """
+        with instrumentation.message() as timings:
+            async with ChatContext(message) as ctx:
+                try:
+                    if self._should_acknowledge_payment(message):
+                        await blocking(self._ack_payment)()
+                    if await blocking(self._should_acknowledge_load)():
+                        await blocking(self._ack_heavy_load)()
+                    handler = self._find_handler(message)
+                    timings.handler = handler.__name__
+                    if asyncio.iscoroutinefunction(handler):
+                        await handler(ctx)
+                    else:
+                        await blocking(handler)(ctx)
+                    self.logger.info(f"Message handled: {message.customer}:{message.text}:{message.payment}")
+                    return message
+                except Exception as e:
+                    self.logger.exception("Processing message failed!")
+                    raise e
+
+    def _done_async(self, task: asyncio.Task):
+        try:
+            self.logger.info(f"Finished processing: {task.result()}")
+        except asyncio.CancelledError:
+            self.logger.warning("Message processing cancelled.")
+        except Exception as e:
+            self.logger.exception("Error resolving message task")
+
+    async def run_chat_async(self, process_max: int = 0, max_concurrency: int = 1000,
+                             blocking_workers: Optional[int] = None) -> int:
+        """Start looking for messages off DB and process them on an event loop.
+
+            :param process_max: Number of messages to process before stopping, if > 0
+            :param max_concurrency: Maximum number of conversations in flight at once
+            :param blocking_workers: Number of threads for blocking calls (DB, signald, full-service). Defaults to
+                max_concurrency, since synchronous handlers hold a thread each for as long as they run
+            :return: Number of messages processed
+        """
+        self._run = True
+        instrumentation.start_publishing()
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=blocking_workers or max_concurrency))
+        in_flight = asyncio.Semaphore(max_concurrency)
+        tasks = set()
+        claim = blocking(self._claim_for_async)
+        wait = blocking(self.notifier.wait)
+
+        def done(task: asyncio.Task):
+            tasks.discard(task)
+            in_flight.release()
+            self._done_async(task)
+
+        self._register_gauges("asyncio", lambda: len(tasks), max_concurrency)
+
+        while self._run:
+            limit = max_concurrency
+            if process_max > 0:
+                limit = min(limit, process_max - self._number_processed)
+            await in_flight.acquire()
+            acquired = 1
+            while acquired < limit and not in_flight.locked():
+                await in_flight.acquire()
+                acquired += 1
+            try:
+                messages = await claim(acquired)
+            except Exception:
+                self.logger.exception("Exception getting message!")
+                messages = []
+            for _ in range(acquired - len(messages)):
+                in_flight.release()
+            if not messages:
+                await wait(self.store, self.poll_interval)
+                continue
+            self.logger.info(f"Got {len(messages)} message(s)!")
+            for message in messages:
+                task = asyncio.create_task(self.process_message_async(message))
+                tasks.add(task)
+                task.add_done_callback(done)
+            self._number_processed += len(messages)
+            if 0 < process_max <= self._number_processed:
+                self._run = False
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._unregister_gauges("asyncio")
+        await blocking(self.notifier.close)()
+        return self._number_processed
 
+    def run_chat_with_asyncio(self, process_max: int = 0, max_concurrency: int = 1000) -> int:
+        """Entrypoint for running run_chat_async in its own thread or process"""
+        return asyncio.run(self.run_chat_async(process_max=process_max, max_concurrency=max_concurrency))
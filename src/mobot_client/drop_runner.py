@@ -1,7 +1,10 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
+from typing import Optional
+
 import mobilecoin as mc
 import pytz
 
+from mobot_client.concurrency import AsyncProxy, blocking
 from mobot_client.core.context import ChatContext
 from mobot_client.core.subscriber import Subscriber
 from mobot_client.models.messages import Message, PaymentStatus
@@ -23,6 +26,7 @@ from mobot_client.air_drop_session import AirDropSession
 from mobot_client.item_drop_session import ItemDropSession
 from mobot_client.chat_strings import ChatStrings
 from mobot_client.payments import Payments
+from mobot_client.timeouts import TimeoutScheduler
 
 import os
 import django
@@ -40,9 +44,13 @@ class DropRunner(Subscriber):
     """
     A specific kind of Subscriber that runs Airdrops and Item drops. This is what used to be MOBot.
     """
-    def __init__(self, store: Store, messenger: SignalMessenger, payments: Payments):
-        super().__init__(store, messenger)
+    def __init__(self, store: Store, messenger: SignalMessenger, payments: Payments,
+                 timeouts: Optional[TimeoutScheduler] = None, **kwargs):
+        super().__init__(store, messenger, **kwargs)
         self.payments = payments
+        self.async_payments = AsyncProxy(payments)
+        # Session idle/cancel deadlines, re-armed by every message we process
+        self.timeouts = timeouts
         self.logger.info("Registering handlers...")
         self.register_payment_handler(self.handle_payment)
         self.register_chat_handler("\+", self.chat_router_plus)
@@ -54,6 +62,36 @@ class DropRunner(Subscriber):
         self.register_chat_handler("health", self.health_handler)
         self.register_chat_handler("", self.default_handler)
 
+    def _arm_timeouts(self, message: Message):
+        if self.timeouts is not None:
+            try:
+                self.timeouts.arm_customer(message.customer_id, message.date)
+            except Exception:
+                self.logger.exception("Exception arming session timeouts")
+
+    def process_message(self, message: Message) -> Message:
+        try:
+            return super().process_message(message)
+        finally:
+            self._arm_timeouts(message)
+
+    async def process_message_async(self, message: Message) -> Message:
+        try:
+            return await super().process_message_async(message)
+        finally:
+            await blocking(self._arm_timeouts)(message)
+
+    def run_chat(self, process_max: int = 0) -> int:
+        if self.timeouts is not None:
+            self.timeouts.start()
+        return super().run_chat(process_max)
+
+    async def run_chat_async(self, process_max: int = 0, max_concurrency: int = 1000,
+                             blocking_workers: Optional[int] = None) -> int:
+        if self.timeouts is not None:
+            await blocking(self.timeouts.start)()
+        return await super().run_chat_async(process_max, max_concurrency, blocking_workers)
+
     def maybe_advertise_drop(self, customer: Customer):
         """Figure out whether or not there's a drop running, and send a message if it is"""
         self.logger.info("Checking for advertising drop")
@@ -104,27 +142,20 @@ class DropRunner(Subscriber):
         message.refresh_from_db()
         source = str(message.customer.phone_number)
         self.logger.info(f"Received payment {payment} from {source}")
-        receipt_status = None
-        transaction_status = "TransactionPending"
 
         if isinstance(source, dict):
             source = source["number"]
 
-        self.logger.info(f"received receipt {payment.signal_payment.receipt}")
-        receipt = mc_util.b64_receipt_to_full_service_receipt(payment.signal_payment.receipt)
-
-        while transaction_status == PaymentStatus.TransactionPending:
-            receipt_status = self.payments.mcc.check_receiver_receipt_status(
-                self.payments.mcc.public_address, receipt
-            )
-            transaction_status = receipt_status["receipt_transaction_status"]
-            self.logger.info(f"Waiting for {receipt}, current status {receipt_status}")
+        if payment.status == PaymentStatus.TransactionPending:
+            # Normally resolved by the PaymentVerifier before the message reaches us
+            self.logger.warning(f"Payment {payment} not yet verified; waiting on it")
+            payment = self.payments.mcc.process_payment(payment)
 
-        if transaction_status != PaymentStatus.TransactionSuccess:
-            self.logger.error(f"failed {transaction_status}")
+        if payment.status != PaymentStatus.TransactionSuccess:
+            self.logger.error(f"failed {payment.status}")
             return "The transaction failed!"
 
-        amount_paid_mob = mc.pmob2mob(receipt_status["txo"]["value_pmob"])
+        amount_paid_mob = payment.amount_mob
         customer = payment.message.customer
         drop_session = customer.drop_sessions.filter(state=SessionState.WAITING_FOR_PAYMENT).first()
 
@@ -180,9 +211,8 @@ class DropRunner(Subscriber):
             skus = Sku.objects.filter(item=active_drop.item).order_by("sort_order")
             message_to_send = ""
             for sku in skus:
-                number_ordered = Order.objects.filter(sku=sku).exclude(status=OrderStatus.CANCELLED).count()
                 message_to_send += (
-                    f"{sku.identifier} - {number_ordered} / {sku.quantity} ordered\n"
+                    f"{sku.identifier} - {sku.quantity - sku.remaining} / {sku.quantity} ordered\n"
                 )
         self.messenger.log_and_send_message(message_to_send)
 
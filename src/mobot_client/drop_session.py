@@ -1,7 +1,6 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 
 import logging
-from django.utils import timezone
 
 from mobot_client.chat_strings import ChatStrings
 from mobot_client.logger import SignalMessenger
@@ -20,20 +19,12 @@ class BaseDropSession:
 
     @staticmethod
     def get_advertising_drop():
-        drops_to_advertise = Drop.objects.filter(
-            advertisment_start_time__lte=timezone.now()
-        ).filter(start_time__gt=timezone.now())
-
-        if len(drops_to_advertise) > 0:
-            return drops_to_advertise[0]
-        return None
+        return Drop.objects.get_advertising_drop()
 
     @staticmethod
     def under_drop_quota(drop):
-        number_initial_drops_finished = DropSession.objects.filter(
-            drop=drop, state__gt=SessionState.READY
-        ).count()
-        return number_initial_drops_finished < drop.initial_coin_limit
+        counts = drop.counts()
+        return counts.initial_sent < counts.initial_coin_limit
 
     def customer_has_store_preferences(self, customer):
         try:
@@ -0,0 +1,276 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+"""
+Hot path instrumentation: where the time goes for each message we handle.
+
+Subscriber.process_message runs every message inside instrumentation.message(), which tracks its wall time and
+the DB queries, signald calls and full-service calls made while handling it, then adds them to histograms by
+handler. Each process keeps its own histograms, and gauges such as how many workers are busy, and publishes them to
+the MetricsSnapshot table every INSTRUMENTATION_PUBLISH_SECONDS, so the show_instrumentation command, the admin and
+the /metrics endpoint can merge them across shards.
+"""
+import bisect
+import contextvars
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import attr
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """Counts of observations falling into fixed buckets, like a Prometheus histogram"""
+
+    def __init__(self, buckets: Sequence[float] = SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket's upper bound, then one for anything above the last
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile; the max if it's past the last bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def merge(self, other: "Histogram"):
+        if other.buckets != self.buckets:
+            raise ValueError("Can't merge histograms with different buckets")
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def summary(self) -> Dict[str, float]:
+        return dict(
+            count=self.count,
+            mean=self.sum / self.count if self.count else 0.0,
+            p50=self.quantile(0.5),
+            p90=self.quantile(0.9),
+            p99=self.quantile(0.99),
+            max=self.max,
+        )
+
+    def as_dict(self) -> dict:
+        return dict(buckets=list(self.buckets), counts=self.counts, count=self.count, sum=self.sum, max=self.max)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        histogram = cls(data["buckets"])
+        histogram.counts = list(data["counts"])
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        histogram.max = data["max"]
+        return histogram
+
+
+@attr.s
+class MessageTimings:
+    handler = attr.ib(type=str, default="")
+    db_queries = attr.ib(type=int, default=0)
+    db_seconds = attr.ib(type=float, default=0.0)
+    signald_seconds = attr.ib(type=float, default=0.0)
+    full_service_seconds = attr.ib(type=float, default=0.0)
+
+
+# The message being handled, followed into worker threads and asyncio tasks like the ChatContext
+_current: contextvars.ContextVar = contextvars.ContextVar("message_timings", default=None)
+
+
+class Instrumentation:
+    SIGNALD = "signald"
+    FULL_SERVICE = "full_service"
+
+    def __init__(self):
+        self.logger = logging.getLogger("Instrumentation")
+        self._lock = threading.Lock()
+        # (metric, label) -> histogram
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        # (metric, label) -> callable reading the gauge's current value
+        self._gauges: Dict[Tuple[str, str], Callable[[], float]] = {}
+        self._publisher: Optional[threading.Thread] = None
+        self._publisher_pid: Optional[int] = None
+
+    @property
+    def process_name(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def observe(self, metric: str, value: float, label: str = "", buckets: Sequence[float] = SECONDS_BUCKETS):
+        with self._lock:
+            histogram = self._histograms.get((metric, label))
+            if histogram is None:
+                histogram = self._histograms[(metric, label)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_gauge(self, metric: str, read: Callable[[], float], label: str = ""):
+        """Publish read()'s value with every snapshot, until the gauge is unregistered"""
+        with self._lock:
+            self._gauges[(metric, label)] = read
+
+    def unregister_gauge(self, metric: str, label: str = ""):
+        with self._lock:
+            self._gauges.pop((metric, label), None)
+
+    def gauges(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            gauges = list(self._gauges.items())
+        values: Dict[str, Dict[str, float]] = {}
+        for (metric, label), read in gauges:
+            try:
+                values.setdefault(metric, {})[label] = float(read())
+            except Exception:
+                self.logger.exception(f"Exception reading gauge {metric}")
+        return values
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """Installed on every DB connection; counts queries made while handling a message"""
+        timings: Optional[MessageTimings] = _current.get()
+        if timings is None:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            timings.db_queries += 1
+            timings.db_seconds += time.perf_counter() - start
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self.execute_wrapper not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.execute_wrapper)
+
+    @contextmanager
+    def message(self, handler: str = "") -> Iterator[MessageTimings]:
+        """Time handling one message. Set the handler on the timings once it's known."""
+        timings = MessageTimings(handler=handler)
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            yield timings
+        finally:
+            wall = time.perf_counter() - start
+            _current.reset(token)
+            label = timings.handler or "unknown"
+            self.observe("message_seconds", wall, label)
+            self.observe("message_db_queries", timings.db_queries, label, COUNT_BUCKETS)
+            self.observe("message_db_seconds", timings.db_seconds, label)
+            self.observe("message_signald_seconds", timings.signald_seconds, label)
+            self.observe("message_full_service_seconds", timings.full_service_seconds, label)
+
+    @contextmanager
+    def timed(self, service: str):
+        """Time a call to signald or full-service, counting it against the current message if there is one"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(f"{service}_call_seconds", elapsed)
+            timings: Optional[MessageTimings] = _current.get()
+            if timings is not None:
+                setattr(timings, f"{service}_seconds", getattr(timings, f"{service}_seconds") + elapsed)
+
+    def histograms(self) -> Dict[Tuple[str, str], Histogram]:
+        with self._lock:
+            return {key: Histogram.from_dict(histogram.as_dict()) for key, histogram in self._histograms.items()}
+
+    def snapshot(self) -> Dict[str, Dict[str, dict]]:
+        snapshot: Dict[str, Dict[str, dict]] = {}
+        for (metric, label), histogram in self.histograms().items():
+            snapshot.setdefault(metric, {})[label] = histogram.as_dict()
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._gauges.clear()
+
+    def publish(self):
+        from mobot_client.models import MetricsSnapshot
+        MetricsSnapshot.objects.update_or_create(process=self.process_name,
+                                                 defaults=dict(metrics=self.snapshot(), gauges=self.gauges()))
+
+    def _publish_every(self, interval: float):
+        from mobot_client.core.context import release_connection
+        while True:
+            time.sleep(interval)
+            try:
+                self.publish()
+            except Exception:
+                self.logger.exception("Exception publishing instrumentation")
+            finally:
+                release_connection()
+
+    def start_publishing(self, interval: Optional[float] = None):
+        """Publish this process' histograms in the background, from now on"""
+        interval = interval if interval is not None else settings.INSTRUMENTATION_PUBLISH_SECONDS
+        if interval <= 0:
+            return
+        with self._lock:
+            # Started lazily, so each forked shard publishes its own
+            if self._publisher is not None and self._publisher.is_alive() and self._publisher_pid == os.getpid():
+                return
+            self._publisher = threading.Thread(target=self._publish_every, args=(interval,),
+                                               name="InstrumentationPublisher", daemon=True)
+            self._publisher_pid = os.getpid()
+            self._publisher.start()
+
+    @staticmethod
+    def collect(max_age: float = 300) -> Dict[Tuple[str, str], Histogram]:
+        """Merge the histograms every process has published in the last max_age seconds"""
+        from mobot_client.models import MetricsSnapshot
+        merged: Dict[Tuple[str, str], Histogram] = {}
+        snapshots = MetricsSnapshot.objects.filter(updated__gte=timezone.now() - timedelta(seconds=max_age))
+        for snapshot in snapshots:
+            for metric, labels in snapshot.metrics.items():
+                for label, data in labels.items():
+                    histogram = Histogram.from_dict(data)
+                    if (metric, label) in merged:
+                        merged[(metric, label)].merge(histogram)
+                    else:
+                        merged[(metric, label)] = histogram
+        return merged
+
+    @staticmethod
+    def collect_gauges(max_age: float = 300) -> Dict[Tuple[str, str], float]:
+        """Sum the gauges every process has published in the last max_age seconds"""
+        from mobot_client.models import MetricsSnapshot
+        summed: Dict[Tuple[str, str], float] = {}
+        snapshots = MetricsSnapshot.objects.filter(updated__gte=timezone.now() - timedelta(seconds=max_age))
+        for gauges in snapshots.values_list('gauges', flat=True):
+            for metric, labels in gauges.items():
+                for label, value in labels.items():
+                    summed[(metric, label)] = summed.get((metric, label), 0.0) + value
+        return summed
+
+    @staticmethod
+    def summarize(histograms: Dict[Tuple[str, str], Histogram]) -> List[dict]:
+        return [dict(metric=metric, label=label, **histogram.summary())
+                for (metric, label), histogram in sorted(histograms.items())]
+
+
+instrumentation = Instrumentation()
+connection_created.connect(instrumentation.install)
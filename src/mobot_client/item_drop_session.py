@@ -161,8 +161,7 @@ class ItemDropSession(BaseDropSession):
         self.payments.send_reply_payment(drop_session.drop.item.price_in_mob, should_refund_transaction_fee)
         
         if order is not None:
-            order.status = OrderStatus.CANCELLED
-            order.save()
+            order.cancel()
 
         drop_session.state = SessionState.REFUNDED
         drop_session.save()
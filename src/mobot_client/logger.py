@@ -1,20 +1,158 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 import logging
-from typing import Optional
+import os
+import queue
+import threading
+import weakref
+from typing import List, Optional, Tuple, Union
+
+import attr
 
 from mobot_client.models import Store, Customer
 from signald import Signal
 from mobot_client.models.messages import Message, MobotResponse, Direction, MessageStatus
-from mobot_client.core.context import ChatContext
+from mobot_client.core.context import ChatContext, release_connection
+from mobot_client.instrumentation import instrumentation
+
+
+class ReplyNotSentException(Exception):
+    pass
+
+
+@attr.s
+class OutboundReply:
+    customer = attr.ib(type=Customer)
+    text = attr.ib(type=str)
+    incoming = attr.ib(type=Optional[Message], default=None)
+    attachments = attr.ib(type=list, factory=list)
 
 
 class SignalMessenger:
-    def __init__(self, signal: Signal, store: Store):
+    """
+    Sends replies over signal and logs them to the DB.
+
+    With sender_workers, replies are queued and sent by a pool of sender threads, so handlers return as soon as
+    their replies are enqueued. Each customer's replies always go to the same sender, so they arrive in order, and
+    each sender logs everything it sent in a burst with one bulk insert for the messages and one for the responses.
+    Anything sent to a customer outside the queue, like a payment receipt, should wait for drain() first.
+    """
+    # Most replies a sender will send before logging them
+    MAX_BURST = 50
+
+    def __init__(self, signal: Signal, store: Store, sender_workers: int = 0):
         self.signal = signal
         self.store = store
         self.logger = logging.getLogger("SignalMessenger")
+        # Each queue holds replies, and events to set once everything queued before them has been sent
+        self._queues: List["queue.Queue[Union[OutboundReply, threading.Event]]"] = [
+            queue.Queue() for _ in range(sender_workers)
+        ]
+        self._senders: List[Optional[threading.Thread]] = [None] * sender_workers
+        self._lock = threading.Lock()
+        if sender_workers:
+            messenger = weakref.ref(self)
+            os.register_at_fork(after_in_child=lambda: messenger() and messenger()._after_fork())
+
+    def _after_fork(self):
+        """Only the forking thread survives a fork. Senders and replies queued in the parent stay the parent's, and
+        a lock another thread held would never be released, so start afresh."""
+        self._queues = [queue.Queue() for _ in self._queues]
+        self._senders = [None] * len(self._queues)
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def _ensure_sender(self, index: int):
+        """Start the sender for one queue if it isn't running. Only ever one per queue, to keep replies in order."""
+        with self._lock:
+            sender = self._senders[index]
+            # Started lazily, so processes forked from the one that created us get their own threads
+            if sender is None or not sender.is_alive():
+                sender = threading.Thread(target=self._send_from, args=(self._queues[index],),
+                                          name=f"SignalSender-{index}", daemon=True)
+                self._senders[index] = sender
+                sender.start()
+
+    def _send(self, reply: OutboundReply) -> bool:
+        try:
+            with instrumentation.timed(instrumentation.SIGNALD):
+                self.signal.send_message(recipient=reply.customer.phone_number.as_e164,
+                                         text=reply.text,
+                                         block=True,
+                                         attachments=reply.attachments)
+            return True
+        except Exception:
+            self.logger.exception(f"Exception sending reply to {reply.customer}")
+            return False
+
+    def _log_burst(self, replies: List[OutboundReply], sent: List[bool]):
+        messages = Message.objects.bulk_create([
+            Message(
+                customer=reply.customer,
+                store=self.store,
+                text=reply.text,
+                direction=Direction.SENT,
+                status=MessageStatus.PROCESSED if ok else MessageStatus.ERROR,
+            ) for reply, ok in zip(replies, sent)
+        ])
+        MobotResponse.objects.bulk_create([
+            MobotResponse(incoming=reply.incoming, outgoing_response=message)
+            for reply, ok, message in zip(replies, sent, messages) if ok and reply.incoming
+        ])
+
+    def _send_from(self, replies: "queue.Queue[Union[OutboundReply, threading.Event]]"):
+        while True:
+            items = [replies.get()]
+            while len(items) < self.MAX_BURST:
+                try:
+                    items.append(replies.get_nowait())
+                except queue.Empty:
+                    break
+            burst = [item for item in items if isinstance(item, OutboundReply)]
+            try:
+                sent = [self._send(reply) for reply in burst]
+                if burst:
+                    self._log_burst(burst, sent)
+            except Exception:
+                self.logger.exception(f"Exception logging {len(burst)} replies")
+            finally:
+                release_connection()
+                # Everything queued before these has been sent
+                for item in items:
+                    if isinstance(item, threading.Event):
+                        item.set()
+                    replies.task_done()
+
+    def flush(self):
+        """Wait until every queued reply has been sent and logged"""
+        for q in self._queues:
+            q.join()
+
+    def drain(self, customer: Customer, timeout: Optional[float] = None) -> bool:
+        """Wait until every reply queued for the customer so far has been sent.
+
+            :return: False if we timed out waiting
+        """
+        if not self._queues:
+            return True
+        sent = threading.Event()
+        index = customer.pk % len(self._queues)
+        self._ensure_sender(index)
+        self._queues[index].put(sent)
+        return sent.wait(timeout)
+
+    def _enqueue(self, reply: OutboundReply):
+        index = reply.customer.pk % len(self._queues)
+        self._ensure_sender(index)
+        self._queues[index].put(reply)
 
     def _log_and_send_message(self, customer: Customer, text: str, incoming: Optional[Message] = None, attachments=[]) -> Optional[MobotResponse]:
+        if self._queues:
+            self._enqueue(OutboundReply(customer=customer, text=text, incoming=incoming, attachments=attachments))
+            return None
+
         response_message = Message.objects.create(
             customer=customer,
             store=self.store,
@@ -24,22 +162,41 @@ class SignalMessenger:
         )
 
         try:
-            self.signal.send_message(recipient=customer.phone_number.as_e164,
-                                     text=text,
-                                     block=True,
-                                     attachments=attachments)
-            if incoming:
-                response = MobotResponse.objects.create(
-                    incoming=incoming,
-                    outgoing_response=response_message,
-                )
-                return response
+            with instrumentation.timed(instrumentation.SIGNALD):
+                self.signal.send_message(recipient=customer.phone_number.as_e164,
+                                         text=text,
+                                         block=True,
+                                         attachments=attachments)
         except Exception as e:
-            print(e)
+            self.logger.exception(f"Exception sending reply to {customer}")
+            response_message.status = MessageStatus.ERROR
+            response_message.save()
             raise e
+        if incoming:
+            response = MobotResponse.objects.create(
+                incoming=incoming,
+                outgoing_response=response_message,
+            )
+            return response
+
+    def log_and_send_messages(self, customer: Customer, replies: List[Tuple[str, list]], incoming: Optional[Message] = None):
+        """Send several replies to one customer in order, logging them together"""
+        if self._queues:
+            for text, attachments in replies:
+                self._enqueue(OutboundReply(customer=customer, text=text, incoming=incoming, attachments=attachments))
+            return
+        burst = [OutboundReply(customer=customer, text=text, incoming=incoming, attachments=attachments)
+                 for text, attachments in replies]
+        sent = [self._send(reply) for reply in burst]
+        self._log_burst(burst, sent)
+        if not all(sent):
+            # Logged as errors; let the handler know, as it would for a single reply
+            raise ReplyNotSentException(f"{sent.count(False)} of {len(burst)} replies to {customer} not sent")
 
     def log_and_send_message(self, text: str, attachments=[]):
         ctx = ChatContext.get_current_context()
+        if ctx.buffer_reply(self, text, attachments):
+            return
         incoming = ctx.message
         customer = ctx.message.customer
         self._log_and_send_message(customer, text, incoming, attachments)
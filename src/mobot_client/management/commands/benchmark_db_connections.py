@@ -0,0 +1,67 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+
+"""
+Benchmark per-message DB latency when reconnecting for every message versus reusing a connection
+"""
+import statistics
+from argparse import ArgumentParser
+from timeit import default_timer
+from typing import Callable, List
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from mobot_client.models import Customer, DropSession, Store
+from mobot_client.models.messages import Message
+
+
+class Command(BaseCommand):
+    help = 'Benchmark per-message DB latency with and without connection reuse'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            '-n',
+            '--messages',
+            type=int,
+            default=200,
+            help='Number of simulated messages per mode'
+        )
+
+    def _simulate_message(self):
+        """Roughly the queries a default-routed message makes before replying"""
+        store = Store.objects.first()
+        customer = Customer.objects.first()
+        if customer:
+            DropSession.objects.active_drop_sessions().filter(customer=customer).first()
+        if store:
+            Message.objects.filter(store=store).order_by('-date').first()
+
+    def _time(self, messages: int, release: Callable[[], None]) -> List[float]:
+        timings = []
+        connection.close()
+        for _ in range(messages):
+            start = default_timer()
+            self._simulate_message()
+            release()
+            timings.append((default_timer() - start) * 1000)
+        return timings
+
+    def _report(self, name: str, timings: List[float]):
+        ordered = sorted(timings)
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        self.stdout.write(
+            f"{name:<12} mean {statistics.mean(timings):8.2f}ms  "
+            f"p50 {statistics.median(timings):8.2f}ms  p99 {p99:8.2f}ms"
+        )
+
+    def handle(self, *args, **kwargs):
+        messages = kwargs['messages']
+
+        def reuse():
+            # What ChatContext does with CONN_MAX_AGE > 0, without depending on the configured value
+            if connection.errors_occurred and not connection.is_usable():
+                connection.close()
+
+        self.stdout.write(f"Simulating {messages} messages per mode against {connection.settings_dict['HOST']}")
+        self._report("reconnect", self._time(messages, connection.close))
+        self._report("reuse", self._time(messages, reuse))
@@ -0,0 +1,44 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+
+"""
+A command to split the store's balance into a pool of right-sized TXOs ahead of a drop
+"""
+import decimal
+from argparse import ArgumentParser
+
+import mc_util
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mobot_client.payments import TxoAllocator
+from mobot_client.payments.client import MCClient
+
+
+class Command(BaseCommand):
+    help = 'Split the wallet into TXOs for concurrent payouts'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            '-n',
+            '--count',
+            type=int,
+            default=settings.PAYOUT_TXO_POOL_SIZE or 100,
+            help='Number of TXOs to have available'
+        )
+        parser.add_argument(
+            '-m',
+            '--mob',
+            type=decimal.Decimal,
+            default=decimal.Decimal(settings.PAYOUT_TXO_VALUE_MOB),
+            help='Value of each TXO in MOB; should cover the largest single payout plus fee'
+        )
+
+    def handle(self, *args, **kwargs):
+        count = kwargs['count']
+        value_pmob = mc_util.mob2pmob(kwargs['mob'])
+        mcc = MCClient()
+        allocator = TxoAllocator(mcc, mcc.account_id)
+        created = allocator.split(count, value_pmob)
+        self.stdout.write(
+            f"Created {created} TXOs; {allocator.pool_size(value_pmob)} of {kwargs['mob']} MOB now available"
+        )
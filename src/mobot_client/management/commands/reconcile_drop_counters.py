@@ -0,0 +1,36 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+
+"""
+A command to recount drops' running totals from their sessions and bonus coins, and give bonus coins the claim
+slots they're missing
+"""
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand
+
+from mobot_client.models import BonusCoinSlot, Drop, DropCounters
+
+
+class Command(BaseCommand):
+    help = 'Recount drop counters from sessions and bonus coins, and backfill bonus coin slots'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            '-d',
+            '--drop',
+            type=int,
+            action='append',
+            help='ID of a drop to reconcile; may be repeated. Defaults to every drop'
+        )
+
+    def handle(self, *args, **kwargs):
+        drop_ids = kwargs['drop'] or Drop.objects.values_list('pk', flat=True)
+        for drop_id in drop_ids:
+            added = BonusCoinSlot.objects.backfill(drop_id)
+            if added:
+                self.stdout.write(f"Drop {drop_id}: added {added} bonus coin slots")
+            before = DropCounters.objects.totals(drop_id)
+            after = DropCounters.objects.reconcile(drop_id)
+            if before != after:
+                self.stdout.write(f"Drop {drop_id}: {before} -> {after}")
+        self.stdout.write(f"Reconciled {len(drop_ids)} drops")
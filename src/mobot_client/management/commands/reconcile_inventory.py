@@ -0,0 +1,16 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+
+"""
+A command to recount every Sku's remaining stock from its orders
+"""
+from django.core.management.base import BaseCommand
+
+from mobot_client.models import Sku
+
+
+class Command(BaseCommand):
+    help = 'Recount Sku inventory from orders'
+
+    def handle(self, *args, **kwargs):
+        fixed = Sku.objects.reconcile_inventory()
+        self.stdout.write(f"Corrected remaining stock for {fixed} Skus")
@@ -5,21 +5,27 @@ The entrypoint for the running MOBot.
 """
 import time
 from copy import deepcopy
+from decimal import Decimal
 from argparse import ArgumentParser
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from functools import partial
+from typing import Callable, List, Optional, Union
 from multiprocessing import Process
 
-from django.core.management.base import BaseCommand
+import mc_util
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import connections
 from signald import Signal
 
 from mobot_client.drop_runner import DropRunner
 from mobot_client.concurrency import AutoCleanupExecutor
-from mobot_client.payments import MCClient, Payments
+from mobot_client.payments import MCClient, Payments, PaymentVerifier, PayoutBatcher, TxoAllocator
 from signal_logger import SignalLogger
 
 from mobot_client.logger import SignalMessenger
 from mobot_client.models import ChatbotSettings, Store
+from mobot_client.timeouts import Timeouts, TimeoutScheduler
 
 
 class Command(BaseCommand):
@@ -40,7 +46,30 @@ class Command(BaseCommand):
             action='store_true',
             default=True
         )
-
+        parser.add_argument(
+            '--shard-count',
+            type=int,
+            default=1,
+            help='Split customers across this many subscriber processes, each claiming only its own customers'
+        )
+        parser.add_argument(
+            '--shard-index',
+            type=int,
+            default=None,
+            help='Run only this shard (0-based) in this process, e.g. one per replica. Runs all shards if not set.'
+        )
+        parser.add_argument(
+            '--asyncio',
+            action='store_true',
+            default=False,
+            help='Run the listener and subscribers on event loops rather than fixed thread pools'
+        )
+        parser.add_argument(
+            '--max-concurrency',
+            type=int,
+            default=1000,
+            help='With --asyncio, the maximum number of conversations in flight per process'
+        )
 
     def get_signal(self, cb_settings: ChatbotSettings, b64_public_address: str) -> Signal:
         store = cb_settings.store
@@ -57,14 +86,75 @@ class Command(BaseCommand):
         return signal
 
     def get_payments(self, store: Store, messenger: SignalMessenger, signal: Signal, mcc: MCClient) -> Payments:
+        allocator = None
+        if settings.PAYOUT_TXO_POOL_SIZE > 0:
+            allocator = TxoAllocator(mcc, mcc.account_id, max_value_pmob=2 * self.pool_txo_value_pmob())
+        batcher = None
+        if settings.PAYOUT_BATCH_WINDOW_SECONDS > 0:
+            # Batches are funded from the pool too, so they don't spend the TXOs the pool keeper is splitting
+            batcher = PayoutBatcher(mcc, mcc.account_id, allocator=allocator)
         return Payments(
             store=store,
             mobilecoin_client=mcc,
             signal=signal,
             messenger=messenger,
+            batcher=batcher,
+            allocator=allocator,
         )
 
+    @staticmethod
+    def pool_txo_value_pmob() -> int:
+        return mc_util.mob2pmob(Decimal(settings.PAYOUT_TXO_VALUE_MOB))
+
+    def get_timeouts(self, messenger: SignalMessenger, payments: Payments,
+                     shard_index: int, shard_count: int) -> Optional[TimeoutScheduler]:
+        if not settings.SESSION_TIMEOUTS_ENABLED:
+            return None
+        timeouts = Timeouts(messenger, payments,
+                            idle_timeout=settings.SESSION_IDLE_TIMEOUT_SECONDS,
+                            cancel_timeout=settings.SESSION_CANCEL_TIMEOUT_SECONDS)
+        return TimeoutScheduler(timeouts, shard_index=shard_index, shard_count=shard_count)
+
+    def _run_target(self, runner: Union[DropRunner, SignalLogger], use_asyncio: bool, max_concurrency: int) -> Callable:
+        if isinstance(runner, SignalLogger):
+            if use_asyncio:
+                return partial(runner.listen_with_asyncio, True, True, max_concurrency)
+            return partial(runner.listen, True, True)
+        if use_asyncio:
+            return partial(runner.run_chat_with_asyncio, max_concurrency=max_concurrency)
+        return runner.run_chat
+
+    def start_subscribers(self, pool: AutoCleanupExecutor, store: Store, messenger: SignalMessenger,
+                          payments: Payments, shard_count: int, shard_index: Optional[int],
+                          use_asyncio: bool = False, max_concurrency: int = 1000) -> List[Future]:
+        """Run a single subscriber in this process, or one process per shard if running all shards"""
+        if shard_index is not None or shard_count == 1:
+            if payments.allocator:
+                payments.allocator.set_partition(shard_index or 0, shard_count)
+            mobot = DropRunner(store=store, messenger=messenger, payments=payments,
+                               timeouts=self.get_timeouts(messenger, payments, shard_index or 0, shard_count),
+                               shard_index=shard_index or 0, shard_count=shard_count)
+            return [pool.submit(self._run_target(mobot, use_asyncio, max_concurrency))]
+        futures = []
+        # Don't share DB connections with forked shards
+        connections.close_all()
+        for index in range(shard_count):
+            if payments.allocator:
+                # Each forked shard gets a copy set to its own share of the wallet's TXOs
+                payments.allocator.set_partition(index, shard_count)
+            mobot = DropRunner(store=store, messenger=messenger, payments=payments,
+                               timeouts=self.get_timeouts(messenger, payments, index, shard_count),
+                               shard_index=index, shard_count=shard_count)
+            shard_task = Process(target=self._run_target(mobot, use_asyncio, max_concurrency))
+            shard_task.start()
+            futures.append(pool.submit(shard_task.join))
+        return futures
+
     def handle(self, *args, **kwargs):
+        if settings.MESSAGE_NOTIFIER == 'local':
+            # The listener always runs in a process of its own, so its notifications would never reach a subscriber
+            raise CommandError("MESSAGE_NOTIFIER 'local' only works within one process; use 'postgresql', "
+                               "or 'none' to poll every MESSAGE_POLL_INTERVAL_SECONDS")
         cb_settings = ChatbotSettings.load()
 
         while not cb_settings.store:
@@ -73,10 +163,12 @@ class Command(BaseCommand):
             cb_settings.refresh_from_db()
         listen = kwargs.get('listen')
         subscribe = kwargs.get('subscribe')
+        use_asyncio = kwargs.get('asyncio')
+        max_concurrency = kwargs.get('max_concurrency')
 
         mcc = MCClient()
         signal = self.get_signal(cb_settings, mcc.b64_public_address)
-        messenger = SignalMessenger(signal, cb_settings.store)
+        messenger = SignalMessenger(signal, cb_settings.store, sender_workers=settings.SIGNAL_SENDER_WORKERS)
         print("Got messenger!")
         payments = self.get_payments(
             store=cb_settings.store,
@@ -91,12 +183,26 @@ class Command(BaseCommand):
             logger = SignalLogger(signal=signal, payments=payments)
             with AutoCleanupExecutor(max_workers=8) as pool:
                 if listen:
-                    listen_task = Process(target=logger.listen, args=(True, True))
+                    listen_task = Process(target=self._run_target(logger, use_asyncio, max_concurrency))
                     listen_task.start()
                     futures.append(pool.submit(listen_task.join))
+                    verifier = PaymentVerifier(mcc)
+                    futures.append(pool.submit(verifier.run))
+                if subscribe and settings.PAYOUT_TXO_POOL_SIZE > 0:
+                    # Splits only from TXOs too big for the shards' allocators, and only in one replica at a time
+                    pool_keeper = TxoAllocator(mcc, mcc.account_id)
+                    futures.append(pool.submit(pool_keeper.run, settings.PAYOUT_TXO_POOL_SIZE,
+                                               self.pool_txo_value_pmob()))
                 if subscribe:
-                    mobot = DropRunner(store=cb_settings.store, messenger=messenger, payments=payments)
-                    futures.append(pool.submit(mobot.run_chat))
+                    futures.extend(self.start_subscribers(pool, cb_settings.store, messenger, payments,
+                                                          shard_count=kwargs.get('shard_count'),
+                                                          shard_index=kwargs.get('shard_index'),
+                                                          use_asyncio=use_asyncio,
+                                                          max_concurrency=max_concurrency))
+                if listen:
+                    # Only once shards have forked: the sweep runs in this process, so a forked copy of the
+                    # verifier would never resolve anything, and shards poll full-service themselves instead
+                    mcc.receipt_checker = verifier
 
 
             for fut in as_completed(futures):
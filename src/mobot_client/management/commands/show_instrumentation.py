@@ -0,0 +1,33 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+
+"""
+A command to show where the time goes per message, merged across every running shard
+"""
+from argparse import ArgumentParser
+
+from django.core.management.base import BaseCommand
+
+from mobot_client.instrumentation import Instrumentation
+
+
+class Command(BaseCommand):
+    help = 'Show per-message latency, DB queries and service time histograms published by running processes'
+
+    def add_arguments(self, parser: ArgumentParser):
+        parser.add_argument(
+            '--max-age',
+            type=float,
+            default=300,
+            help='Ignore processes that have not published in this many seconds'
+        )
+
+    def handle(self, *args, **kwargs):
+        rows = Instrumentation.summarize(Instrumentation.collect(max_age=kwargs['max_age']))
+        if not rows:
+            self.stdout.write("Nothing published yet; is INSTRUMENTATION_PUBLISH_SECONDS set?")
+            return
+        self.stdout.write(f"{'metric':<30} {'handler':<30} {'count':>8} {'mean':>9} {'p50':>9} {'p90':>9} "
+                          f"{'p99':>9} {'max':>9}")
+        for row in rows:
+            self.stdout.write(f"{row['metric']:<30} {row['label']:<30} {row['count']:>8} {row['mean']:>9.4f} "
+                              f"{row['p50']:>9.4f} {row['p90']:>9.4f} {row['p99']:>9.4f} {row['max']:>9.4f}")
@@ -1,23 +1,28 @@
 #  Copyright (c) 2021 MobileCoin. All rights reserved.
 
 from __future__ import annotations
+import copy
 import random
+import threading
+import time
 
 from decimal import Decimal
-from typing import Optional, Union
+from typing import List, Optional, Union
 import logging
 
+import attr
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
 from django.db.models import F, Sum
+from django.db.models.functions import Coalesce, Greatest
 from django.utils import timezone
-from django.utils.functional import cached_property
 from django.db import transaction
 
 from django.contrib import admin
 from phonenumber_field.modelfields import PhoneNumberField
-from tenacity import wait_random_exponential, retry, retry_if_exception_type
 
-from mobot_client.models.exceptions import ConcurrentModificationException
 from mobot_client.models.states import SessionState
 
 
@@ -57,20 +62,33 @@ class Item(models.Model):
 
 class AvailableSkuManager(models.Manager):
     def get_queryset(self) -> models.QuerySet:
-        return super().get_queryset() \
-            .annotate(number_ordered=models.Count('orders'),
-                      available=F('quantity') - models.Count('orders')) \
-            .filter(available__gt=0)
+        return super().get_queryset().filter(remaining__gt=0)
+
+
+class SkuManager(models.Manager):
+    def reconcile_inventory(self) -> int:
+        """Recount every Sku's remaining stock from its orders.
+
+            :return: Number of Skus whose count was off
+        """
+        active_orders = Order.active_orders.filter(sku=models.OuterRef('pk')).order_by() \
+            .values('sku').annotate(count=models.Count('pk')).values('count')
+        counted = Greatest(F('quantity') - Coalesce(models.Subquery(active_orders), 0), 0)
+        with transaction.atomic():
+            off = self.select_for_update().annotate(counted=counted).exclude(remaining=F('counted'))
+            return self.filter(pk__in=list(off.values_list('pk', flat=True))).update(remaining=counted)
 
 
 class Sku(models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name="skus")
     identifier = models.CharField(max_length=255)
     quantity = models.PositiveIntegerField(default=0)
+    remaining = models.PositiveIntegerField(default=0, editable=False,
+                                            help_text="Stock not yet ordered; kept by order() and Order.cancel()")
     sort_order = models.PositiveIntegerField(default=0)
 
     available = AvailableSkuManager()
-    objects = models.Manager()
+    objects = SkuManager()
 
     class Meta:
         unique_together = ('item', 'identifier')
@@ -80,25 +98,46 @@ class Sku(models.Model):
     def __str__(self) -> str:
         return f"{self.item.name} - {self.identifier}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_quantity = instance.__dict__.get('quantity')
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.remaining = self.quantity
+            super().save(*args, **kwargs)
+        else:
+            # remaining moves with orders, so don't overwrite it with what we loaded; shift it by the restock instead
+            if kwargs.get('update_fields') is None:
+                kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                           if not field.primary_key and field.name != 'remaining']
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                restocked = self.quantity - getattr(self, '_saved_quantity', self.quantity)
+                if restocked:
+                    Sku.objects.filter(pk=self.pk).update(remaining=Greatest(F('remaining') + restocked, 0))
+        self._saved_quantity = self.quantity
+
     def number_ordered(self) -> int:
-        return self.orders.count()
+        return self.quantity - self.number_available()
 
     def number_available(self) -> int:
-        return self.quantity - self.number_ordered()
+        return Sku.objects.filter(pk=self.pk).values_list('remaining', flat=True).first() or 0
 
     def in_stock(self) -> bool:
         return self.number_available() > 0
 
-    @transaction.atomic()
     def order(self, drop_session: DropSession) -> Order:
-        # Need to check whether this is in-stock again, just in case!
-        if self.in_stock():
+        """Take one off the remaining stock and order it, or raise OutOfStockException if there's none left"""
+        with transaction.atomic():
+            if not Sku.objects.filter(pk=self.pk, remaining__gt=0).update(remaining=F('remaining') - 1):
+                raise OutOfStockException(f"Unable to complete order; Item {self.identifier} out of stock!")
             return Order.objects.create(customer=drop_session.customer,
                                         drop_session=drop_session,
                                         sku=self,
                                         conversion_rate_mob_to_currency=drop_session.drop.conversion_rate_mob_to_currency)
-        else:
-            raise OutOfStockException(f"Unable to complete order; Item {self.identifier} out of stock!")
 
 
 class DropType(models.IntegerChoices):
@@ -113,7 +152,7 @@ class DropQuerySet(models.QuerySet):
     def advertising_drops(self) -> models.QuerySet:
         return self.filter(
             advertisment_start_time__lte=timezone.now(),
-            end_time__lte=timezone.now()
+            start_time__gt=timezone.now()
         )
 
     def active_drops(self) -> models.QuerySet:
@@ -129,14 +168,14 @@ class DropManager(models.Manager.from_queryset(DropQuerySet)):
     def advertising_drops(self) -> DropQuerySet:
         return self.get_queryset().advertising_drops()
 
-    def get_advertising_drop(self):
-        return self.advertising_drops().first()
+    def get_advertising_drop(self) -> Optional[Drop]:
+        return drop_schedule.advertising_drop()
 
     def active_drops(self) -> DropQuerySet:
         return self.get_queryset().active_drops()
 
     def get_active_drop(self) -> Optional[Drop]:
-        return self.active_drops().first()
+        return drop_schedule.active_drop()
 
 
 class Drop(models.Model):
@@ -171,49 +210,46 @@ class Drop(models.Model):
     def value_in_currency(self, amount: Decimal) -> Decimal:
         return amount * Decimal(self.conversion_rate_mob_to_currency)
 
-    @cached_property
+    def counts(self) -> DropCounts:
+        """Running totals for the drop, kept by DropCounters"""
+        return DropCounters.objects.totals(self.pk)
+
+    @property
     def initial_coin_limit(self) -> int:
-        if bonus_coins := self.bonus_coins.aggregate(Sum('number_available_at_start'))['number_available_at_start__sum']:
-            return bonus_coins
-        else:
-            return 0
+        return self.counts().initial_coin_limit
 
     @admin.display(description='Initial Payments')
     def num_initial_sent(self) -> int:
-        return DropSession.objects.initial_coin_sent_sessions().filter(drop=self).count()
+        return self.counts().initial_sent
 
     @admin.display(description='Bonus Payments')
     def num_bonus_sent(self) -> int:
-        return BonusCoin.objects.filter(drop=self).aggregate(Sum('number_claimed'))[
-            'number_claimed__sum']
+        return self.counts().bonus_sent
 
     def bonus_mob_disbursed(self) -> Decimal:
-        if self.bonus_coins.count():
-            return BonusCoin.objects.with_sum_spent().filter(drop=self).aggregate(Sum('mob_claimed'))[
-                'mob_claimed__sum']
-        else:
-            return Decimal(0)
+        return self.counts().bonus_mob_disbursed
 
     def initial_mob_disbursed(self) -> Decimal:
         return Decimal(self.num_initial_sent() * self.initial_coin_amount_mob)
 
     def initial_coins_available(self) -> Union[int, str]:
         if self.drop_type == DropType.AIRDROP:
-            return self.initial_coin_limit - self.num_initial_sent()
+            return self.counts().initial_coins_available
         else:
             return "N/A"
 
     def under_quota(self) -> bool:
         if self.drop_type == DropType.AIRDROP:
             DropManager.logger.info("Checking if there are coins available to give out...")
-            active_drop_sessions_count = DropSession.objects.initial_coin_sent_sessions().filter(drop=self).count()
-            bonus_available = self.num_bonus_sent() < self.initial_coins_available()
+            counts = self.counts()
             logger.debug(
-                f"There are {active_drop_sessions_count} sessions on this airdrop with an initial limit of {self.initial_coin_limit}"
+                f"There are {counts.initial_sent} sessions on this airdrop with an initial limit of {counts.initial_coin_limit}"
             )
-            return active_drop_sessions_count < self.initial_coin_limit and self.initial_coins_available() > 0 and bonus_available
+            return counts.initial_sent < counts.initial_coin_limit \
+                and counts.initial_coins_available > 0 \
+                and counts.bonus_sent < counts.initial_coins_available
         else:
-            return len(self.item.skus) > 0
+            return self.item.skus.filter(remaining__gt=0).exists()
 
     def is_active(self) -> bool:
         if self.start_time and self.end_time:
@@ -225,6 +261,83 @@ class Drop(models.Model):
         return f"{self.store.name}-{self.name}"
 
 
+class DropSchedule:
+    """
+    A process-local copy of every drop that hasn't ended yet, so finding the active or advertising drop for a
+    message doesn't take a query. Reloaded whenever a drop is saved or deleted in this process, and at least every
+    refresh_interval seconds to pick up changes made by other processes, like the admin.
+    """
+
+    def __init__(self, refresh_interval: Optional[float] = None):
+        self.refresh_interval = refresh_interval if refresh_interval is not None \
+            else settings.DROP_SCHEDULE_REFRESH_SECONDS
+        self._lock = threading.Lock()
+        self._drops: Optional[List[Drop]] = None
+        self._loaded_at = 0.0
+
+    def invalidate(self, **kwargs):
+        with self._lock:
+            self._drops = None
+
+    def _current(self) -> List[Drop]:
+        with self._lock:
+            if self._drops is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+                self._drops = list(Drop.objects.filter(end_time__gte=timezone.now())
+                                   .select_related('store', 'item').order_by('pk'))
+                self._loaded_at = time.monotonic()
+            return self._drops
+
+    def active_drop(self) -> Optional[Drop]:
+        """The first drop running now"""
+        now = timezone.now()
+        for drop in self._current():
+            if drop.start_time <= now <= drop.end_time:
+                # Callers get their own copy, so nothing they cache on it leaks into the schedule
+                return copy.copy(drop)
+        return None
+
+    def advertising_drop(self) -> Optional[Drop]:
+        """The first drop being advertised now, ahead of its start"""
+        now = timezone.now()
+        for drop in self._current():
+            if drop.advertisment_start_time <= now < drop.start_time:
+                return copy.copy(drop)
+        return None
+
+
+drop_schedule = DropSchedule()
+
+
+@receiver([post_save, post_delete], sender=Drop)
+def _drop_changed(**kwargs):
+    # Now, so the rest of this transaction sees the change, and again once it commits, in case another thread
+    # reloaded from before the commit in between
+    drop_schedule.invalidate()
+    transaction.on_commit(drop_schedule.invalidate)
+
+
+# The DB was flushed, as between tests
+post_migrate.connect(drop_schedule.invalidate)
+
+
+@receiver(post_migrate)
+def _backfill_bonus_coin_slots(sender, **kwargs):
+    """Migrations are generated at build time, so coins from before slots existed get theirs here"""
+    if sender.name == 'mobot_client':
+        added = BonusCoinSlot.objects.backfill()
+        if added:
+            logger.info(f"Added {added} bonus coin slots")
+
+
+@receiver(post_migrate)
+def _backfill_sku_remaining(sender, **kwargs):
+    """Skus from before remaining was kept would otherwise read as sold out, so count their stock here"""
+    if sender.name == 'mobot_client':
+        fixed = Sku.objects.reconcile_inventory()
+        if fixed:
+            logger.info(f"Recounted remaining stock for {fixed} Skus")
+
+
 class BonusCoinQuerySet(models.QuerySet):
     def with_sum_spent(self) -> models.QuerySet:
         return self.annotate(mob_claimed=F('number_claimed') * F('amount_mob')).all()
@@ -235,60 +348,20 @@ class BonusCoinQuerySet(models.QuerySet):
 
 
 class BonusCoinManager(models.Manager.from_queryset(BonusCoinQuerySet)):
-    def _claim_optimistic(self, coin: BonusCoin, number_claimed: int):
-        """Try to claim a coin using optimistic locking - assume we know the number claimed is the same as it was when we
-           entered the transaction, and fail if the update fails
-        """
-        with transaction.atomic():
-            updated = self.available_coins().filter(pk=coin.pk, number_claimed=number_claimed).select_for_update().update(number_claimed=number_claimed + 1)
-            if not updated:
-                raise ConcurrentModificationException()
-        coin.refresh_from_db()
-        return coin
-
-    @retry(wait=wait_random_exponential(multiplier=1, min=4, max=10), retry=retry_if_exception_type(ConcurrentModificationException))
     def find_and_claim_unclaimed_coin(self, drop: Drop) -> BonusCoin:
-        coins_available = self.available_coins().filter(drop=drop)
-        coins_dist = [coin.number_remaining() for coin in coins_available]
-        if len(coins_available) > 0:
-            coin: BonusCoin = random.choices(coins_available, weights=coins_dist)[0]
-            if coin.number_remaining() < 1:
-                raise ConcurrentModificationException("Coin no longer available; looking for another")
-            logger.debug(f"Trying to claim a coin {coin} with number claimed {coin.number_claimed}")
-            claimed_coin = self._claim_optimistic(coin, coin.number_claimed)
-            logger.info(f"Got a coin! {claimed_coin}")
-            claimed_coin.save()
-            return claimed_coin
-        else:
-            raise OutOfStockException("No more bonus coins available to give out!")
-
-    def _claim_optimistic(self, coin: BonusCoin, number_claimed: int):
-        """Try to claim a coin using optimistic locking - assume we know the number claimed is the same as it was when we
-           entered the transaction, and fail if the update fails
+        """Claim the next unit from the drop's shuffled coin slots. Units from all of the drop's coins are shuffled
+           together, so each claim picks a coin with probability proportional to its number remaining.
         """
         with transaction.atomic():
-            updated = self.available_coins().filter(pk=coin.pk, number_claimed=number_claimed).select_for_update().update(number_claimed=number_claimed + 1)
-            if not updated:
-                raise ConcurrentModificationException()
-        coin.refresh_from_db()
+            coin_id = BonusCoinSlot.objects.claim_next(drop)
+            if coin_id is None:
+                raise OutOfStockException("No more bonus coins available to give out!")
+            self.filter(pk=coin_id).update(number_claimed=F('number_claimed') + 1)
+            coin = self.get(pk=coin_id)
+            DropCounters.objects.add(drop.pk, bonus_sent=1, bonus_mob_disbursed=coin.amount_mob)
+        logger.info(f"Got a coin! {coin}")
         return coin
 
-    @retry(wait=wait_random_exponential(multiplier=1, min=4, max=10), retry=retry_if_exception_type(ConcurrentModificationException))
-    def find_and_claim_unclaimed_coin(self, drop: Drop) -> BonusCoin:
-        coins_available = self.available_coins().filter(drop=drop)
-        coins_dist = [coin.number_remaining() for coin in coins_available]
-        if len(coins_available) > 0:
-            coin: BonusCoin = random.choices(coins_available, weights=coins_dist)[0]
-            if coin.number_remaining() < 1:
-                raise ConcurrentModificationException("Coin no longer available; looking for another")
-            logger.debug(f"Trying to claim a coin {coin} with number claimed {coin.number_claimed}")
-            claimed_coin = self._claim_optimistic(coin, coin.number_claimed)
-            logger.info(f"Got a coin! {claimed_coin}")
-            claimed_coin.save()
-            return claimed_coin
-        else:
-            raise OutOfStockException("No more bonus coins available to give out!")
-
     def claim_random_coin_for_session(self, drop_session: DropSession):
         try:
             coin = self.find_and_claim_unclaimed_coin(drop_session.drop)
@@ -320,9 +393,77 @@ class BonusCoin(models.Model):
         return self.number_claimed * self.amount_mob
 
 
+class BonusCoinSlotManager(models.Manager):
+    def sync(self, coin: BonusCoin) -> int:
+        """Give the coin one unclaimed slot per unit remaining, each at a random place in the drop's order
+
+            :return: The number of slots added, or removed if negative
+        """
+        with transaction.atomic():
+            unclaimed = self.filter(coin=coin, claimed=False)
+            missing = coin.number_remaining() - unclaimed.count()
+            if missing > 0:
+                self.bulk_create([
+                    BonusCoinSlot(drop_id=coin.drop_id, coin=coin, position=random.getrandbits(62))
+                    for _ in range(missing)
+                ])
+            elif missing < 0:
+                self.filter(pk__in=list(unclaimed.values_list('pk', flat=True)[:-missing])).delete()
+        return missing
+
+    def backfill(self, drop_id: Optional[int] = None) -> int:
+        """Sync the slots of every coin with units left, e.g. coins created before there were slots
+
+            :param drop_id: Only this drop's coins
+            :return: The number of slots added
+        """
+        coins = BonusCoin.objects.available_coins()
+        if drop_id is not None:
+            coins = coins.filter(drop_id=drop_id)
+        return sum(max(self.sync(coin), 0) for coin in coins)
+
+    def claim_next(self, drop: Drop) -> Optional[int]:
+        """Claim the first unclaimed slot that nobody else is claiming, in the caller's transaction.
+
+            :return: The claimed slot's coin ID, or None once the drop's slots are all claimed
+        """
+        while True:
+            slot = self.filter(drop=drop, claimed=False).order_by('position') \
+                .select_for_update(skip_locked=True).only('coin').first()
+            if slot is None:
+                return None
+            # Without row locks (SQLite) two claimers can find the same slot; the loser moves on to the next
+            if self.filter(pk=slot.pk, claimed=False).update(claimed=True):
+                return slot.coin_id
+
+
+class BonusCoinSlot(models.Model):
+    """
+    One claimable unit of a bonus coin. A drop's slots are handed out in order of a random position, so claimers
+    skip past each other's locked slots instead of racing to update the same few coins.
+    """
+    drop = models.ForeignKey(Drop, on_delete=models.CASCADE, related_name='bonus_coin_slots')
+    coin = models.ForeignKey(BonusCoin, on_delete=models.CASCADE, related_name='slots')
+    position = models.BigIntegerField()
+    claimed = models.BooleanField(default=False)
+
+    objects = BonusCoinSlotManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['drop', 'claimed', 'position'])]
+
+    def __str__(self):
+        return f"{self.coin} [{self.position}]"
+
+
 class Customer(models.Model):
     phone_number = PhoneNumberField(db_index=True, unique=True)
     received_sticker_pack = models.BooleanField(default=False)
+    payments_address = models.CharField(max_length=255, null=True, blank=True,
+                                        help_text="MobileCoin address from the customer's signal profile, if cached")
+    payments_address_updated = models.DateTimeField(null=True, blank=True, db_index=True,
+                                                    help_text="When payments_address was fetched from signal, "
+                                                              "or last invalidated")
 
     def matches_country_code_restriction(self, drop: Drop) -> bool:
         if not drop.number_restriction.strip():
@@ -469,6 +610,21 @@ class DropSession(models.Model):
     class Meta:
         ordering = ('-state', '-updated')
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_state = instance.__dict__.get('state')
+        return instance
+
+    def save(self, *args, **kwargs):
+        saved_state = getattr(self, '_saved_state', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            delta = DropCounters.initial_sent_delta(saved_state, self.state)
+            if delta:
+                DropCounters.objects.add(self.drop_id, initial_sent=delta)
+        self._saved_state = self.state
+
     def is_active(self) -> bool:
         return self.state < SessionState.COMPLETED and (self.drop.start_time < timezone.now() < self.drop.end_time)
 
@@ -476,6 +632,140 @@ class DropSession(models.Model):
         return f"{self.drop.name}"
 
 
+@attr.s(frozen=True)
+class DropCounts:
+    initial_sent = attr.ib(type=int, default=0)
+    bonus_sent = attr.ib(type=int, default=0)
+    bonus_mob_disbursed = attr.ib(type=Decimal, default=Decimal(0))
+    initial_coin_limit = attr.ib(type=int, default=0)
+
+    @property
+    def initial_coins_available(self) -> int:
+        return self.initial_coin_limit - self.initial_sent
+
+
+class DropCountersManager(models.Manager):
+    def _ensure_slots(self, drop_id: int):
+        """Create any of the drop's slot rows that are missing, as zeros"""
+        self.bulk_create([DropCounters(drop_id=drop_id, slot=slot) for slot in range(DropCounters.SLOTS)],
+                         ignore_conflicts=True)
+
+    def add(self, drop_id: int, **deltas):
+        """Add deltas to the drop's running totals, in the caller's transaction. Updates go to a random slot, so
+           concurrent sessions rarely wait on each other's row locks.
+        """
+        slot = random.randrange(DropCounters.SLOTS)
+        increments = {field: F(field) + delta for field, delta in deltas.items()}
+        if self.filter(drop_id=drop_id, slot=slot).update(**increments):
+            return
+        if self.filter(drop_id=drop_id).exists():
+            # Just this slot's missing; the others hold the totals, so it can start from zero
+            self._ensure_slots(drop_id)
+            self.filter(drop_id=drop_id, slot=slot).update(**increments)
+        else:
+            # Never counted, or the drop's being deleted. Either way the first read recounts from the sessions and
+            # coins, which already include this change.
+            logger.debug(f"No counters for drop {drop_id}; leaving them to be reconciled")
+
+    def totals(self, drop_id: int) -> DropCounts:
+        totals = self.filter(drop_id=drop_id).aggregate(
+            slots=models.Count('slot'),
+            initial_sent=Sum('initial_sent'),
+            bonus_sent=Sum('bonus_sent'),
+            bonus_mob_disbursed=Sum('bonus_mob_disbursed'),
+            initial_coin_limit=Sum('initial_coin_limit'),
+        )
+        if not totals.pop('slots'):
+            return self.reconcile(drop_id)
+        return DropCounts(**totals)
+
+    def reconcile(self, drop_id: int) -> DropCounts:
+        """Recount a drop's totals from its sessions and bonus coins, into slot 0, zeroing the other slots.
+
+           Rows are updated in place rather than replaced, so anyone waiting to add to them adds to the new totals.
+        """
+        with transaction.atomic():
+            if not Drop.objects.filter(pk=drop_id).exists():
+                return DropCounts()
+            self._ensure_slots(drop_id)
+            # Wait out anyone adding to the current counters, so our counts include their changes
+            list(self.select_for_update().filter(drop_id=drop_id).order_by('slot'))
+            coins = BonusCoin.objects.filter(drop_id=drop_id).aggregate(
+                bonus_sent=Sum('number_claimed'),
+                bonus_mob_disbursed=Sum(F('number_claimed') * F('amount_mob')),
+                initial_coin_limit=Sum('number_available_at_start'),
+            )
+            counts = DropCounts(
+                initial_sent=DropSession.objects.filter(drop_id=drop_id, state__gt=SessionState.READY).count(),
+                **{field: value for field, value in coins.items() if value is not None},
+            )
+            self.filter(drop_id=drop_id, slot=0).update(**attr.asdict(counts))
+            self.filter(drop_id=drop_id, slot__gt=0).update(**attr.asdict(DropCounts()))
+        return counts
+
+
+class DropCounters(models.Model):
+    """
+    Running totals for a drop, kept up to date as sessions change state and bonus coins are claimed, so quota
+    checks and stats don't aggregate over every session. Spread over SLOTS rows per drop to keep lock contention
+    down; a drop's totals are the sums over its rows. Run reconcile_drop_counters after editing sessions or coins
+    in bulk.
+    """
+    SLOTS = 8
+
+    drop = models.ForeignKey(Drop, on_delete=models.CASCADE, related_name='counters')
+    slot = models.PositiveSmallIntegerField(default=0)
+    initial_sent = models.IntegerField(default=0)
+    bonus_sent = models.IntegerField(default=0)
+    bonus_mob_disbursed = models.DecimalField(decimal_places=8, max_digits=20, default=Decimal(0))
+    initial_coin_limit = models.IntegerField(default=0)
+
+    objects = DropCountersManager()
+
+    class Meta:
+        unique_together = ('drop', 'slot')
+        verbose_name_plural = 'drop counters'
+
+    @staticmethod
+    def initial_sent_delta(old_state: Optional[int], new_state: int) -> int:
+        """How a session moving from old_state to new_state changes the count of initial coins sent"""
+        was_sent = old_state is not None and old_state > SessionState.READY
+        is_sent = new_state > SessionState.READY
+        return int(is_sent) - int(was_sent)
+
+    def __str__(self):
+        return f"{self.drop} [{self.slot}]"
+
+
+@receiver(post_save, sender=Drop)
+def _drop_created(instance: Drop, created: bool, raw: bool = False, **kwargs):
+    if created and not raw:
+        DropCounters.objects.reconcile(instance.pk)
+
+
+@receiver(post_save, sender=BonusCoin)
+def _bonus_coin_saved(instance: BonusCoin, raw: bool = False, **kwargs):
+    # Coins are set up in the admin rather than claimed through save(), so this is rare
+    if not raw:
+        BonusCoinSlot.objects.sync(instance)
+        DropCounters.objects.reconcile(instance.drop_id)
+
+
+@receiver(post_delete, sender=BonusCoin)
+def _bonus_coin_deleted(instance: BonusCoin, **kwargs):
+    DropCounters.objects.add(instance.drop_id,
+                             bonus_sent=-instance.number_claimed,
+                             bonus_mob_disbursed=-instance.amount_disbursed(),
+                             initial_coin_limit=-instance.number_available_at_start)
+
+
+@receiver(post_delete, sender=DropSession)
+def _drop_session_deleted(instance: DropSession, **kwargs):
+    delta = DropCounters.initial_sent_delta(instance.state, SessionState.READY)
+    if delta:
+        DropCounters.objects.add(instance.drop_id, initial_sent=delta)
+
+
 class OrderStatus(models.IntegerChoices):
     STARTED = 0, 'started'
     CONFIRMED = 1, 'confirmed'
@@ -512,8 +802,17 @@ class Order(models.Model):
     objects = models.Manager()
 
     def cancel(self):
+        """Cancel the order and put its Sku back in stock, once however many times it's called"""
+        with transaction.atomic():
+            if Order.objects.filter(pk=self.pk).exclude(status=OrderStatus.CANCELLED).update(status=OrderStatus.CANCELLED):
+                Sku.objects.filter(pk=self.sku_id).update(remaining=F('remaining') + 1)
         self.status = OrderStatus.CANCELLED
-        self.save()
+
+
+@receiver(post_delete, sender=Order)
+def _order_deleted(instance: Order, **kwargs):
+    if instance.status != OrderStatus.CANCELLED:
+        Sku.objects.filter(pk=instance.sku_id).update(remaining=F('remaining') + 1)
 
 
 # ------------------------------------------------------------------------------------------
@@ -543,3 +842,14 @@ class ChatbotSettings(SingletonModel):
 
     def __str__(self):
         return "Global settings"
+
+
+class MetricsSnapshot(models.Model):
+    """The latest metrics published by one running process, so the admin and management commands can see them"""
+    process = models.CharField(max_length=255, unique=True, help_text="host:pid of the publishing process")
+    updated = models.DateTimeField(auto_now=True)
+    metrics = models.JSONField(default=dict)
+    gauges = models.JSONField(default=dict)
+
+    def __str__(self):
+        return f"{self.process} at {self.updated}"
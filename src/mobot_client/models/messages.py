@@ -2,21 +2,21 @@
 from __future__ import annotations
 import attr
 import json
-from typing import Optional, Callable
-from datetime import datetime
+from typing import Optional, Callable, List
+from datetime import datetime, timedelta
 
 import mc_util
+from django.conf import settings
 from django.db import models
-from django.db import transaction
+from django.db import transaction, connections
 from django.utils import timezone
 from django.db.models import IntegerChoices
 from phonenumber_field.modelfields import PhoneNumberField
 from signald.types import Message as SignalMessage
-from tenacity import wait_random_exponential, retry, retry_if_exception_type
 from cached_property import threaded_cached_property_with_ttl
 
 
-from mobot_client.models import Customer, Store, ConcurrentModificationException
+from mobot_client.models import Customer, Store
 
 
 class PaymentStatus(models.TextChoices):
@@ -101,6 +101,8 @@ class MessageStatus(models.IntegerChoices):
     NOT_PROCESSED = 0
     PROCESSING = 1
     PROCESSED = 2
+    # Stored, but waiting on the payment verifier to confirm its payment before it can be processed
+    PAYMENT_PENDING = 3
 
 
 class MessageQuerySet(models.QuerySet):
@@ -109,28 +111,92 @@ class MessageQuerySet(models.QuerySet):
         return self.filter(status=MessageStatus.NOT_PROCESSED,
                            direction=Direction.RECEIVED).distinct('customer_id').order_by('customer_id')
 
-    @retry(wait=wait_random_exponential(multiplier=1, min=4, max=10), retry=retry_if_exception_type(ConcurrentModificationException))
-    def claim_message(self, message: Message) -> Message:
-        """Ask for a message at the current status, and update to processing if found. Retry/fail a few times if not possible.
+    def claim_message(self, message: Message) -> Optional[Message]:
+        """Ask for a message at the current status, and update to processing if found. Rows locked by another worker
+            are skipped rather than waited on, so this never blocks or retries.
 
             :param: The message to declare as currently being worked on.
-            :return: Message claimed
+            :return: Message claimed, or None if another worker has it
         """
-        updated = self.filter(pk=message.pk, status=MessageStatus.NOT_PROCESSED).select_for_update().update(status=MessageStatus.PROCESSING)
-        if not updated:
-            raise ConcurrentModificationException("Got a message currently being processed")
+        with transaction.atomic(using=self.db):
+            locked = self.select_for_update(skip_locked=True).filter(pk=message.pk, status=MessageStatus.NOT_PROCESSED)
+            if locked.first() is None:
+                return None
+            self.filter(pk=message.pk).update(status=MessageStatus.PROCESSING, processing=timezone.now())
         message.refresh_from_db()
         return message
 
-    @transaction.atomic()
-    def get_message(self, store: Store) -> Message:
+    def claim_batch(self, store: Store, n: int, shard_index: int = 0, shard_count: int = 1) -> List[Message]:
+        """Atomically claim up to n messages for the store, at most one per customer, in a single statement.
+
+            Picks each customer's oldest unprocessed message, skipping rows locked by other workers and customers
+            who still have a message in flight or an earlier payment awaiting verification, and marks them as
+            processing. With shard_count > 1, only customers where customer_id % shard_count == shard_index are
+            considered, so each customer is always handled by the same worker.
+
+            :param: store: The store to claim messages for
+            :param: n: Maximum number of messages to claim
+            :param: shard_index: The shard of customers to claim from
+            :param: shard_count: The total number of shards
+            :return: Claimed messages, oldest first
+        """
+        if n < 1:
+            return []
+        if not 0 <= shard_index < shard_count:
+            raise ValueError(f"Shard index {shard_index} out of range for {shard_count} shards")
+        fields = self.model._meta.concrete_fields
+        table = self.model._meta.db_table
+        columns = ", ".join(f'"{field.column}"' for field in fields)
+        sql = f"""
+            WITH candidates AS (
+                SELECT m.id FROM {table} m
+                WHERE m.store_id = %s AND m.status = %s AND m.direction = %s
+                AND NOT EXISTS (
+                    SELECT 1 FROM {table} earlier
+                    WHERE earlier.customer_id = m.customer_id
+                    AND earlier.store_id = m.store_id
+                    AND earlier.status IN (%s, %s) AND earlier.direction = %s
+                    AND (earlier.date, earlier.id) < (m.date, m.id)
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM {table} in_flight
+                    WHERE in_flight.customer_id = m.customer_id
+                    AND in_flight.store_id = m.store_id
+                    AND in_flight.status = %s AND in_flight.processing > %s
+                )
+                AND m.customer_id %% %s = %s
+                ORDER BY m.date, m.id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE {table} SET status = %s, processing = %s, updated = %s
+            WHERE id IN (SELECT id FROM candidates) AND status = %s
+            RETURNING {columns}
+        """
+        now = timezone.now()
+        params = [
+            store.pk, MessageStatus.NOT_PROCESSED, Direction.RECEIVED,
+            MessageStatus.NOT_PROCESSED, MessageStatus.PAYMENT_PENDING, Direction.RECEIVED,
+            MessageStatus.PROCESSING, now - timedelta(seconds=settings.MESSAGE_PROCESSING_TIMEOUT_SECONDS),
+            shard_count, shard_index,
+            n,
+            MessageStatus.PROCESSING, now, now,
+            MessageStatus.NOT_PROCESSED,
+        ]
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        field_names = [field.attname for field in fields]
+        messages = [self.model.from_db(self.db, field_names, row) for row in rows]
+        return sorted(messages, key=lambda message: (message.date, message.pk))
+
+    def get_message(self, store: Store) -> Optional[Message]:
         """Get next available message for the current MOBot store.
 
-        :return: The next available message to handle
-        :raises: ConcurrentModificationException
+        :return: The next available message to handle, or None if there's nothing unclaimed
         """
-        if message := self.not_processing().filter(store=store).first():
-            return self.claim_message(message)
+        if claimed := self.claim_batch(store, 1):
+            return claimed[0]
 
 
 class MessageManager(models.Manager.from_queryset(MessageQuerySet)):
@@ -4,6 +4,8 @@ from django.db import models
 
 
 class SessionState(models.IntegerChoices):
+    # Timed out and being refunded; if one stays here, the refund may or may not have gone out
+    REFUNDING = -5
     IDLE_AND_REFUNDABLE = -4
     IDLE = -3
     REFUNDED = -2
@@ -34,7 +36,6 @@ class SessionState(models.IntegerChoices):
         }
     
     @staticmethod
-    @property
     def refundable_states():
         return {
             SessionState.IDLE_AND_REFUNDABLE,
@@ -46,6 +47,5 @@ class SessionState(models.IntegerChoices):
         }
 
     @staticmethod
-    @property
-    def error_states(self):
+    def error_states():
         return {SessionState.OUT_OF_STOCK}
@@ -1,3 +1,6 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 
 from .payments import *
+from .verifier import PaymentVerifier
+from .batcher import PayoutBatcher
+from .allocator import TxoAllocator
@@ -0,0 +1,143 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from mobot_client.models import Customer
+
+
+class PaymentsAddressCache:
+    """
+    Customers' MobileCoin addresses, keyed by phone number, so paying someone doesn't need a signald profile round
+    trip every time.
+
+    Lookups go to a size-bounded, TTL'd in-memory LRU first, then to the address persisted on the Customer (which
+    other processes share), and only then to signald. Invalidating an address clears it on the Customer and stamps
+    payments_address_updated, and every process checks for Customers stamped since it last looked at most every
+    sync_interval seconds, dropping any in-memory address that no longer matches.
+    """
+    # Allowance for clocks differing between the processes stamping Customers
+    SYNC_SLACK = timedelta(seconds=5)
+
+    def __init__(self, ttl: Optional[float] = None, max_size: Optional[int] = None, persist_ttl: Optional[float] = None,
+                 sync_interval: Optional[float] = None):
+        self.ttl = ttl if ttl is not None else settings.PAYMENTS_ADDRESS_CACHE_TTL_SECONDS
+        self.max_size = max_size if max_size is not None else settings.PAYMENTS_ADDRESS_CACHE_SIZE
+        self.persist_ttl = persist_ttl if persist_ttl is not None else settings.PAYMENTS_ADDRESS_PERSIST_TTL_SECONDS
+        self.sync_interval = sync_interval if sync_interval is not None \
+            else settings.PAYMENTS_ADDRESS_SYNC_SECONDS
+        self.logger = logging.getLogger("PaymentsAddressCache")
+        self._lock = threading.Lock()
+        self._addresses: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._synced_at: Optional[datetime] = None
+        self._next_sync = 0.0
+        self.hits = 0
+        self.persisted_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_local(self, number: str) -> Optional[str]:
+        with self._lock:
+            if entry := self._addresses.get(number):
+                expires, address = entry
+                if expires > time.monotonic():
+                    self._addresses.move_to_end(number)
+                    self.hits += 1
+                    return address
+                del self._addresses[number]
+        return None
+
+    def _put_local(self, number: str, address: str):
+        with self._lock:
+            self._addresses[number] = (time.monotonic() + self.ttl, address)
+            self._addresses.move_to_end(number)
+            while len(self._addresses) > self.max_size:
+                self._addresses.popitem(last=False)
+                self.evictions += 1
+
+    def _get_persisted(self, number: str) -> Optional[str]:
+        if not self.persist_ttl:
+            return None
+        fresh_since = timezone.now() - timedelta(seconds=self.persist_ttl)
+        address = Customer.objects.filter(
+            phone_number=number,
+            payments_address__isnull=False,
+            payments_address_updated__gte=fresh_since,
+        ).values_list('payments_address', flat=True).first()
+        if address:
+            with self._lock:
+                self.persisted_hits += 1
+        return address
+
+    def _persist(self, number: str, address: str):
+        if self.persist_ttl:
+            Customer.objects.filter(phone_number=number)\
+                .update(payments_address=address, payments_address_updated=timezone.now())
+
+    def _sync(self):
+        """Drop in-memory addresses that any process has changed or invalidated since we last looked"""
+        with self._lock:
+            if time.monotonic() < self._next_sync:
+                return
+            self._next_sync = time.monotonic() + self.sync_interval
+            since, self._synced_at = self._synced_at, timezone.now()
+            if since is None or not self._addresses:
+                return
+        changed = Customer.objects.filter(payments_address_updated__gte=since - self.SYNC_SLACK)\
+            .values_list('phone_number', 'payments_address')
+        with self._lock:
+            for phone_number, address in changed:
+                number = phone_number.as_e164
+                if (entry := self._addresses.get(number)) and entry[1] != address:
+                    del self._addresses[number]
+
+    def get(self, number: str, fetch: Callable[[str], Optional[str]]) -> Optional[str]:
+        """Get a customer's address, calling fetch with their number if it isn't cached.
+
+        Customers without an address aren't cached, so they can turn payments on and be paid straight away.
+        """
+        try:
+            self._sync()
+        except Exception:
+            self.logger.exception("Exception checking for changed payments addresses")
+        if address := self._get_local(number):
+            return address
+        if address := self._get_persisted(number):
+            self._put_local(number, address)
+            return address
+        with self._lock:
+            self.misses += 1
+        if address := fetch(number):
+            self._put_local(number, address)
+            self._persist(number, address)
+        return address
+
+    def invalidate(self, number: str):
+        """Forget a customer's address, e.g. because their signal profile changed"""
+        self.logger.info(f"Invalidating payments address for {number}")
+        with self._lock:
+            self._addresses.pop(number, None)
+        # Stamped, so other processes drop their copy too
+        Customer.objects.filter(phone_number=number).update(payments_address=None,
+                                                            payments_address_updated=timezone.now())
+
+    def clear(self):
+        with self._lock:
+            self._addresses.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                size=len(self._addresses),
+                hits=self.hits,
+                persisted_hits=self.persisted_hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
@@ -0,0 +1,189 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import hashlib
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+import mc_util
+from django.conf import settings
+from django.db import connection
+
+from mobot_client.payments.client import MCClient
+
+
+class TxoAllocator:
+    """
+    Hands each concurrent payout its own input TXO, so payouts don't contend for the same unspent outputs.
+
+    Works best on a wallet that's been split into a pool of right-sized TXOs with split(), either ahead of a drop
+    with the prepare_wallet command or continuously with run(). A payout allocates the smallest free TXO that
+    covers it; the TXO is marked spent once the transaction is submitted, or freed if it fails. With no suitable
+    TXO free, allocate() returns None and full-service picks inputs as usual.
+
+    Processes sharing a wallet should each take a partition, so they never allocate the same TXO. Only one pool
+    keeper splits at a time across all of them, and allocators given a max_value_pmob leave the TXOs it splits
+    from alone. Batched payouts take their inputs from the allocator as well, several at once if need be.
+    """
+    # Postgres advisory lock held by the pool keeper that's splitting
+    KEEPER_LOCK_ID = 0x6d6f626f7401
+
+    def __init__(self, mcc: MCClient, account_id: str, refresh_interval: Optional[float] = None,
+                 max_value_pmob: Optional[int] = None):
+        self.mcc = mcc
+        self.account_id = account_id
+        # TXOs worth this much or more are left for the pool keeper to split
+        self.max_value_pmob = max_value_pmob
+        self.refresh_interval = refresh_interval if refresh_interval is not None \
+            else settings.PAYMENTS_BALANCE_RECONCILE_SECONDS
+        self.logger = logging.getLogger("TxoAllocator")
+        self._lock = threading.Lock()
+        self._unspent: Dict[str, int] = {}
+        self._allocated: Set[str] = set()
+        self._spent: Set[str] = set()
+        self._refreshed_at: Optional[float] = None
+        self._partition_index = 0
+        self._partition_count = 1
+        self._run = False
+
+    def set_partition(self, index: int, count: int):
+        """Only allocate this process' share of the wallet's TXOs"""
+        if not 0 <= index < count:
+            raise ValueError(f"Partition index {index} out of range for {count} partitions")
+        with self._lock:
+            self._partition_index, self._partition_count = index, count
+
+    def _in_partition(self, txo_id: str) -> bool:
+        if self._partition_count == 1:
+            return True
+        digest = hashlib.sha256(txo_id.encode()).digest()
+        return int.from_bytes(digest[:4], 'big') % self._partition_count == self._partition_index
+
+    def refresh(self):
+        """Reload unspent TXOs from full-service"""
+        unspent = self.mcc.get_unspent_txos(self.account_id)
+        with self._lock:
+            self._unspent = {txo_id: value for txo_id, value in unspent.items() if self._in_partition(txo_id)}
+            # Spent TXOs drop out of full-service's unspent list once their transaction lands
+            self._spent &= set(self._unspent)
+            self._refreshed_at = time.monotonic()
+
+    def _refresh_if_stale(self):
+        if self._refreshed_at is None or time.monotonic() - self._refreshed_at > self.refresh_interval:
+            try:
+                self.refresh()
+            except Exception:
+                self.logger.exception("Exception refreshing unspent TXOs")
+
+    def _free(self) -> Dict[str, int]:
+        return {txo_id: value for txo_id, value in self._unspent.items()
+                if txo_id not in self._allocated and txo_id not in self._spent}
+
+    def available(self, min_value_pmob: int = 0) -> int:
+        """Number of free TXOs worth at least min_value_pmob"""
+        self._refresh_if_stale()
+        with self._lock:
+            return sum(1 for value in self._free().values() if value >= min_value_pmob)
+
+    def pool_size(self, value_pmob: int) -> int:
+        """Number of free right-sized TXOs: worth at least value_pmob, but less than twice that"""
+        self._refresh_if_stale()
+        with self._lock:
+            return sum(1 for value in self._free().values() if value_pmob <= value < 2 * value_pmob)
+
+    def allocate(self, amount_pmob: int, max_inputs: int = 1) -> Optional[List[str]]:
+        """Reserve the smallest free TXO covering amount_pmob (which should include the fee). If none does and
+        max_inputs allows, reserve the fewest of the largest free TXOs that do between them.
+
+            :return: The TXO IDs to use as inputs, or None to let full-service choose
+        """
+        self._refresh_if_stale()
+        with self._lock:
+            candidates = sorted((value, txo_id) for txo_id, value in self._free().items()
+                                if self.max_value_pmob is None or value < self.max_value_pmob)
+            covering = [txo_id for value, txo_id in candidates if value >= amount_pmob]
+            if covering:
+                txo_ids = covering[:1]
+            else:
+                largest = candidates[::-1][:max_inputs]
+                if max_inputs <= 1 or sum(value for value, _ in largest) < amount_pmob:
+                    return None
+                txo_ids = []
+                for value, txo_id in largest:
+                    txo_ids.append(txo_id)
+                    amount_pmob -= value
+                    if amount_pmob <= 0:
+                        break
+            self._allocated.update(txo_ids)
+            return txo_ids
+
+    def release(self, txo_ids: List[str]):
+        """The payout failed; its inputs are free again"""
+        with self._lock:
+            self._allocated.difference_update(txo_ids)
+
+    def spent(self, txo_ids: List[str]):
+        """The payout was submitted; don't hand its inputs out again"""
+        with self._lock:
+            self._allocated.difference_update(txo_ids)
+            self._spent.update(txo_ids)
+
+    def split(self, count: int, value_pmob: int, timeout: float = 120) -> int:
+        """Pay ourselves until there are at least count free right-sized TXOs worth value_pmob each.
+
+            :return: Number of TXOs created
+        """
+        self.refresh()
+        created = 0
+        fee_pmob = int(self.mcc.minimum_fee_pmob)
+        while (needed := count - self.pool_size(value_pmob)) > 0:
+            # Fund splits from TXOs too big for the pool, so we don't spend the pool to grow it
+            with self._lock:
+                funding = sorted(((value, txo_id) for txo_id, value in self._free().items()
+                                  if value >= 2 * value_pmob), reverse=True)[:16]
+            funding_pmob = sum(value for value, _ in funding)
+            outputs = min(needed, 15, (funding_pmob - fee_pmob) // value_pmob)
+            if outputs <= 0:
+                self.logger.warning(f"Not enough funds to split off {needed} more TXOs of {value_pmob} pmob")
+                break
+            self.logger.info(f"Splitting off {outputs} TXOs of {value_pmob} pmob")
+            transaction_log, _ = self.mcc.build_and_submit_multi_output_transaction(
+                self.account_id, [(self.mcc.public_address, mc_util.pmob2mob(value_pmob))] * outputs,
+                input_txo_ids=[txo_id for _, txo_id in funding],
+            )
+            self.spent([txo_id for _, txo_id in funding])
+            self._wait_for([txo["txo_id_hex"] for txo in transaction_log["output_txos"]], timeout)
+            created += outputs
+        return created
+
+    def _wait_for(self, txo_ids: List[str], timeout: float):
+        """Wait for split outputs to land, so the next split has change to spend"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            unspent = self.mcc.get_unspent_txos(self.account_id)
+            if all(txo_id in unspent for txo_id in txo_ids):
+                break
+            time.sleep(1)
+        self.refresh()
+
+    def _is_keeper(self) -> bool:
+        """Whether this process is the one pool keeper for the wallet, taking over if the last one's gone"""
+        if connection.vendor != 'postgresql':
+            return True
+        with connection.cursor() as cursor:
+            # Held for as long as our connection is; taking it again while we hold it just succeeds
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [self.KEEPER_LOCK_ID])
+            return cursor.fetchone()[0]
+
+    def run(self, count: int, value_pmob: int, schedule: float = 60):
+        """Keep the pool topped up to count TXOs of value_pmob, splitting more when it falls below half. Every
+        replica can run this; only one of them splits at a time.
+        """
+        self._run = True
+        while self._run:
+            try:
+                if self._is_keeper() and self.pool_size(value_pmob) < count // 2:
+                    self.split(count, value_pmob)
+            except Exception:
+                self.logger.exception("Exception topping up TXO pool")
+            time.sleep(schedule)
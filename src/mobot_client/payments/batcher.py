@@ -0,0 +1,190 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import attr
+import mc_util
+import tenacity
+from django.conf import settings
+
+from mobot_client.payments.allocator import TxoAllocator
+from mobot_client.payments.client import MCClient
+
+
+class UnmatchedPayoutException(Exception):
+    """The payout went out in a submitted transaction, but we couldn't find its own output. Sending it again would
+    pay the customer twice, so it needs reconciling by hand instead."""
+    pass
+
+
+@attr.s
+class PayoutRequest:
+    address = attr.ib(type=str)  # b58 public address
+    amount_mob = attr.ib(type=Decimal)
+    future = attr.ib(type=Future, factory=Future)
+
+
+@attr.s
+class Payout:
+    """One recipient's share of a batched transaction"""
+    txo_id = attr.ib(type=str)
+    receiver_receipt = attr.ib(type=dict)  # full-service receiver receipt
+    batch_size = attr.ib(type=int, default=1)
+
+
+class PayoutBatcher:
+    """
+    Collects payouts over a short window and submits them as one multi-recipient transaction.
+
+    Sending a transaction per customer serialises every payout through the account's change outputs; batching
+    means one transaction (and one change output) per window instead. Callers block in send() until their batch
+    has been submitted, then get back their own txo and receiver receipt to send to the customer.
+    """
+    # A MobileCoin transaction has at most 16 outputs, and we need one for change
+    MAX_OUTPUTS = 15
+    MAX_INPUTS = 16
+
+    def __init__(self, mcc: MCClient, account_id: str, window: Optional[float] = None,
+                 max_outputs: Optional[int] = None, allocator: Optional[TxoAllocator] = None):
+        self.mcc = mcc
+        self.account_id = account_id
+        # If set, batches are funded from its TXOs rather than whatever full-service picks
+        self.allocator = allocator
+        self.window = window if window is not None else settings.PAYOUT_BATCH_WINDOW_SECONDS
+        self.max_outputs = min(max_outputs or self.MAX_OUTPUTS, self.MAX_OUTPUTS)
+        self.logger = logging.getLogger("PayoutBatcher")
+        self._queue: "queue.Queue[PayoutRequest]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.payouts = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Payouts waiting for the next batch"""
+        return self._queue.qsize()
+
+    def _ensure_running(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name="PayoutBatcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, address: str, amount_mob: Decimal) -> Future:
+        """Queue a payout for the next batch.
+
+            :return: A future resolving to the Payout, or raising if the batch failed
+        """
+        request = PayoutRequest(address=address, amount_mob=amount_mob)
+        self._queue.put(request)
+        self._ensure_running()
+        return request.future
+
+    def send(self, address: str, amount_mob: Decimal, timeout: Optional[float] = None) -> Payout:
+        return self.submit(address, amount_mob).result(timeout)
+
+    def _collect(self) -> List[PayoutRequest]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_outputs:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    @tenacity.retry(wait=tenacity.wait_random_exponential(min=1, max=30, multiplier=2),
+                    stop=tenacity.stop_after_delay(60), reraise=True)
+    def _get_public_key(self, txo_id: str) -> str:
+        """An output's public key, with retry: it may not have landed in full-service's wallet yet"""
+        return self.mcc.get_txo(txo_id)["public_key"]
+
+    def _match(self, batch: List[PayoutRequest], output_txos: List[dict],
+               receiver_receipts: List[dict]) -> List[Tuple[str, dict]]:
+        """Find each request's own output and receiver receipt. full-service doesn't promise to keep the order we
+            asked for, so outputs are matched on recipient and value, and receipts on their output's public key.
+
+            :return: TXO ID and receiver receipt for each request, in the batch's order
+        """
+        outputs: Dict[Tuple[str, int], List[str]] = defaultdict(list)
+        for txo in output_txos:
+            outputs[(txo["recipient_address_id"], int(txo["value_pmob"]))].append(txo["txo_id_hex"])
+        receipts = {receipt["public_key"]: receipt for receipt in receiver_receipts}
+        matched = []
+        for request in batch:
+            txo_ids = outputs.get((request.address, mc_util.mob2pmob(request.amount_mob)))
+            if not txo_ids:
+                raise ValueError(f"No output paying {request.amount_mob} MOB to {request.address}")
+            txo_id = txo_ids.pop(0)
+            public_key = self._get_public_key(txo_id)
+            if public_key not in receipts:
+                raise ValueError(f"No receiver receipt for output {txo_id}")
+            matched.append((txo_id, receipts[public_key]))
+        return matched
+
+    def _allocate_inputs(self, batch: List[PayoutRequest]) -> Optional[List[str]]:
+        if self.allocator is None:
+            return None
+        total_pmob = sum(mc_util.mob2pmob(request.amount_mob) for request in batch) + int(self.mcc.minimum_fee_pmob)
+        return self.allocator.allocate(total_pmob, max_inputs=self.MAX_INPUTS)
+
+    def submit_batch(self, batch: List[PayoutRequest]):
+        """Build and submit one transaction paying everyone in the batch, and resolve their futures.
+
+            If the transaction can't be built, each payout is retried in a transaction of its own, so one bad
+            address or amount only fails its own payout.
+        """
+        input_txo_ids = self._allocate_inputs(batch)
+        try:
+            transaction_log, tx_proposal = self.mcc.build_and_submit_multi_output_transaction(
+                self.account_id, [(request.address, request.amount_mob) for request in batch],
+                input_txo_ids=input_txo_ids,
+            )
+        except Exception as e:
+            if input_txo_ids:
+                self.allocator.release(input_txo_ids)
+            if len(batch) > 1:
+                self.logger.exception(f"Exception submitting batch of {len(batch)} payouts; sending them one by one")
+                for request in batch:
+                    self.submit_batch([request])
+            else:
+                self.logger.exception("Exception submitting payout")
+                batch[0].future.set_exception(e)
+            return
+        if input_txo_ids:
+            self.allocator.spent(input_txo_ids)
+        try:
+            matched = self._match(batch, transaction_log["output_txos"], self.mcc.create_receiver_receipts(tx_proposal))
+        except Exception as e:
+            # Submitted, so it must never be resent: fail with an exception senders don't retry on
+            self.logger.exception(f"Exception matching {len(batch)} submitted payouts to their outputs")
+            for request in batch:
+                request.future.set_exception(UnmatchedPayoutException(
+                    f"Payout of {request.amount_mob} MOB to {request.address} submitted but not matched: {e}"
+                ))
+            return
+        self.batches += 1
+        self.payouts += len(batch)
+        self.logger.info(f"Submitted {len(batch)} payouts in one transaction")
+        for request, (txo_id, receiver_receipt) in zip(batch, matched):
+            request.future.set_result(Payout(txo_id=txo_id, receiver_receipt=receiver_receipt, batch_size=len(batch)))
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self.submit_batch(batch)
+            except Exception as e:
+                self.logger.exception("Exception in payout batcher")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
@@ -1,14 +1,17 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 import logging
+import threading
 import time
 
 from concurrent.futures import ThreadPoolExecutor
-from typing import Tuple
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
 
 from django.utils import timezone
 import mobilecoin as mc
 import mc_util
 
+from mobot_client.instrumentation import instrumentation
 from mobot_client.models.messages import PaymentStatus, Payment, Message, ProcessingError
 
 from mobilecoin import Client
@@ -27,7 +30,46 @@ class CheckReceiptException(PaymentClientException):
     pass
 
 
+class PaymentPollStats:
+    """
+    In-memory counters for receipt polling, so waiting on a payment doesn't write to the payments table on every
+    poll. Payments are only saved when their status changes; how often and how long we polled is kept here.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.polls = 0
+        self.transitions = 0
+        self.resolved = 0
+        self.wait_seconds = 0.0
+
+    def poll(self, changed: bool = False):
+        with self._lock:
+            self.polls += 1
+            if changed:
+                self.transitions += 1
+
+    def resolve(self, wait_seconds: float):
+        with self._lock:
+            self.resolved += 1
+            self.wait_seconds += wait_seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(
+                polls=self.polls,
+                transitions=self.transitions,
+                resolved=self.resolved,
+                wait_seconds=self.wait_seconds,
+            )
+
+
 class MCClient(Client):
+    # Central receipt status service (a PaymentVerifier), if one is running in this process
+    receipt_checker = None
+    # Process-wide, shared by every client and the verifier
+    poll_stats = PaymentPollStats()
+
     def __init__(self):
         super().__init__(settings.FULLSERVICE_URL)
         self.public_address, self.account_id = self._get_default_account_info()
@@ -46,6 +88,11 @@ class MCClient(Client):
         public_address = account_obj["main_address"]
         return public_address, account_id
 
+    def _req(self, request: dict) -> dict:
+        # Every full-service call goes through here
+        with instrumentation.timed(instrumentation.FULL_SERVICE):
+            return super()._req(request)
+
     def check_receiver_receipt_status(self, address, receipt):
         try:
             return super().check_receiver_receipt_status(address, receipt)
@@ -53,8 +100,48 @@ class MCClient(Client):
             self.logger.exception("Exception raised when checking receipt")
             raise CheckReceiptException(str(e))
 
+    def build_and_submit_multi_output_transaction(self, account_id: str,
+                                                  addresses_and_amounts: List[Tuple[str, Decimal]],
+                                                  input_txo_ids: Optional[List[str]] = None) -> Tuple[dict, dict]:
+        """Pay several b58 addresses in one transaction, optionally from specific inputs.
+
+            :return: The transaction log and tx proposal, with outputs in the order given
+        """
+        params = {
+            "account_id": account_id,
+            "addresses_and_values": [
+                (address, str(mc_util.mob2pmob(amount))) for address, amount in addresses_and_amounts
+            ],
+        }
+        if input_txo_ids:
+            params["input_txo_ids"] = input_txo_ids
+        r = self._req({
+            "method": "build_and_submit_transaction",
+            "params": params,
+        })
+        return r["transaction_log"], r["tx_proposal"]
+
+    def get_unspent_txos(self, account_id: str) -> Dict[str, int]:
+        """:return: pmob value of each of the account's unspent TXOs, by TXO ID"""
+        r = self._req({
+            "method": "get_all_txos_for_account",
+            "params": {"account_id": account_id},
+        })
+        return {
+            txo_id: int(txo["value_pmob"]) for txo_id, txo in r["txo_map"].items()
+            if txo["account_status_map"].get(account_id, {}).get("txo_status") == "txo_status_unspent"
+        }
+
     def _wait_for_transaction(self, payment: Payment) -> Payment:
+        if self.receipt_checker is not None:
+            # Let the checker's sweep resolve it, rather than polling full-service ourselves
+            payment = self.receipt_checker.wait_for(payment)
+            if payment.status == PaymentStatus.TransactionPending:
+                raise TransactionCheckException(f"Payment {payment.pk} still pending")
+            return payment
+
         receipt = payment.signal_payment.receipt
+        started = time.monotonic()
         transaction_status = PaymentStatus.TransactionPending
         while transaction_status == PaymentStatus.TransactionPending:
             receipt_status = self.get_receipt_status(
@@ -62,15 +149,26 @@ class MCClient(Client):
             )
             transaction_status = PaymentStatus[receipt_status["receipt_transaction_status"]]
             self.logger.info(f"Waiting for {receipt}, current status {receipt_status}")
-            payment.status = transaction_status
-            payment.save()
-            time.sleep(2)
-
+            changed = transaction_status != payment.status
+            self.poll_stats.poll(changed)
+            if transaction_status == PaymentStatus.TransactionPending:
+                if changed:
+                    payment.status = transaction_status
+                    payment.save(update_fields=['status', 'updated'])
+                time.sleep(2)
+        self.poll_stats.resolve(time.monotonic() - started)
+
+        # One write for the final state, amount included
         if transaction_status != PaymentStatus.TransactionSuccess:
             self.logger.error(f"failed {transaction_status}")
-            transaction_status = PaymentStatus.Failure
+            payment.status = PaymentStatus.Failure
+        else:
             payment.status = transaction_status
-            payment.save()
+            if payment.amount_mob is None:
+                # Recorded as pending without an amount; fill it in from the receipt
+                payment.amount_mob = mc_util.pmob2mob(receipt_status["txo"]["value_pmob"])
+                payment.txo_id = receipt_status["txo"]["txo_id_hex"]
+        payment.save()
 
         return payment
 
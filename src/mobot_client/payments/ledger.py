@@ -0,0 +1,95 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from django.conf import settings
+
+from mobot_client.payments.client import MCClient
+
+
+class BalanceLedger:
+    """
+    Our view of the wallet balance, kept in memory so funds checks don't each cost a full-service call.
+
+    Payouts reserve their amount (plus fee) before they're submitted, so concurrent payouts in this process can't
+    promise the same pmob twice. A reservation is committed (deducted from the balance) once the transaction is
+    submitted, or released if it fails. The balance is reconciled against full-service whenever it's older than
+    reconcile_interval seconds, which also corrects for anything spent or received elsewhere, including by other
+    processes.
+    """
+
+    def __init__(self, mcc: MCClient, account_id: str, reconcile_interval: Optional[float] = None):
+        self.mcc = mcc
+        self.account_id = account_id
+        self.reconcile_interval = reconcile_interval if reconcile_interval is not None \
+            else settings.PAYMENTS_BALANCE_RECONCILE_SECONDS
+        self.logger = logging.getLogger("BalanceLedger")
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._unspent_pmob = 0
+        self._reservations: Dict[int, int] = {}
+        self._reconciled_at: Optional[float] = None
+
+    @property
+    def reserved_pmob(self) -> int:
+        with self._lock:
+            return sum(self._reservations.values())
+
+    def _stale(self) -> bool:
+        return self._reconciled_at is None or time.monotonic() - self._reconciled_at > self.reconcile_interval
+
+    def reconcile(self) -> int:
+        """Refresh the balance from full-service.
+
+            :return: The unspent pmob full-service reported
+        """
+        account_amount_response = self.mcc.get_balance_for_account(self.account_id)
+        unspent_pmob = int(account_amount_response["unspent_pmob"])
+        with self._lock:
+            if self._reconciled_at is not None and unspent_pmob != self._unspent_pmob:
+                self.logger.info(f"Reconciled balance: {self._unspent_pmob} -> {unspent_pmob} pmob")
+            self._unspent_pmob = unspent_pmob
+            self._reconciled_at = time.monotonic()
+        return unspent_pmob
+
+    def _reconcile_if_stale(self):
+        if self._stale():
+            try:
+                self.reconcile()
+            except Exception:
+                # Keep working from the last known balance; we'll try again next time
+                self.logger.exception("Exception reconciling balance with full-service")
+                if self._reconciled_at is None:
+                    raise
+
+    def available_pmob(self) -> int:
+        """Unspent pmob not already promised to a payout in flight"""
+        self._reconcile_if_stale()
+        with self._lock:
+            return self._unspent_pmob - sum(self._reservations.values())
+
+    def reserve(self, amount_pmob: int) -> Optional[int]:
+        """Set aside pmob for a payout about to be submitted.
+
+            :return: A reservation ID, or None if there aren't enough funds available
+        """
+        self._reconcile_if_stale()
+        with self._lock:
+            if self._unspent_pmob - sum(self._reservations.values()) < amount_pmob:
+                return None
+            reservation = next(self._ids)
+            self._reservations[reservation] = amount_pmob
+            return reservation
+
+    def commit(self, reservation: int):
+        """The payout was submitted; its pmob is spent"""
+        with self._lock:
+            self._unspent_pmob -= self._reservations.pop(reservation, 0)
+
+    def release(self, reservation: int):
+        """The payout failed; its pmob is available again"""
+        with self._lock:
+            self._reservations.pop(reservation, None)
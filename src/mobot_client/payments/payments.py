@@ -1,10 +1,11 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 
 import time
+from contextlib import contextmanager
 from decimal import Decimal
 import logging
 from functools import cached_property
-from typing import Optional
+from typing import List, Optional
 
 import mc_util as mc
 import tenacity
@@ -22,6 +23,11 @@ from mobot_client.models.messages import (
 )
 from mobot_client.chat_strings import ChatStrings
 from mobot_client.payments.client import MCClient
+from mobot_client.payments.address_cache import PaymentsAddressCache
+from mobot_client.payments.ledger import BalanceLedger
+from mobot_client.payments.batcher import PayoutBatcher, UnmatchedPayoutException
+from mobot_client.payments.allocator import TxoAllocator
+from mobot_client.instrumentation import instrumentation
 from mobot_client.utils import TimerFactory
 from mobot_client.core.context import ChatContext
 
@@ -38,11 +44,21 @@ class Payments:
     """The Payments class handles the logic relevant to sending MOB and handling receipts."""
 
     def __init__(
-            self, mobilecoin_client: MCClient, store: Store, messenger: SignalMessenger, signal: Signal
+            self, mobilecoin_client: MCClient, store: Store, messenger: SignalMessenger, signal: Signal,
+            address_cache: Optional[PaymentsAddressCache] = None, ledger: Optional[BalanceLedger] = None,
+            batcher: Optional[PayoutBatcher] = None, allocator: Optional[TxoAllocator] = None,
     ):
         self.mcc = mobilecoin_client
+        self.address_cache = address_cache if address_cache is not None else PaymentsAddressCache()
         self.minimum_fee_pmob = mobilecoin_client.minimum_fee_pmob
         self.account_id = mobilecoin_client.account_id
+        self.ledger = ledger if ledger is not None else BalanceLedger(mobilecoin_client, self.account_id)
+        # If set, payouts are collected and sent in multi-recipient transactions
+        self.batcher = batcher
+        if batcher is not None:
+            instrumentation.register_gauge("payout_queue_depth", lambda: batcher.queue_depth)
+        # If set, concurrent single payouts are each given their own input TXO (batches get theirs via the batcher)
+        self.allocator = allocator
         self.store = store
         self.signal = signal
         self.messenger = messenger
@@ -58,14 +74,23 @@ class Payments:
     def minimum_fee_mob(self):
         return mc.pmob2mob(self.minimum_fee_pmob)
 
-    def get_payments_address(self, source):
+    @staticmethod
+    def _source_number(source) -> str:
         if isinstance(source, dict):
-            source = source["number"]
-        else:
-            source = str(source)
+            return source["number"]
+        return str(source)
+
+    def get_payments_address(self, source):
+        return self.address_cache.get(self._source_number(source), self._fetch_payments_address)
+
+    def invalidate_payments_address(self, source):
+        """The customer's profile changed, so their payments address may have too"""
+        self.address_cache.invalidate(self._source_number(source))
 
+    def _fetch_payments_address(self, source: str) -> Optional[str]:
         self.logger.info(f"Getting payment address for customer {source}")
-        customer_signal_profile = self.signal.get_profile(source)
+        with instrumentation.timed(instrumentation.SIGNALD):
+            customer_signal_profile = self.signal.get_profile(source)
         self.logger.info(f"Got customer({source}) signal profile {customer_signal_profile}")
         mobilecoin_address = customer_signal_profile.get('mobilecoin_address')
         if not mobilecoin_address:
@@ -97,13 +122,25 @@ class Payments:
                     source, self.account_id, amount_mob, customer_payments_address, memo=memo
                 )
 
-    def send_reply_payment(self, amount_mob, cover_transaction_fee, memo="Refund") -> Payment:
+    def send_reply_payment(self, amount_mob, cover_transaction_fee, memo="Refund") -> Optional[Payment]:
+        """Pay the customer in the current context, and log it as our response to their message.
+
+            :return: The payment, or None if nothing was sent (e.g. they have no payments address)
+        """
         ctx = ChatContext.get_current_context()
         self.logger.info(f"Sending reply payment to {ctx.customer}: {amount_mob} MOB...")
 
         try:
             payment = self._send_mob_to_customer(ctx.message.customer, amount_mob, cover_transaction_fee, memo)
             self.logger.info("Payment logged!")
+        except UnmatchedPayoutException:
+            # It may well have been paid, so it's neither a success nor safe to treat as a failure and pay again
+            self.logger.exception(f"Reply payment to customer {ctx.customer} needs manual reconciliation")
+            payment = Payment(
+                amount_mob=amount_mob,
+                status=PaymentStatus.TransactionPending,
+                customer=ctx.customer,
+            )
         except Exception:
             self.logger.exception(f"Failed sending reply payment to customer {ctx.customer}: {amount_mob} MOB")
             payment = Payment(
@@ -111,6 +148,9 @@ class Payments:
                 status=PaymentStatus.Failure,
                 customer=ctx.customer,
             )
+        if payment is None:
+            self.logger.warning(f"No reply payment sent to customer {ctx.customer}")
+            return None
         payment.save()
         self.logger.info("Logging response object")
         response = MobotResponse.objects.create(
@@ -125,13 +165,55 @@ class Payments:
         )
         return payment
 
+    @contextmanager
+    def _reserve_funds(self, amount_in_mob: Decimal):
+        """Hold the amount plus fee against the balance while a payout is submitted; spent only if it succeeds"""
+        reservation = self.ledger.reserve(mc.mob2pmob(amount_in_mob) + int(self.minimum_fee_pmob))
+        if reservation is None:
+            raise NotEnoughFundsException(f"Not enough MOB in wallet to send {amount_in_mob}")
+        try:
+            yield reservation
+        except Exception:
+            self.ledger.release(reservation)
+            raise
+        self.ledger.commit(reservation)
+
+    def _allocate_inputs(self, amount_in_mob: Decimal) -> Optional[List[str]]:
+        if self.allocator is None:
+            return None
+        return self.allocator.allocate(mc.mob2pmob(amount_in_mob) + int(self.minimum_fee_pmob))
+
+    def submit_batched_payout(self, amount_in_mob: Decimal, customer_payments_address: str) -> (str, dict):
+        """Send with the next multi-recipient batch.
+
+            :return: Our output's TXO ID and full-service receiver receipt
+        """
+        self.logger.info("Submitting with the next payout batch")
+        with self.timers.get_timer("submit_batched_transaction"), self._reserve_funds(amount_in_mob):
+            payout = self.batcher.send(customer_payments_address, amount_in_mob)
+            self.logger.info(f"Sent in a batch of {payout.batch_size}")
+            return payout.txo_id, payout.receiver_receipt
+
     def build_and_submit_transaction_with_proposal(self, account_id: str, amount_in_mob: Decimal,
                                                    customer_payments_address: str) -> (str, dict):
         self.logger.info("Building and submitting with proposal")
-        with self.timers.get_timer("submit_transaction"):
-            transaction_log, tx_proposal = self.mcc.build_and_submit_transaction_with_proposal(account_id,
-                                                                                               amount=amount_in_mob,
-                                                                                               to_address=customer_payments_address)
+        with self.timers.get_timer("submit_transaction"), self._reserve_funds(amount_in_mob):
+            input_txo_ids = self._allocate_inputs(amount_in_mob)
+            try:
+                if input_txo_ids:
+                    transaction_log, tx_proposal = self.mcc.build_and_submit_multi_output_transaction(
+                        account_id, [(customer_payments_address, amount_in_mob)], input_txo_ids=input_txo_ids
+                    )
+                else:
+                    transaction_log, tx_proposal = self.mcc.build_and_submit_transaction_with_proposal(account_id,
+                                                                                                       amount=amount_in_mob,
+                                                                                                       to_address=customer_payments_address)
+            except Exception:
+                if input_txo_ids:
+                    self.allocator.release(input_txo_ids)
+                raise
+            if input_txo_ids:
+                self.allocator.spent(input_txo_ids)
             list_of_txos = transaction_log["output_txos"]
 
             if len(list_of_txos) > 1:
@@ -155,7 +237,8 @@ class Payments:
             self.logger.exception("TxOut did not land yet, id: " + txo_id)
             raise e
 
-    @tenacity.retry(wait=tenacity.wait_random_exponential(min=1, max=30, multiplier=2))
+    @tenacity.retry(wait=tenacity.wait_random_exponential(min=1, max=30, multiplier=2),
+                    retry=tenacity.retry_if_not_exception_type((NotEnoughFundsException, UnmatchedPayoutException)))
     def send_mob_to_address(self, source, account_id: str, amount_in_mob: Decimal, customer_payments_address: str, memo="Refund") -> Payment:
         """Attempt to send MOB to customer; retry if we fail."""
         # customer_payments_address is b64 encoded, but full service wants a b58 address
@@ -166,9 +249,14 @@ class Payments:
 
         with self.timers.get_timer("build_and_send_transaction"):
             self.logger.info(f"Sending {amount_in_mob} MOB to {customer_payments_address}")
-            txo_id, tx_proposal = self.build_and_submit_transaction_with_proposal(
-                account_id, amount_in_mob, customer_payments_address
-            )
+            if self.batcher is not None:
+                tx_proposal = None
+                txo_id, receiver_receipt_fs = self.submit_batched_payout(amount_in_mob, customer_payments_address)
+            else:
+                txo_id, tx_proposal = self.build_and_submit_transaction_with_proposal(
+                    account_id, amount_in_mob, customer_payments_address
+                )
+                receiver_receipt_fs = None
             self.logger.info(f"TXO_ID: {txo_id}")
             payment = Payment(
                 amount_mob=amount_in_mob,
@@ -181,7 +269,7 @@ class Payments:
                 self.logger.exception(f"Exception getting TXO result for {txo_id}")
             else:
                 try:
-                    receipt = self.send_payment_receipt(source, tx_proposal, memo)
+                    receipt = self.send_payment_receipt(source, tx_proposal, memo, receiver_receipt_fs)
                     signal_payment = SignalPayment.objects.create(
                         note=memo,
                         receipt=receipt
@@ -197,15 +285,22 @@ class Payments:
                     return payment
 
     @tenacity.retry(wait=tenacity.wait_random_exponential(min=1, max=30, multiplier=2))
-    def send_payment_receipt(self, source: str, tx_proposal: dict, memo="Refund") -> str:
-        receiver_receipt_fs = self.create_receiver_receipt(tx_proposal)
+    def send_payment_receipt(self, source: str, tx_proposal: Optional[dict], memo="Refund",
+                             receiver_receipt_fs: Optional[dict] = None) -> str:
+        if receiver_receipt_fs is None:
+            receiver_receipt_fs = self.create_receiver_receipt(tx_proposal)
         confirmation = receiver_receipt_fs["confirmation"]
         self.logger.info(f"Sending payment receipt to {source}")
 
         receiver_receipt = mc.full_service_receipt_to_b64_receipt(
             receiver_receipt_fs
         )
-        resp = self.signal.send_payment_receipt(source, receiver_receipt, memo)
+        # Anything we've said about this payment should arrive before it
+        ctx = ChatContext.get_current_context()
+        ctx.flush_replies()
+        self.messenger.drain(ctx.customer)
+        with instrumentation.timed(instrumentation.SIGNALD):
+            resp = self.signal.send_payment_receipt(source, receiver_receipt, memo)
         self.logger.info(f"Send receipt {receiver_receipt} to {source}: {resp}")
         return receiver_receipt
 
@@ -220,14 +315,13 @@ class Payments:
         return receiver_receipts[0]
 
     def get_unspent_pmob(self) -> int:
+        """Unspent pmob, straight from full-service. Also brings the ledger up to date."""
         with self.timers.get_timer("get_unspent_pmob"):
-            account_amount_response = self.mcc.get_balance_for_account(self.account_id)
-            unspent_pmob = int(account_amount_response["unspent_pmob"])
-            return unspent_pmob
+            return self.ledger.reconcile()
 
     def has_enough_funds_for_payment(self, payment_amount: Decimal) -> bool:
-        """Return a bool to check if we can pay out the desired amount"""
-        return self.get_unspent_pmob() >= (
+        """Return a bool to check if we can pay out the desired amount, net of payouts already in flight"""
+        return self.ledger.available_pmob() >= (
                 mc.mob2pmob(payment_amount) + int(self.minimum_fee_pmob)
         )
 
@@ -282,6 +376,14 @@ class Payments:
     def process_signal_payment(self, message: Message) -> Payment:
         return self.mcc.process_signal_payment(message)
 
+    def record_signal_payment(self, message: Message) -> Payment:
+        """Store an incoming payment as pending, without waiting on full-service; the PaymentVerifier resolves it"""
+        return Payment.objects.create(
+            customer=message.customer,
+            signal_payment=message.raw.payment,
+            status=PaymentStatus.TransactionPending,
+        )
+
     def handle_item_payment(self, amount_paid_mob: Decimal, drop_session: DropSession):
         item_cost_mob = drop_session.drop.item.price_in_mob
         if amount_paid_mob < item_cost_mob:
@@ -0,0 +1,195 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+from traceback import format_exc
+from typing import Dict, List, Optional
+
+import mc_util
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+from mobot_client.concurrency import AutoCleanupExecutor
+from mobot_client.core.context import release_connection
+from mobot_client.core.notifier import MessageNotifier, get_message_notifier
+from mobot_client.models.messages import Payment, PaymentStatus, Message, MessageStatus, ProcessingError
+from mobot_client.payments.client import MCClient, PaymentClientException
+
+
+class PaymentVerifier:
+    """
+    The central receipt status service: resolves incoming payments off the ingestion path, in one scheduled sweep.
+
+    The SignalLogger stores payment messages straight away as PAYMENT_PENDING. Each sweep checks every distinct
+    pending receipt with full-service once, records the amount and final status, and releases the message to
+    subscribers. Anything else that needs a receipt resolved registers with wait_for rather than polling
+    full-service itself, so request volume grows with the number of sweeps, not with payments times polls.
+    """
+
+    def __init__(self, mcc: MCClient, notifier: Optional[MessageNotifier] = None, schedule: float = 2,
+                 max_workers: int = 8, timeout: Optional[float] = None):
+        self.mcc = mcc
+        self.notifier = notifier if notifier is not None else get_message_notifier()
+        self.schedule = schedule
+        self.max_workers = max_workers
+        self.timeout = timeout if timeout is not None else settings.PAYMENT_VERIFICATION_TIMEOUT_SECONDS
+        self.logger = logging.getLogger("PaymentVerifier")
+        self._lock = threading.Lock()
+        self._first_seen: Dict[int, float] = {}
+        self._watched: Dict[int, Payment] = {}
+        self._waiters: Dict[int, threading.Event] = {}
+        self._run = False
+
+    @staticmethod
+    def pending_payments() -> models.QuerySet:
+        return Payment.objects.filter(
+            status=PaymentStatus.TransactionPending,
+            message__status=MessageStatus.PAYMENT_PENDING,
+        ).select_related('signal_payment', 'message', 'message__store')
+
+    def watch(self, payment: Payment) -> threading.Event:
+        """Include a payment in every sweep until it resolves, even if it has no pending message.
+
+            :return: An event set once the payment is resolved
+        """
+        with self._lock:
+            self._watched[payment.pk] = payment
+            return self._waiters.setdefault(payment.pk, threading.Event())
+
+    def wait_for(self, payment: Payment, timeout: Optional[float] = None) -> Payment:
+        """Block until the next sweep that resolves the payment, then return it with its final status"""
+        resolved = self.watch(payment).wait(timeout if timeout is not None else self.timeout)
+        if not resolved:
+            self.logger.warning(f"Timed out waiting on payment {payment.pk}")
+        payment.refresh_from_db()
+        return payment
+
+    def _resolved(self, payment: Payment):
+        with self._lock:
+            first_seen = self._first_seen.pop(payment.pk, None)
+            self._watched.pop(payment.pk, None)
+            event = self._waiters.pop(payment.pk, None)
+        self.mcc.poll_stats.resolve(time.monotonic() - first_seen if first_seen is not None else 0.0)
+        if event:
+            event.set()
+
+    def _release(self, payment: Payment):
+        """Hand the payment's message, if it's waiting on us, to the subscribers"""
+        message: Optional[Message] = Message.objects.filter(payment=payment).select_related('store').first()
+        if message is None:
+            return
+        released = Message.objects.filter(pk=message.pk, status=MessageStatus.PAYMENT_PENDING)\
+            .update(status=MessageStatus.NOT_PROCESSED)
+        if released:
+            try:
+                self.notifier.notify(message.store)
+            except Exception:
+                self.logger.exception("Exception notifying subscribers of verified payment")
+
+    def _fail(self, payment: Payment, exception: Exception):
+        self.logger.error(f"Giving up on payment {payment.pk}: {exception}")
+        payment.status = PaymentStatus.Failure
+        payment.save()
+        if message := Message.objects.filter(payment=payment).first():
+            ProcessingError.objects.create(
+                message=message,
+                exception=str(exception.__class__.__name__),
+                tb=str(format_exc())
+            )
+        self._release(payment)
+
+    def _timed_out(self, payment: Payment) -> bool:
+        with self._lock:
+            first_seen = self._first_seen.setdefault(payment.pk, time.monotonic())
+        return time.monotonic() - first_seen > self.timeout
+
+    def verify(self, receipt: str, payments: List[Payment]) -> bool:
+        """Check a receipt once, and apply the result to every payment carrying it.
+
+            :return: True if the payments were resolved (success or failure)
+        """
+        try:
+            receipt_status = self.mcc.get_receipt_status(receipt)
+            transaction_status = PaymentStatus[receipt_status["receipt_transaction_status"]]
+            self.mcc.poll_stats.poll(changed=transaction_status != PaymentStatus.TransactionPending)
+        except (PaymentClientException, KeyError) as e:
+            self.logger.exception(f"Exception checking receipt for payments {[payment.pk for payment in payments]}")
+            if not any(self._timed_out(payment) for payment in payments):
+                return False
+            for payment in payments:
+                self._fail(payment, e)
+                self._resolved(payment)
+            return True
+
+        if transaction_status == PaymentStatus.TransactionPending:
+            # Nothing has changed, so nothing to write
+            if not any(self._timed_out(payment) for payment in payments):
+                return False
+            for payment in payments:
+                self._fail(payment, TimeoutError(f"Payment still pending after {self.timeout} seconds"))
+                self._resolved(payment)
+            return True
+
+        for payment in payments:
+            payment.amount_mob = mc_util.pmob2mob(receipt_status["txo"]["value_pmob"])
+            payment.txo_id = receipt_status["txo"]["txo_id_hex"]
+            payment.status = transaction_status if transaction_status == PaymentStatus.TransactionSuccess \
+                else PaymentStatus.Failure
+            payment.processed = timezone.now()
+            payment.save()
+            self._release(payment)
+            self._resolved(payment)
+        return True
+
+    def _verify_isolated(self, receipt: str, payments: List[Payment]) -> int:
+        try:
+            return len(payments) if self.verify(receipt, payments) else 0
+        except Exception:
+            self.logger.exception(f"Exception verifying receipt {receipt}")
+            return 0
+        finally:
+            release_connection()
+
+    def _pending_by_receipt(self) -> Dict[str, List[Payment]]:
+        with self._lock:
+            watched = list(self._watched.values())
+        by_receipt = defaultdict(list)
+        seen = set()
+        for payment in itertools.chain(self.pending_payments(), watched):
+            if payment.pk not in seen and payment.signal_payment is not None:
+                seen.add(payment.pk)
+                by_receipt[payment.signal_payment.receipt].append(payment)
+        return by_receipt
+
+    def verify_pending(self) -> int:
+        """Sweep: check every distinct pending receipt once, concurrently.
+
+            :return: Number of payments resolved
+        """
+        by_receipt = self._pending_by_receipt()
+        if not by_receipt:
+            return 0
+        with AutoCleanupExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self._verify_isolated, receipt, payments) for receipt, payments in by_receipt.items()]
+            resolved = sum(fut.result() for fut in futures)
+        self.logger.info(f"Resolved {resolved} pending payments from {len(by_receipt)} receipt checks")
+        return resolved
+
+    def run(self, stop_when_done: bool = False):
+        """Keep verifying pending payments every schedule seconds.
+
+            :param stop_when_done: Stop once there are no more pending payments
+        """
+        self._run = True
+        while self._run:
+            try:
+                self.verify_pending()
+                if stop_when_done and not self._pending_by_receipt():
+                    self._run = False
+                    break
+            except Exception:
+                self.logger.exception("Exception verifying pending payments")
+            time.sleep(self.schedule)
@@ -0,0 +1,281 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+"""
+A load test that replays a drop end to end: synthetic customers message the store through a fake signald, the
+SignalLogger stores their messages, and a DropRunner answers them, paying out through a fake full-service. Both
+fakes add a fixed latency to every call, to stand in for the real services.
+
+Each customer sends the next line of their script once the bot has replied to the last, like a person would.
+
+Run it in the test database, sized by LOAD_TEST_* environment variables (see test_load.py), e.g.
+
+    LOAD_TEST_CUSTOMERS=1000 python manage.py test mobot_client.tests.test_load
+"""
+import logging
+import queue
+import statistics
+import threading
+import time
+from decimal import Decimal
+from typing import Dict, Iterator, List, Optional
+
+import attr
+import mc_util
+from django.db import connection
+from django.db.backends.signals import connection_created
+from signald.types import Message as SignalMessage, Payment as SignalPayment
+
+from mobot_client.drop_runner import DropRunner
+from mobot_client.instrumentation import instrumentation
+from mobot_client.logger import SignalMessenger
+from mobot_client.models import Customer, Drop, DropType, Store
+from mobot_client.models.messages import PaymentStatus
+from mobot_client.payments import Payments, PaymentVerifier
+from mobot_client.tests.factories import BonusCoinFactory, CustomerFactory, DropFactory, StoreFactory
+from mobot_client.tests.mock import MockMCC, MockSignal, TestMessage
+from signal_logger import SignalLogger
+
+
+class LatentMCC(MockMCC):
+    """MockMCC that takes latency seconds to answer every call, with a balance big enough for any drop"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+
+    def _wait(self):
+        # Stands in for MCClient._req, so count it the same way
+        with instrumentation.timed(instrumentation.FULL_SERVICE):
+            if self.latency:
+                time.sleep(self.latency)
+
+    def get_receipt_status(self, receipt: str) -> dict:
+        self._wait()
+        return super().get_receipt_status(receipt)
+
+    def get_balance_for_account(self, account_id: str) -> dict:
+        self._wait()
+        return dict(unspent_pmob=str(mc_util.mob2pmob(Decimal(1_000_000))))
+
+    def build_and_submit_multi_output_transaction(self, *args, **kwargs):
+        self._wait()
+        return super().build_and_submit_multi_output_transaction(*args, **kwargs)
+
+    def create_receiver_receipts(self, tx_proposal: dict) -> List[dict]:
+        self._wait()
+        return super().create_receiver_receipts(tx_proposal)
+
+    def get_txo(self, txo_id: str) -> dict:
+        self._wait()
+        return super().get_txo(txo_id)
+
+
+class ScriptedSignal(MockSignal):
+    """
+    A fake signald whose customers follow a script. Every call takes latency seconds. Records how long each
+    message waited for its first reply.
+    """
+
+    def __init__(self, customers: List[Customer], script: List[str], payments_address: str,
+                 payment_pmob: int = 0, mcc: Optional[MockMCC] = None, latency: float = 0.0,
+                 store_number: str = "+14156665666"):
+        super().__init__(store_number=store_number)
+        self.script = script
+        self.payments_address = payments_address
+        self.payment_pmob = payment_pmob
+        self.mcc = mcc
+        self.latency = latency
+        self.latencies: List[float] = []
+        self._inbox: "queue.Queue[SignalMessage]" = queue.Queue()
+        self._lock = threading.Lock()
+        # Customer number -> (index of the line waiting on a reply, when it was sent)
+        self._waiting: Dict[str, tuple] = {}
+        self._remaining = len(customers) * len(script)
+        self.finished = threading.Event()
+        self._closed = False
+        for customer in customers:
+            self._send_line(customer.phone_number.as_e164, 0)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _send_line(self, number: str, index: int):
+        payment = None
+        # The last line of the script carries the customer's payment, if there is one
+        if self.payment_pmob and self.mcc is not None and index == len(self.script) - 1:
+            payment = SignalPayment(note="a payment",
+                                    receipt=self.mcc.add_mock_payment(self.payment_pmob, PaymentStatus.TransactionSuccess))
+        with self._lock:
+            self._waiting[number] = (index, time.monotonic())
+        self._inbox.put(SignalMessage(text=self.script[index], username=number, source=dict(number=number),
+                                      timestamp=time.time(), payment=payment))
+
+    def close(self):
+        self._closed = True
+
+    def receive_messages(self) -> Iterator[SignalMessage]:
+        while not self._closed:
+            try:
+                yield self._inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def _replied(self, number: str):
+        with self._lock:
+            waiting = self._waiting.pop(number, None)
+            if waiting is None:
+                # The rest of a burst of replies to a line we've already counted
+                return
+            index, sent_at = waiting
+            self.latencies.append(time.monotonic() - sent_at)
+            self._remaining -= 1
+            if self._remaining == 0:
+                self.finished.set()
+        if index + 1 < len(self.script):
+            self._send_line(number, index + 1)
+
+    def send_message(self, recipient: str, text: str, block: bool = True, attachments: List[str] = []) -> None:
+        self._wait()
+        self.sent_messages[recipient].append(TestMessage(text=text, phone_number=self.store_number))
+        self._replied(recipient)
+
+    def send_payment_receipt(self, recipient: str, receipt: str, note: str) -> dict:
+        self._wait()
+        return {}
+
+    def send_read_receipt(self, recipient, timestamps, block: bool = True) -> None:
+        self._wait()
+
+    def get_profile(self, recipient: str) -> dict:
+        self._wait()
+        return {'mobilecoin_address': self.payments_address}
+
+    @property
+    def unanswered(self) -> int:
+        with self._lock:
+            return self._remaining
+
+
+class QueryCounter:
+    """Counts queries on every DB connection opened while installed"""
+
+    def __init__(self):
+        self.queries = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.queries += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        # Worker threads open their own connections; count those, and the one we already have
+        connection_created.connect(self._install)
+        connection.execute_wrappers.append(self)
+        return self
+
+    def __exit__(self, *args):
+        connection_created.disconnect(self._install)
+        connection.execute_wrappers.remove(self)
+
+
+@attr.s
+class LoadTestResult:
+    customers = attr.ib(type=int)
+    messages = attr.ib(type=int)
+    answered = attr.ib(type=int)
+    seconds = attr.ib(type=float)
+    queries = attr.ib(type=int)
+    latencies = attr.ib(type=list, repr=False)
+
+    @property
+    def throughput(self) -> float:
+        """Messages answered per second"""
+        return self.answered / self.seconds if self.seconds else 0.0
+
+    @property
+    def queries_per_message(self) -> float:
+        return self.queries / self.answered if self.answered else 0.0
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def summary(self) -> str:
+        median = statistics.median(self.latencies) if self.latencies else 0.0
+        return (
+            f"{self.customers} customers, {self.answered}/{self.messages} messages answered in {self.seconds:.2f}s\n"
+            f"throughput {self.throughput:8.1f} msg/s\n"
+            f"latency    p50 {median * 1000:8.1f}ms  p99 {self.percentile(99) * 1000:8.1f}ms  "
+            f"max {max(self.latencies, default=0) * 1000:8.1f}ms\n"
+            f"queries    {self.queries} total, {self.queries_per_message:.1f} per message"
+        )
+
+
+class DropLoadTest:
+    """Set up a store, an active airdrop and customers, then replay the script for every customer at once"""
+
+    def __init__(self, customers: int = 100, script: Optional[List[str]] = None, signald_latency: float = 0.0,
+                 full_service_latency: float = 0.0, payment_mob: Decimal = Decimal(0),
+                 payments_address: str = "fake-payments-address", sender_workers: int = 8, max_workers: int = 8):
+        self.customer_count = customers
+        self.script = script or ["hi"]
+        self.signald_latency = signald_latency
+        self.full_service_latency = full_service_latency
+        self.payment_pmob = mc_util.mob2pmob(payment_mob)
+        self.payments_address = payments_address
+        self.sender_workers = sender_workers
+        self.max_workers = max_workers
+        self.logger = logging.getLogger("DropLoadTest")
+
+    def set_up(self) -> (Store, Drop, List[Customer]):
+        store = StoreFactory.create()
+        drop = DropFactory.create(store=store, drop_type=DropType.AIRDROP, number_restriction="+44")
+        BonusCoinFactory.create(drop=drop, number_available_at_start=self.customer_count)
+        customers = CustomerFactory.create_batch(size=self.customer_count)
+        return store, drop, customers
+
+    def run(self, timeout: float = 600) -> LoadTestResult:
+        store, _, customers = self.set_up()
+        mcc = LatentMCC(latency=self.full_service_latency)
+        signal = ScriptedSignal(customers, self.script, self.payments_address, payment_pmob=self.payment_pmob,
+                                mcc=mcc, latency=self.signald_latency, store_number=store.phone_number.as_e164)
+        messenger = SignalMessenger(signal, store, sender_workers=self.sender_workers)
+        payments = Payments(mcc, store, messenger, signal)
+        runner = DropRunner(store=store, messenger=messenger, payments=payments)
+        runner.max_workers = self.max_workers
+        runner.poll_interval = 0.1
+        listener = SignalLogger(signal=signal, payments=payments)
+        verifier = PaymentVerifier(mcc, schedule=0.1)
+
+        threads = [
+            threading.Thread(target=listener.listen, name="LoadTestListener", daemon=True),
+            threading.Thread(target=runner.run_chat, name="LoadTestRunner", daemon=True),
+            threading.Thread(target=verifier.run, name="LoadTestVerifier", daemon=True),
+        ]
+        with QueryCounter() as counter:
+            start = time.monotonic()
+            for thread in threads:
+                thread.start()
+            if not signal.finished.wait(timeout):
+                self.logger.warning(f"Timed out with {signal.unanswered} messages unanswered")
+            seconds = time.monotonic() - start
+            listener._run = False
+            runner._run = False
+            verifier._run = False
+            signal.close()
+            for thread in threads:
+                thread.join(timeout=5)
+        return LoadTestResult(
+            customers=self.customer_count,
+            messages=self.customer_count * len(self.script),
+            answered=len(signal.latencies),
+            seconds=seconds,
+            queries=counter.queries,
+            latencies=signal.latencies,
+        )
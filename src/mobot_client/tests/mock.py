@@ -4,9 +4,11 @@ import attr
 import uuid
 import logging
 from collections import defaultdict
-from typing import Optional, Iterator, List
+from typing import Optional, Iterator, List, Tuple
 from decimal import Decimal
 
+import mc_util
+
 from django.utils import timezone
 from signald.types import Payment as SignalPayment, Message as SignalMessage
 
@@ -25,6 +27,8 @@ class MockMCC(MCClient):
         self.receipt_status_responses = {}
         self.public_address = "FooAddress"
         self.verbose = True
+        self.submitted_transactions = []
+        self.unspent_txos = {}
 
     def _get_receipt(self, amount_pmob: int, status: PaymentStatus) -> dict:
         """Create a bogus receipt with an amount"""
@@ -45,6 +49,44 @@ class MockMCC(MCClient):
     def get_receipt_status(self, receipt: str) -> dict:
         return self.receipt_status_responses[receipt]
 
+    def build_and_submit_multi_output_transaction(self, account_id: str, addresses_and_amounts,
+                                                  input_txo_ids: Optional[List[str]] = None) -> Tuple[dict, dict]:
+        """Pretend to submit a transaction, with one output per recipient plus change. Outputs to ourselves land
+        straight away."""
+        outputs = [dict(txo_id_hex=str(uuid.uuid4()), recipient_address_id=address, value_pmob=str(mc_util.mob2pmob(amount)))
+                   for address, amount in addresses_and_amounts]
+        self.submitted_transactions.append(outputs)
+        if input_txo_ids is None and self.unspent_txos:
+            # Fund it from our largest TXO
+            input_txo_ids = [max(self.unspent_txos, key=self.unspent_txos.get)]
+        if input_txo_ids:
+            change_pmob = sum(self.unspent_txos.pop(txo_id) for txo_id in input_txo_ids) - self.minimum_fee_pmob \
+                - sum(int(output["value_pmob"]) for output in outputs)
+            if change_pmob > 0:
+                self.unspent_txos[str(uuid.uuid4())] = change_pmob
+        for output in outputs:
+            if output["recipient_address_id"] == self.public_address:
+                self.unspent_txos[output["txo_id_hex"]] = int(output["value_pmob"])
+        transaction_log = dict(output_txos=outputs, change_txos=[dict(txo_id_hex=str(uuid.uuid4()))])
+        tx_proposal = dict(outlay_list=[dict(receiver=output["recipient_address_id"], value=output["value_pmob"])
+                                        for output in outputs],
+                           outputs=outputs)
+        return transaction_log, tx_proposal
+
+    def build_and_submit_transaction_with_proposal(self, account_id: str, amount, to_address: str) -> Tuple[dict, dict]:
+        return self.build_and_submit_multi_output_transaction(account_id, [(to_address, amount)])
+
+    def create_receiver_receipts(self, tx_proposal: dict) -> List[dict]:
+        return [dict(public_key=output["txo_id_hex"], confirmation=str(uuid.uuid4()), tombstone_block="0",
+                     amount=dict(value=output["value_pmob"])) for output in tx_proposal["outputs"]]
+
+    def get_txo(self, txo_id: str) -> dict:
+        # Our receiver receipts use the TXO ID as the output's public key
+        return dict(txo_id_hex=txo_id, public_key=txo_id)
+
+    def get_unspent_txos(self, account_id: str) -> dict:
+        return dict(self.unspent_txos)
+
     @property
     def minimum_fee_pmob(self) -> int:
         return 400000000
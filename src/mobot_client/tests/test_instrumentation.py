@@ -0,0 +1,79 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+from django.test import override_settings
+
+from mobot_client.core.context import ChatContext
+from mobot_client.instrumentation import COUNT_BUCKETS, Histogram, Instrumentation, instrumentation
+from mobot_client.models import Customer
+from mobot_client.tests.factories import CustomerFactory
+from mobot_client.tests.test_messages import AbstractMessageTest
+
+
+class InstrumentationTest(AbstractMessageTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        instrumentation.reset()
+
+    def test_histogram(self):
+        histogram = Histogram(COUNT_BUCKETS)
+        for value in range(1, 101):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.quantile(0.5), 50)
+        self.assertEqual(histogram.quantile(0.99), 100)
+        self.assertEqual(histogram.max, 100)
+
+        other = Histogram(COUNT_BUCKETS)
+        other.observe(5000)
+        histogram.merge(other)
+        self.assertEqual(histogram.count, 101)
+        self.assertEqual(histogram.quantile(1), 5000)
+        self.assertEqual(Histogram.from_dict(histogram.as_dict()).summary(), histogram.summary())
+        with self.assertRaises(ValueError):
+            histogram.merge(Histogram())
+
+    def test_message_timings(self):
+        """Handling a message should record its wall time, queries and signald time under its handler"""
+        customer = CustomerFactory.create()
+        self.create_incoming_message(customer=customer, text="hi")
+
+        def instrumented_handler(ctx: ChatContext):
+            Customer.objects.get(pk=ctx.customer.pk)
+            with instrumentation.timed(Instrumentation.SIGNALD):
+                pass
+
+        self.subscriber.register_chat_handler("hi", instrumented_handler)
+        self.subscriber.run_chat(process_max=1)
+
+        histograms = instrumentation.histograms()
+        self.assertEqual(histograms[("message_seconds", "instrumented_handler")].count, 1)
+        self.assertGreaterEqual(histograms[("message_db_queries", "instrumented_handler")].max, 1)
+        self.assertEqual(histograms[("signald_call_seconds", "")].count, 1)
+
+        instrumentation.publish()
+        collected = Instrumentation.collect()
+        self.assertEqual(collected[("message_seconds", "instrumented_handler")].count, 1)
+
+    @override_settings(METRICS_TOKEN="scrape-me")
+    def test_metrics(self):
+        """The metrics endpoint should show the queue, payments and published worker gauges to Prometheus"""
+        customer = CustomerFactory.create()
+        self.create_incoming_message(customer=customer, text="hi")
+        self.create_incoming_message(customer=customer, text="paying", payment_mob=1)
+        instrumentation.register_gauge("worker_in_flight", lambda: 2, "threads")
+        instrumentation.register_gauge("worker_capacity", lambda: 8, "threads")
+        instrumentation.observe("message_claim_seconds", 0.02)
+        instrumentation.publish()
+
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me")
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        store = self.store.phone_number.as_e164
+        self.assertIn(f'mobot_message_queue{{store="{store}",status="not_processed"}} 2', lines)
+        self.assertIn('mobot_payments{status="TransactionSuccess"} 1', lines)
+        self.assertIn('mobot_worker_in_flight{runtime="threads"} 2.0', lines)
+        self.assertIn('mobot_worker_utilisation{runtime="threads"} 0.25', lines)
+        self.assertIn('mobot_message_claim_seconds_bucket{le="0.025"} 1', lines)
+        self.assertIn('mobot_message_claim_seconds_count 1', lines)
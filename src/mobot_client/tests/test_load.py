@@ -0,0 +1,39 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import os
+import sys
+import unittest
+from decimal import Decimal
+
+from django.test import LiveServerTestCase
+
+from mobot_client.models.messages import Message, Direction
+from mobot_client.tests.load import DropLoadTest
+
+
+class DropLoadTestTest(LiveServerTestCase):
+
+    def test_small_drop(self):
+        """Every scripted message should get a reply, with its latency and queries counted"""
+        result = DropLoadTest(customers=5, script=["hi", "coins"], sender_workers=2, max_workers=4).run(timeout=60)
+        self.assertEqual(result.messages, 10)
+        self.assertEqual(result.answered, 10)
+        self.assertEqual(len(result.latencies), 10)
+        self.assertGreater(result.queries_per_message, 0)
+        self.assertEqual(Message.objects.filter(direction=Direction.RECEIVED).count(), 10)
+
+    @unittest.skipUnless(os.getenv("LOAD_TEST_CUSTOMERS"), "Set LOAD_TEST_CUSTOMERS to load test a full drop")
+    def test_drop_rush(self):
+        """A drop's opening rush, sized by LOAD_TEST_* environment variables, reporting throughput and latency"""
+        load_test = DropLoadTest(
+            customers=int(os.getenv("LOAD_TEST_CUSTOMERS")),
+            script=[line.strip() for line in os.getenv("LOAD_TEST_SCRIPT", "hi").split(',')],
+            signald_latency=float(os.getenv("LOAD_TEST_SIGNALD_LATENCY", 0.05)),
+            full_service_latency=float(os.getenv("LOAD_TEST_FULL_SERVICE_LATENCY", 0.2)),
+            payment_mob=Decimal(os.getenv("LOAD_TEST_PAY_MOB", 0)),
+            payments_address=os.getenv("LOAD_TEST_PAYMENTS_ADDRESS", "fake-payments-address"),
+            sender_workers=int(os.getenv("LOAD_TEST_SENDER_WORKERS", 8)),
+            max_workers=int(os.getenv("LOAD_TEST_WORKERS", 8)),
+        )
+        result = load_test.run(timeout=float(os.getenv("LOAD_TEST_TIMEOUT", 600)))
+        sys.stdout.write(f"\n{result.summary()}\n")
+        self.assertEqual(result.answered, result.messages, "Every message should have been answered")
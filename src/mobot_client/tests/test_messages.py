@@ -12,7 +12,7 @@ from django.test import LiveServerTestCase
 from mobot_client.core.subscriber import Subscriber
 from mobot_client.logger import SignalMessenger
 from mobot_client.tests.factories import StoreFactory
-from mobot_client.models import Store, Customer
+from mobot_client.models import Store, Customer, drop_schedule
 from mobot_client.models.messages import Message, Payment, PaymentStatus, Direction
 from mobot_client.payments import Payments
 from mobot_client.tests.mock import TestMessage, MockSignal, MockMCC, MockPayments
@@ -20,6 +20,8 @@ from mobot_client.tests.mock import TestMessage, MockSignal, MockMCC, MockPaymen
 
 class AbstractMessageTest(LiveServerTestCase):
     def setUp(self) -> None:
+        # Drops cached by an earlier test may have been rolled back
+        drop_schedule.invalidate()
         self.store: Store = StoreFactory.create()
         self.logger = logging.getLogger('ListenerTest')
         self.mcc = MockMCC()
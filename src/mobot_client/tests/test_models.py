@@ -3,8 +3,9 @@ import logging
 from concurrent.futures import as_completed
 from typing import List, Dict
 from collections import defaultdict
+from django.apps import apps
 from django.test import LiveServerTestCase
-from django.db import connection
+from django.db import connection, transaction
 
 import factory.random
 
@@ -12,11 +13,16 @@ from mobot_client.concurrency import AutoCleanupExecutor
 from mobot_client.tests.factories import *
 
 from mobot_client.models import (Drop,
+                                 DropCounts,
+                                 DropCounters,
                                  DropSession,
                                  Sku,
                                  DropType,
                                  BonusCoin,
-                                 OutOfStockException)
+                                 BonusCoinSlot,
+                                 OutOfStockException,
+                                 drop_schedule)
+from mobot_client.models.base import _backfill_sku_remaining
 from mobot_client.models.states import SessionState
 
 factory.random.reseed_random('mobot cleanup')
@@ -26,6 +32,8 @@ class ModelTests(LiveServerTestCase):
 
     def setUp(self) -> None:
         self.logger = logging.getLogger("ModelTestsLogger")
+        # Drops cached by an earlier test may have been rolled back
+        drop_schedule.invalidate()
 
     def test_items_available(self):
         '''Make sure inventory availability is what's expected, and sold-out logic is correctly applied'''
@@ -85,6 +93,19 @@ class ModelTests(LiveServerTestCase):
         self.assertIsNotNone(sku_to_sell_out.order(sold_out_session))
         print(f"Cancelled orders are available!")
 
+    def test_backfill_sku_remaining(self):
+        """Skus from before remaining was kept should be counted on migrate, and drops should go by their stock"""
+        item = ItemFactory.create()
+        drop = DropFactory.create(drop_type=DropType.ITEM, store=item.store, item=item)
+        sku = SkuFactory.create(item=item, quantity=2)
+        sku.order(DropSessionFactory.create(drop=drop))
+        Sku.objects.filter(pk=sku.pk).update(remaining=0)
+        self.assertFalse(drop.under_quota())
+
+        _backfill_sku_remaining(sender=apps.get_app_config('mobot_client'))
+        self.assertEqual(sku.number_available(), 1)
+        self.assertTrue(drop.under_quota())
+
     def test_claim_coin(self):
         '''Test that we're only able to claim a BonusCoin once'''
         drop = DropFactory.create(drop_type=DropType.AIRDROP)
@@ -120,6 +141,69 @@ class ModelTests(LiveServerTestCase):
         with self.assertRaises(OutOfStockException):
             BonusCoin.objects.claim_random_coin_for_session(session3)
 
+    def test_claim_from_slots(self):
+        """Every unit of every coin should be claimable once, including units added after claims start"""
+        drop = DropFactory.create(drop_type=DropType.AIRDROP)
+        small = BonusCoinFactory.create(drop=drop, number_available_at_start=1)
+        big = BonusCoinFactory.create(drop=drop, number_available_at_start=3)
+        self.assertEqual(BonusCoinSlot.objects.filter(drop=drop, claimed=False).count(), 4)
+        claimed = [BonusCoin.objects.find_and_claim_unclaimed_coin(drop).pk for _ in range(2)]
+
+        small.refresh_from_db()
+        small.number_available_at_start = 2
+        small.save()
+        claimed += [BonusCoin.objects.find_and_claim_unclaimed_coin(drop).pk for _ in range(3)]
+        with self.assertRaises(OutOfStockException):
+            BonusCoin.objects.find_and_claim_unclaimed_coin(drop)
+        self.assertEqual(sorted(claimed), sorted([small.pk] * 2 + [big.pk] * 3))
+        self.assertEqual(BonusCoin.objects.available_coins().filter(drop=drop).count(), 0)
+
+    def test_backfill_slots(self):
+        """Coins from before there were slots should be claimable once backfilled"""
+        drop = DropFactory.create(drop_type=DropType.AIRDROP)
+        coin = BonusCoinFactory.create(drop=drop, number_available_at_start=3)
+        BonusCoin.objects.filter(pk=coin.pk).update(number_claimed=1)
+        BonusCoinSlot.objects.filter(coin=coin).delete()
+        with self.assertRaises(OutOfStockException):
+            BonusCoin.objects.find_and_claim_unclaimed_coin(drop)
+        self.assertEqual(BonusCoinSlot.objects.backfill(drop.pk), 2)
+        self.assertEqual(BonusCoinSlot.objects.backfill(drop.pk), 0)
+        self.assertEqual(BonusCoin.objects.find_and_claim_unclaimed_coin(drop).pk, coin.pk)
+
+    def test_drop_counters(self):
+        """Counters should follow sessions and claims, and agree with a recount"""
+        drop = DropFactory.create(drop_type=DropType.AIRDROP)
+        coin = BonusCoinFactory.create(drop=drop, number_available_at_start=3, amount_mob=Decimal("0.5"))
+        sessions = DropSessionFactory.create_batch(size=3, drop=drop)
+        self.assertEqual(drop.counts(), DropCounts(initial_coin_limit=3))
+
+        for session in sessions[:2]:
+            BonusCoin.objects.claim_random_coin_for_session(session)
+        sessions[2].state = SessionState.WAITING_FOR_PAYMENT
+        sessions[2].save()
+        sessions[2].state = SessionState.CANCELLED
+        sessions[2].save()
+
+        counts = DropCounts(initial_sent=2, bonus_sent=2, bonus_mob_disbursed=Decimal(1), initial_coin_limit=3)
+        self.assertEqual(drop.counts(), counts)
+        with self.assertNumQueries(1):
+            self.assertFalse(drop.under_quota())
+        rows = set(DropCounters.objects.filter(drop=drop).values_list('pk', flat=True))
+        self.assertEqual(DropCounters.objects.reconcile(drop.pk), counts)
+        self.assertEqual(drop.counts(), counts)
+        # Reconciling updates the rows in place, so adds waiting on them aren't lost
+        self.assertEqual(set(DropCounters.objects.filter(drop=drop).values_list('pk', flat=True)), rows)
+
+        # An add to a missing slot recreates it rather than dropping the delta
+        DropCounters.objects.filter(drop=drop, slot__gt=0).delete()
+        for _ in range(DropCounters.SLOTS):
+            DropCounters.objects.add(drop.pk, initial_sent=1)
+        self.assertEqual(drop.counts().initial_sent, 2 + DropCounters.SLOTS)
+        DropCounters.objects.reconcile(drop.pk)
+
+        coin.delete()
+        self.assertEqual(drop.counts(), DropCounts(initial_sent=2))
+
     def test_claim_multithreaded(self):
         drop = DropFactory.create(drop_type=DropType.AIRDROP)
         BonusCoinFactory.create_batch(size=3, drop=drop, number_available_at_start=5)
@@ -147,6 +231,29 @@ class ModelTests(LiveServerTestCase):
         for coin in refreshed:
             self.assertEqual(coin.number_claimed, 5)
 
+    def test_order_multithreaded(self):
+        """Concurrent orders should never sell more than the Sku's quantity"""
+        item = ItemFactory.create()
+        drop = DropFactory.create(drop_type=DropType.ITEM, item=item)
+        sku = SkuFactory.create(item=item, quantity=5)
+        sessions = DropSessionFactory.create_batch(size=20, drop=drop)
+
+        def order_and_close(session: DropSession):
+            try:
+                return sku.order(session)
+            except OutOfStockException:
+                return None
+            finally:
+                connection.close()
+
+        with AutoCleanupExecutor(max_workers=10) as pool:
+            futures = [pool.submit(order_and_close, session) for session in sessions]
+        orders = [fut.result() for fut in as_completed(futures)]
+
+        self.assertEqual(len([order for order in orders if order is not None]), 5)
+        self.assertEqual(sku.number_available(), 0)
+        self.assertEqual(Sku.objects.reconcile_inventory(), 0)
+
     def test_active_drop_sessions_found_for_customer(self):
         '''Ensure that customers with old drop sessions don't find themselves unable to participate in current drops'''
         customer = CustomerFactory.create()
@@ -204,6 +311,27 @@ class ModelTests(LiveServerTestCase):
         self.assertEqual(Drop.objects.active_drops().count(), 1)
         self.assertEqual(Drop.objects.get_active_drop().pk, active_drop.pk)
 
+    def test_drop_schedule_cached(self):
+        """The active drop should come from the schedule, reloaded when a drop changes"""
+        active_drop = DropFactory.create()
+        self.assertEqual(Drop.objects.get_active_drop().pk, active_drop.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(Drop.objects.get_active_drop().pk, active_drop.pk)
+            self.assertIsNone(Drop.objects.get_advertising_drop())
+
+        active_drop.start_time = timezone.now() + timedelta(days=1)
+        active_drop.end_time = timezone.now() + timedelta(days=2)
+        active_drop.advertisment_start_time = timezone.now() - timedelta(days=1)
+        active_drop.save()
+        self.assertIsNone(Drop.objects.get_active_drop())
+        self.assertEqual(Drop.objects.get_advertising_drop().pk, active_drop.pk)
+
+        # Changes show up straight away within a transaction, too
+        with transaction.atomic():
+            active_drop.start_time = timezone.now() - timedelta(days=1)
+            active_drop.save()
+            self.assertEqual(Drop.objects.get_active_drop().pk, active_drop.pk)
+
     def test_customer_store_preferences_found(self):
         '''Test the customer.has_store_preferences method'''
         store = StoreFactory.create()
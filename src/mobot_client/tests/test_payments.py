@@ -0,0 +1,243 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+from decimal import Decimal
+from unittest.mock import MagicMock
+
+from django.test import LiveServerTestCase
+
+from mobot_client.concurrency import AutoCleanupExecutor
+from mobot_client.models import Customer
+from mobot_client.payments.address_cache import PaymentsAddressCache
+from mobot_client.payments.allocator import TxoAllocator
+from mobot_client.payments.batcher import PayoutBatcher, UnmatchedPayoutException
+from mobot_client.payments.ledger import BalanceLedger
+from mobot_client.tests.factories import CustomerFactory
+from mobot_client.tests.mock import MockMCC
+
+
+class PaymentsAddressCacheTest(LiveServerTestCase):
+
+    def test_cached_until_invalidated(self):
+        """Addresses should be fetched from signal once, then served from memory until the profile changes"""
+        customer = CustomerFactory.create()
+        number = customer.phone_number.as_e164
+        cache = PaymentsAddressCache(ttl=60, max_size=10, persist_ttl=60)
+        fetch = MagicMock(return_value="address")
+        self.assertEqual(cache.get(number, fetch), "address")
+        self.assertEqual(cache.get(number, fetch), "address")
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 1)
+        self.assertEqual(Customer.objects.get(pk=customer.pk).payments_address, "address")
+
+        cache.invalidate(number)
+        fetch.return_value = "new address"
+        self.assertEqual(cache.get(number, fetch), "new address")
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_persisted_address_shared(self):
+        """Another process' cache should pick up a persisted address without asking signal"""
+        customer = CustomerFactory.create()
+        number = customer.phone_number.as_e164
+        PaymentsAddressCache(persist_ttl=60).get(number, MagicMock(return_value="address"))
+        fetch = MagicMock()
+        cache = PaymentsAddressCache(persist_ttl=60)
+        self.assertEqual(cache.get(number, fetch), "address")
+        fetch.assert_not_called()
+        self.assertEqual(cache.stats['persisted_hits'], 1)
+
+    def test_invalidated_in_other_processes(self):
+        """An address invalidated by another process' cache should stop being served from memory"""
+        customer = CustomerFactory.create()
+        number = customer.phone_number.as_e164
+        cache = PaymentsAddressCache(ttl=60, persist_ttl=60, sync_interval=0)
+        fetch = MagicMock(return_value="address")
+        self.assertEqual(cache.get(number, fetch), "address")
+        self.assertEqual(cache.get(number, fetch), "address")
+
+        PaymentsAddressCache(persist_ttl=60).invalidate(number)
+        fetch.return_value = "new address"
+        self.assertEqual(cache.get(number, fetch), "new address")
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_bounded_and_misses_not_cached(self):
+        cache = PaymentsAddressCache(ttl=60, max_size=2, persist_ttl=0)
+        for number in ["+15555550001", "+15555550002", "+15555550003"]:
+            cache.get(number, MagicMock(return_value=f"address {number}"))
+        self.assertEqual(cache.stats['size'], 2)
+        self.assertEqual(cache.stats['evictions'], 1)
+        fetch = MagicMock(return_value=None)
+        cache.get("+15555550004", fetch)
+        cache.get("+15555550004", fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+
+class BalanceLedgerTest(LiveServerTestCase):
+
+    def setUp(self) -> None:
+        self.mcc = MockMCC()
+        self.mcc.get_balance_for_account = MagicMock(return_value={"unspent_pmob": "1000"})
+
+    def test_funds_checked_in_memory(self):
+        """Funds checks should use the ledger until it's due for reconciling"""
+        ledger = BalanceLedger(self.mcc, "foo", reconcile_interval=60)
+        self.assertEqual(ledger.available_pmob(), 1000)
+        self.assertEqual(ledger.available_pmob(), 1000)
+        self.assertEqual(self.mcc.get_balance_for_account.call_count, 1)
+
+    def test_reservations_not_oversubscribed(self):
+        ledger = BalanceLedger(self.mcc, "foo", reconcile_interval=60)
+        first = ledger.reserve(600)
+        self.assertIsNotNone(first)
+        self.assertIsNone(ledger.reserve(600))
+        ledger.release(first)
+        second = ledger.reserve(600)
+        self.assertIsNotNone(second)
+        ledger.commit(second)
+        self.assertEqual(ledger.available_pmob(), 400)
+        self.assertEqual(ledger.reserved_pmob, 0)
+        self.mcc.get_balance_for_account.return_value = {"unspent_pmob": "500"}
+        self.assertEqual(ledger.reconcile(), 500)
+        self.assertEqual(ledger.available_pmob(), 500)
+
+
+class PayoutBatcherTest(LiveServerTestCase):
+
+    def test_payouts_share_a_transaction(self):
+        """Payouts sent together should go out in one transaction, each getting back its own output and receipt"""
+        mcc = MockMCC()
+        batcher = PayoutBatcher(mcc, "foo", window=1)
+        addresses = [f"address {i}" for i in range(3)]
+        with AutoCleanupExecutor(max_workers=3) as pool:
+            futures = [pool.submit(batcher.send, address, Decimal("0.5")) for address in addresses]
+            payouts = [fut.result() for fut in futures]
+        self.assertEqual(len(mcc.submitted_transactions), 1)
+        outputs = {output["txo_id_hex"]: output["recipient_address_id"] for output in mcc.submitted_transactions[0]}
+        for address, payout in zip(addresses, payouts):
+            self.assertEqual(outputs[payout.txo_id], address)
+            self.assertEqual(payout.receiver_receipt["public_key"], payout.txo_id)
+            self.assertEqual(payout.batch_size, 3)
+
+    def test_batch_size_bounded(self):
+        mcc = MockMCC()
+        batcher = PayoutBatcher(mcc, "foo", window=1, max_outputs=2)
+        futures = [batcher.submit(f"address {i}", Decimal("0.5")) for i in range(3)]
+        for fut in futures:
+            fut.result()
+        self.assertEqual([len(outputs) for outputs in mcc.submitted_transactions], [2, 1])
+
+    def test_failed_batch_fails_every_payout(self):
+        mcc = MockMCC()
+        mcc.build_and_submit_multi_output_transaction = MagicMock(side_effect=Exception("full-service down"))
+        batcher = PayoutBatcher(mcc, "foo", window=0.1)
+        with self.assertRaises(Exception):
+            batcher.send("address", Decimal("0.5"))
+
+    def test_failed_batch_isolates_bad_payout(self):
+        """A batch that can't be built should be resent one payout at a time, failing only the bad one"""
+        mcc = MockMCC()
+        build = mcc.build_and_submit_multi_output_transaction
+
+        def reject_bad_address(account_id, addresses_and_amounts, **kwargs):
+            if any(address == "bad address" for address, _ in addresses_and_amounts):
+                raise ValueError("Invalid address")
+            return build(account_id, addresses_and_amounts, **kwargs)
+
+        mcc.build_and_submit_multi_output_transaction = reject_bad_address
+        batcher = PayoutBatcher(mcc, "foo", window=1)
+        futures = [batcher.submit(address, Decimal("0.5")) for address in ("address 0", "bad address", "address 1")]
+        self.assertEqual(futures[0].result().batch_size, 1)
+        self.assertEqual(futures[2].result().batch_size, 1)
+        with self.assertRaises(ValueError):
+            futures[1].result()
+        self.assertEqual([len(outputs) for outputs in mcc.submitted_transactions], [1, 1])
+
+    def test_outputs_matched_by_recipient(self):
+        """Each payout should get its own output and receipt, whatever order full-service returns them in"""
+        mcc = MockMCC()
+        build, create_receipts = mcc.build_and_submit_multi_output_transaction, mcc.create_receiver_receipts
+
+        def build_reversed(*args, **kwargs):
+            transaction_log, tx_proposal = build(*args, **kwargs)
+            return dict(transaction_log, output_txos=transaction_log["output_txos"][::-1]), tx_proposal
+
+        def create_rotated(tx_proposal):
+            receipts = create_receipts(tx_proposal)
+            return receipts[1:] + receipts[:1]
+
+        mcc.build_and_submit_multi_output_transaction = build_reversed
+        mcc.create_receiver_receipts = create_rotated
+        batcher = PayoutBatcher(mcc, "foo", window=1)
+        addresses = [f"address {i}" for i in range(3)]
+        futures = [batcher.submit(address, Decimal(i + 1)) for i, address in enumerate(addresses)]
+        outputs = {output["txo_id_hex"]: output["recipient_address_id"] for output in mcc.submitted_transactions[0]}
+        for address, fut in zip(addresses, futures):
+            payout = fut.result()
+            self.assertEqual(outputs[payout.txo_id], address)
+            self.assertEqual(payout.receiver_receipt["public_key"], payout.txo_id)
+
+    def test_unmatched_payouts_not_resent(self):
+        """A submitted batch whose outputs can't be matched should fail without being submitted again"""
+        mcc = MockMCC()
+        mcc.create_receiver_receipts = MagicMock(return_value=[])
+        batcher = PayoutBatcher(mcc, "foo", window=1)
+        futures = [batcher.submit(f"address {i}", Decimal("0.5")) for i in range(2)]
+        for fut in futures:
+            with self.assertRaises(UnmatchedPayoutException):
+                fut.result()
+        self.assertEqual(len(mcc.submitted_transactions), 1)
+
+
+class TxoAllocatorTest(LiveServerTestCase):
+
+    def setUp(self) -> None:
+        self.mcc = MockMCC()
+
+    def test_split_and_allocate(self):
+        """Concurrent payouts should each get their own input from the split pool"""
+        self.mcc.unspent_txos = {"big": int(Decimal("100e12"))}
+        allocator = TxoAllocator(self.mcc, "foo", refresh_interval=60)
+        value_pmob = int(Decimal("1e12"))
+        self.assertEqual(allocator.split(20, value_pmob), 20)
+        self.assertEqual([len(outputs) for outputs in self.mcc.submitted_transactions], [15, 5])
+        self.assertEqual(allocator.pool_size(value_pmob), 20)
+
+        with AutoCleanupExecutor(max_workers=10) as pool:
+            allocations = list(pool.map(lambda _: allocator.allocate(value_pmob), range(20)))
+        self.assertEqual(len({txo_ids[0] for txo_ids in allocations}), 20)
+        self.assertEqual(allocator.pool_size(value_pmob), 0)
+
+        allocator.release(allocations[0])
+        self.assertEqual(allocator.pool_size(value_pmob), 1)
+        allocator.spent(allocations[0])
+        allocator.release(allocations[0])
+        self.assertEqual(allocator.pool_size(value_pmob), 0)
+
+    def test_smallest_fit_and_partitions(self):
+        self.mcc.unspent_txos = {f"txo {i}": value for i, value in enumerate([5, 10, 20, 40])}
+        allocator = TxoAllocator(self.mcc, "foo", refresh_interval=60)
+        self.assertEqual(allocator.allocate(8), ["txo 1"])
+        partitions = [TxoAllocator(self.mcc, "foo", refresh_interval=60) for _ in range(2)]
+        for index, partition in enumerate(partitions):
+            partition.set_partition(index, 2)
+        self.assertEqual(sum(partition.available() for partition in partitions), 4)
+
+    def test_leaves_funding_to_keeper(self):
+        """With a max value, payouts shouldn't allocate the TXOs the pool keeper splits from"""
+        self.mcc.unspent_txos = {"pool": 10, "funding": 40}
+        allocator = TxoAllocator(self.mcc, "foo", refresh_interval=60, max_value_pmob=20)
+        self.assertEqual(allocator.allocate(8), ["pool"])
+        self.assertIsNone(allocator.allocate(8))
+        self.assertTrue(allocator._is_keeper())
+
+    def test_batches_funded_from_pool(self):
+        """Batches should take their inputs from the pool, several if need be, and leave the keeper's TXOs alone"""
+        value_pmob = int(Decimal("1e12"))
+        self.mcc.unspent_txos = {"pool 0": value_pmob, "pool 1": value_pmob, "funding": 100 * value_pmob}
+        allocator = TxoAllocator(self.mcc, "foo", refresh_interval=60, max_value_pmob=2 * value_pmob)
+        batcher = PayoutBatcher(self.mcc, "foo", window=1, allocator=allocator)
+        futures = [batcher.submit(f"address {i}", Decimal("0.5")) for i in range(2)]
+        for fut in futures:
+            self.assertEqual(fut.result().batch_size, 2)
+        self.assertIn("funding", self.mcc.unspent_txos)
+        self.assertNotIn("pool 0", self.mcc.unspent_txos)
+        self.assertNotIn("pool 1", self.mcc.unspent_txos)
@@ -1,7 +1,7 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 import logging
 from typing import List
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import mc_util
 
@@ -9,7 +9,9 @@ from decimal import Decimal
 
 from mobot_client.concurrency import AutoCleanupExecutor
 from mobot_client.tests.factories import StoreFactory, CustomerFactory, DropFactory, BonusCoinFactory
-from mobot_client.models.messages import Message
+from mobot_client.core.notifier import LocalMessageNotifier
+from mobot_client.models.messages import Message, MessageStatus, Payment, PaymentStatus
+from mobot_client.payments import PaymentVerifier
 from mobot_client.tests.mock import TestMessage, MockSignal, MockMCC, mock_signal_message_with_receipt
 from mobot_client.tests.test_messages import AbstractMessageTest
 from signal_logger import SignalLogger
@@ -33,6 +35,64 @@ class SignalLoggerTest(AbstractMessageTest):
             pool.submit(logger.listen, stop_when_done=True)
         print("Continuing test")
         self.assertEqual(Message.objects.all().count(), 2)
+        self.assertEqual(Message.objects.filter(status=MessageStatus.PAYMENT_PENDING).count(), 2,
+                         "Payments should be stored without waiting for verification")
+        verifier = PaymentVerifier(self.mcc, notifier=LocalMessageNotifier())
+        self.assertEqual(verifier.verify_pending(), 2)
+        self.assertEqual(Message.objects.filter(status=MessageStatus.NOT_PROCESSED).count(), 2)
         messages = list(Message.objects.all())
         self._compare_message(test_message_1, messages[0])
-        self._compare_message(test_message_2, messages[1])
\ No newline at end of file
+        self._compare_message(test_message_2, messages[1])
+
+    def test_pending_payment_not_released(self):
+        """Payments still pending on the ledger should keep their message back from subscribers"""
+        customer = CustomerFactory.create()
+        test_message = TestMessage(phone_number=customer.phone_number, text="Pay", payment=int(Decimal("1e12")))
+        signal = MockSignal(test_messages=[
+            mock_signal_message_with_receipt(test_message, self.mcc, status=PaymentStatus.TransactionPending)
+        ])
+        logger = SignalLogger(signal=signal, payments=self.payments)
+        with AutoCleanupExecutor(max_workers=1) as pool:
+            pool.submit(logger.listen, stop_when_done=True)
+        verifier = PaymentVerifier(self.mcc, notifier=LocalMessageNotifier())
+        self.assertEqual(verifier.verify_pending(), 0)
+        self.assertEqual(Message.objects.get_message(self.store), None)
+        self.assertEqual(Message.objects.filter(status=MessageStatus.PAYMENT_PENDING).count(), 1)
+
+    def test_receipt_checked_once_per_sweep(self):
+        """Payments sharing a receipt should cost one full-service check per sweep, and wake anyone waiting"""
+        customer = CustomerFactory.create()
+        test_message = TestMessage(phone_number=customer.phone_number, text="Pay", payment=int(Decimal("1e12")))
+        signal_message = mock_signal_message_with_receipt(test_message, self.mcc)
+        logger = SignalLogger(signal=MockSignal(test_messages=[signal_message, signal_message]), payments=self.payments)
+        with AutoCleanupExecutor(max_workers=1) as pool:
+            pool.submit(logger.listen, stop_when_done=True)
+        self.mcc.get_receipt_status = MagicMock(wraps=self.mcc.get_receipt_status)
+        verifier = PaymentVerifier(self.mcc, notifier=LocalMessageNotifier())
+        waiting_on = Message.objects.first().payment
+        event = verifier.watch(waiting_on)
+        self.assertEqual(verifier.verify_pending(), 2)
+        self.assertEqual(self.mcc.get_receipt_status.call_count, 1)
+        self.assertTrue(event.is_set())
+        self.assertEqual(Message.objects.filter(status=MessageStatus.NOT_PROCESSED).count(), 2)
+
+    def test_wait_writes_only_on_transition(self):
+        """Polling a pending payment shouldn't save it until its status changes"""
+        customer = CustomerFactory.create()
+        test_message = TestMessage(phone_number=customer.phone_number, text="Pay", payment=int(Decimal("1e12")))
+        signal = MockSignal(test_messages=[mock_signal_message_with_receipt(test_message, self.mcc)])
+        logger = SignalLogger(signal=signal, payments=self.payments)
+        with AutoCleanupExecutor(max_workers=1) as pool:
+            pool.submit(logger.listen, stop_when_done=True)
+        payment = Message.objects.first().payment
+        success = self.mcc.get_receipt_status(payment.signal_payment.receipt)
+        pending = dict(success, receipt_transaction_status=PaymentStatus.TransactionPending)
+        self.mcc.get_receipt_status = MagicMock(side_effect=[pending, pending, pending, success])
+        polls_before = self.mcc.poll_stats.as_dict()['polls']
+        with patch('mobot_client.payments.client.time.sleep'), \
+                patch.object(Payment, 'save', autospec=True, side_effect=Payment.save) as save:
+            payment = self.mcc.process_payment(payment)
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(self.mcc.poll_stats.as_dict()['polls'] - polls_before, 4)
+        self.assertEqual(payment.status, PaymentStatus.TransactionSuccess)
+        self.assertEqual(payment.amount_mob, mc_util.pmob2mob(test_message.payment))
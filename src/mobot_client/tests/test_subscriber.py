@@ -1,7 +1,19 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
+import asyncio
+import threading
+import time
+from unittest.mock import MagicMock
+
+from django.db import connection
+
+from mobot_client.chat_strings import ChatStrings
+from mobot_client.concurrency import AutoCleanupExecutor
 from mobot_client.core.context import ChatContext
+from mobot_client.core.notifier import LocalMessageNotifier
+from mobot_client.core.subscriber import Subscriber
+from mobot_client.logger import OutboundReply, ReplyNotSentException, SignalMessenger
 from mobot_client.tests.factories import StoreFactory, CustomerFactory, DropFactory, BonusCoinFactory
-from mobot_client.models.messages import Message, Payment, PaymentStatus, Direction
+from mobot_client.models.messages import Message, MobotResponse, Payment, PaymentStatus, Direction, MessageStatus
 from mobot_client.tests.test_messages import AbstractMessageTest
 
 
@@ -58,4 +70,212 @@ class SubscriberTestCase(AbstractMessageTest):
         expected_responses = [
             TEST_RESPONSE
         ]
-        self.check_replies(messages=replies, expected_replies=expected_responses)
\ No newline at end of file
+        self.check_replies(messages=replies, expected_replies=expected_responses)
+
+    def test_subscriber_wakes_on_notification(self):
+        """The subscriber should pick up a new message as soon as it's signalled, rather than on the next poll"""
+        customer = CustomerFactory.create()
+        notifier = LocalMessageNotifier()
+        subscriber = Subscriber(store=self.store, messenger=self.messenger, notifier=notifier)
+        subscriber.poll_interval = 60
+        handled = []
+        subscriber.register_chat_handler("test", lambda ctx: handled.append(ctx.message.text))
+
+        with AutoCleanupExecutor(max_workers=1) as pool:
+            fut = pool.submit(subscriber.run_chat, process_max=1)
+            time.sleep(0.5)
+            start = time.monotonic()
+            self.create_incoming_message(customer=customer, store=self.store, text="test")
+            notifier.notify(self.store)
+            fut.result(timeout=30)
+        self.assertLess(time.monotonic() - start, subscriber.poll_interval)
+        self.assertEqual(handled, ["test"])
+
+    def test_claim_batch(self):
+        """A batch claim should take the oldest message for each customer in one go"""
+        customers = CustomerFactory.create_batch(size=3)
+        first = self.create_incoming_message(customer=customers[0], store=self.store, text="first")
+        second = self.create_incoming_message(customer=customers[0], store=self.store, text="second")
+        for customer in customers[1:]:
+            self.create_incoming_message(customer=customer, store=self.store, text="hello")
+
+        claimed = Message.objects.claim_batch(self.store, 10)
+        self.assertEqual(len(claimed), 3)
+        self.assertEqual({message.customer_id for message in claimed}, {customer.pk for customer in customers})
+        self.assertIn(first.pk, [message.pk for message in claimed])
+        for message in claimed:
+            self.assertEqual(message.status, MessageStatus.PROCESSING)
+            message.refresh_from_db()
+            self.assertEqual(message.status, MessageStatus.PROCESSING)
+
+        self.assertEqual(Message.objects.claim_batch(self.store, 10), [],
+                         "Customer's next message should wait until their first is processed")
+        Message.objects.filter(pk=first.pk).update(status=MessageStatus.PROCESSED)
+        self.assertEqual([message.pk for message in Message.objects.claim_batch(self.store, 10)], [second.pk])
+
+    def test_claim_batch_sharded(self):
+        """Each shard should only claim its own customers, and together they should claim everyone"""
+        customers = CustomerFactory.create_batch(size=10)
+        for customer in customers:
+            self.create_incoming_message(customer=customer, store=self.store, text="hello")
+
+        claimed = {}
+        for shard_index in range(3):
+            for message in Message.objects.claim_batch(self.store, 10, shard_index=shard_index, shard_count=3):
+                self.assertEqual(message.customer_id % 3, shard_index)
+                claimed[message.customer_id] = shard_index
+        self.assertEqual(set(claimed.keys()), {customer.pk for customer in customers})
+
+    def test_concurrent_claims_never_collide(self):
+        """Workers claiming at the same time should each get distinct messages, without waiting on one another"""
+        for customer in CustomerFactory.create_batch(size=20):
+            self.create_incoming_message(customer=customer, store=self.store, text="hello")
+
+        def claim_all():
+            claimed = []
+            try:
+                while message := Message.objects.get_message(self.store):
+                    claimed.append(message.pk)
+            finally:
+                connection.close()
+            return claimed
+
+        with AutoCleanupExecutor(max_workers=5) as pool:
+            futures = [pool.submit(claim_all) for _ in range(5)]
+        claimed = [pk for fut in futures for pk in fut.result()]
+        self.assertEqual(len(claimed), 20)
+        self.assertEqual(len(set(claimed)), 20)
+
+    def test_claim_message_skips_claimed(self):
+        customer = CustomerFactory.create()
+        message = self.create_incoming_message(customer=customer, store=self.store, text="hello")
+        self.assertIsNotNone(Message.objects.claim_message(message))
+        self.assertIsNone(Message.objects.claim_message(message))
+
+    def test_dispatch_priority(self):
+        """The combined dispatcher should pick the same handler as searching each regex in order"""
+        handled = []
+        self.subscriber.register_chat_handler("", lambda ctx: handled.append("default"))
+        self.subscriber.register_chat_handler("\\+", lambda ctx: handled.append("plus"), order=10)
+        self.subscriber.register_chat_handler("coins", lambda ctx: handled.append("coins"), order=10)
+        self.subscriber.register_chat_handler("^help$", lambda ctx: handled.append("help"), order=20)
+
+        customer = CustomerFactory.create()
+        for text, expected in [("coins +", "plus"), ("my coins", "coins"), ("HELP", "help"),
+                               ("need help", "default"), ("multi\nline +", "plus")]:
+            message = self.create_incoming_message(customer=customer, store=self.store, text=text)
+            self.subscriber._find_handler(message)(None)
+            self.assertEqual(handled[-1], expected)
+        self.assertEqual(sum(self.subscriber.handler_match_counts.values()), 5)
+
+    def test_subscriber_asyncio(self):
+        """Coroutine handlers should run on the event loop, with the chat context available to blocking calls"""
+        customers = CustomerFactory.create_batch(size=3)
+        for customer in customers:
+            self.create_incoming_message(customer=customer, store=self.store, text="test")
+        TEST_RESPONSE = "Message Received!"
+        handled = []
+
+        async def test_handler(ctx: ChatContext):
+            handled.append(ctx.message.text)
+            await self.subscriber.async_messenger.log_and_send_message(TEST_RESPONSE)
+
+        self.subscriber.register_chat_handler("test", test_handler)
+        processed = asyncio.run(self.subscriber.run_chat_async(process_max=3, max_concurrency=2))
+        self.assertEqual(processed, 3)
+        self.assertEqual(handled, ["test"] * 3)
+        self.assertEqual(Message.objects.filter(direction=Direction.RECEIVED, status=MessageStatus.PROCESSED).count(), 3)
+        replies = Message.objects.filter(direction=Direction.SENT)
+        self.assertEqual(replies.count(), 3)
+        self.check_replies(messages=replies, expected_replies=[TEST_RESPONSE] * 3)
+
+    def test_queued_replies(self):
+        """Queued replies should go out in order per customer, and be logged once sent"""
+        customers = CustomerFactory.create_batch(size=3)
+        for customer in customers:
+            self.create_incoming_message(customer=customer, store=self.store, text="test")
+        messenger = SignalMessenger(self.signal, self.store, sender_workers=2)
+        subscriber = Subscriber(store=self.store, messenger=messenger)
+        TEST_RESPONSES = [f"Reply {i}" for i in range(5)]
+
+        def test_handler(ctx: ChatContext):
+            for response in TEST_RESPONSES:
+                messenger.log_and_send_message(response)
+
+        subscriber.register_chat_handler("test", test_handler)
+        subscriber.run_chat(process_max=3)
+        messenger.flush()
+        self.assertEqual(messenger.queue_depth, 0)
+        for customer in customers:
+            sent = [message.text for message in self.signal.sent_messages[customer.phone_number.as_e164]]
+            self.assertEqual(sent, TEST_RESPONSES)
+            replies = Message.objects.filter(direction=Direction.SENT, customer=customer, status=MessageStatus.PROCESSED)
+            self.assertEqual(replies.count(), len(TEST_RESPONSES))
+            self.assertEqual(MobotResponse.objects.filter(outgoing_response__in=replies).count(), len(TEST_RESPONSES))
+
+    def test_drain_replies(self):
+        """drain() should wait for a customer's queued replies, and a dead sender should be replaced on its own"""
+        customer = CustomerFactory.create()
+        message = self.create_incoming_message(customer=customer, store=self.store, text="test")
+        recipient = customer.phone_number.as_e164
+        messenger = SignalMessenger(self.signal, self.store, sender_workers=2)
+        index = customer.pk % 2
+        with ChatContext(message, reply_buffering="off"):
+            messenger.log_and_send_message("One")
+            other = messenger._senders[1 - index]
+            dead = threading.Thread(target=lambda: None)
+            dead.start()
+            dead.join()
+            messenger._senders[index] = dead
+            messenger.log_and_send_message("Two")
+            self.assertTrue(messenger.drain(customer, timeout=5))
+            self.assertEqual([sent.text for sent in self.signal.sent_messages[recipient]], ["One", "Two"])
+        self.assertIsNot(messenger._senders[index], dead)
+        self.assertIs(messenger._senders[1 - index], other)
+
+    def test_messenger_after_fork(self):
+        """A forked child shouldn't inherit the parent's senders, queued replies or lock"""
+        customer = CustomerFactory.create()
+        messenger = SignalMessenger(self.signal, self.store, sender_workers=2)
+        index = customer.pk % 2
+        messenger._queues[index].put(OutboundReply(customer=customer, text="parent's"))
+        messenger._lock.acquire()
+        messenger._after_fork()
+        self.assertEqual(messenger.queue_depth, 0)
+        self.assertEqual(messenger._senders, [None, None])
+        self.assertTrue(messenger.drain(customer, timeout=5))
+        self.assertEqual(self.signal.sent_messages[customer.phone_number.as_e164], [])
+
+    def test_inline_send_failure(self):
+        """Replies that couldn't be sent inline should be logged as errors, and the failure raised"""
+        customer = CustomerFactory.create()
+        message = self.create_incoming_message(customer=customer, store=self.store, text="test")
+        self.signal.send_message = MagicMock(side_effect=Exception("signald down"))
+        with self.assertRaises(ReplyNotSentException):
+            self.messenger.log_and_send_messages(customer, [("One", []), ("Two", [])], message)
+        self.assertEqual(Message.objects.filter(direction=Direction.SENT, customer=customer,
+                                                status=MessageStatus.ERROR).count(), 2)
+
+    def test_buffered_replies(self):
+        """Buffered replies should only go out when the handler's done, joined into one message if asked"""
+        customer = CustomerFactory.create()
+        message = self.create_incoming_message(customer=customer, store=self.store, text="test")
+        recipient = customer.phone_number.as_e164
+
+        with ChatContext(message, reply_buffering="burst"):
+            self.messenger.log_and_send_message("One")
+            self.messenger.log_and_send_message("Two")
+            self.assertEqual(len(self.signal.sent_messages[recipient]), 0)
+        self.assertEqual([sent.text for sent in self.signal.sent_messages[recipient]], ["One", "Two"])
+        self.assertEqual(MobotResponse.objects.filter(incoming=message).count(), 2)
+
+        with ChatContext(message, reply_buffering="join"):
+            self.messenger.log_and_send_message("Three")
+            self.messenger.log_and_send_message("Four")
+        self.assertEqual(self.signal.sent_messages[recipient][-1].text, "Three\n\nFour")
+        self.assertEqual(MobotResponse.objects.filter(incoming=message).count(), 3)
+
+        # Acks don't wait for the handler
+        with ChatContext(message, reply_buffering="burst"):
+            self.subscriber._ack_payment()
+            self.assertEqual(self.signal.sent_messages[recipient][-1].text, ChatStrings.PAYMENT_RECEIVED)
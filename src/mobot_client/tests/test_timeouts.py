@@ -0,0 +1,123 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import time
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from mobot_client.chat_strings import ChatStrings
+from mobot_client.models import DropSession, SessionState
+from mobot_client.models.messages import Message, Direction
+from mobot_client.tests.factories import CustomerFactory, DropFactory, DropSessionFactory
+from mobot_client.tests.test_messages import AbstractMessageTest
+from mobot_client.timeouts import Timeouts, TimeoutScheduler
+
+
+class TimeoutsTest(AbstractMessageTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.drop = DropFactory.create(store=self.store)
+        self.timeouts = Timeouts(self.messenger, self.payments, idle_timeout=60, cancel_timeout=300)
+
+    def _session(self, state: SessionState, quiet_for: int) -> DropSession:
+        customer = CustomerFactory.create()
+        message = self.create_incoming_message(customer=customer, text="hi")
+        Message.objects.filter(pk=message.pk).update(date=timezone.now() - timedelta(seconds=quiet_for))
+        return DropSessionFactory.create(customer=customer, drop=self.drop, state=state)
+
+    def test_sweep(self):
+        """Quiet sessions should move on in bulk, and only those sessions"""
+        chatty = self._session(SessionState.WAITING_FOR_PAYMENT, quiet_for=5)
+        quiet = [self._session(SessionState.WAITING_FOR_PAYMENT, quiet_for=120) for _ in range(3)]
+        idle = self._session(SessionState.IDLE, quiet_for=600)
+        done = self._session(SessionState.COMPLETED, quiet_for=600)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.timeouts.sweep(), 4)
+        sweep_queries = len(queries)
+
+        def state(session: DropSession) -> SessionState:
+            return DropSession.objects.get(pk=session.pk).state
+
+        self.assertEqual(state(chatty), SessionState.WAITING_FOR_PAYMENT)
+        self.assertEqual([state(session) for session in quiet], [SessionState.IDLE] * 3)
+        self.assertEqual(state(idle), SessionState.CANCELLED)
+        self.assertEqual(state(done), SessionState.COMPLETED)
+        self.assertEqual(
+            Message.objects.filter(direction=Direction.SENT, text=ChatStrings.TIMEOUT).count(), 3
+        )
+        self.assertEqual(
+            Message.objects.filter(direction=Direction.SENT, text=ChatStrings.TIMEOUT_CANCELLED).count(), 1
+        )
+
+        # Queries shouldn't grow with the number of customers we've ever seen
+        CustomerFactory.create_batch(size=20)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.timeouts.sweep(), 0)
+        self.assertLessEqual(len(queries), sweep_queries)
+
+    def test_failed_refund_retried(self):
+        """A session should only be marked refunded once its refund has gone out"""
+        session = self._session(SessionState.IDLE_AND_REFUNDABLE, quiet_for=600)
+        self.timeouts.do_refund = MagicMock(return_value=SessionState.IDLE_AND_REFUNDABLE)
+        self.assertEqual(self.timeouts.expire_idle(), 0)
+        self.assertEqual(DropSession.objects.get(pk=session.pk).state, SessionState.IDLE_AND_REFUNDABLE)
+
+        self.timeouts.do_refund = MagicMock(return_value=SessionState.REFUNDED)
+        self.assertEqual(self.timeouts.expire_idle(), 1)
+        self.assertEqual(DropSession.objects.get(pk=session.pk).state, SessionState.REFUNDED)
+        self.timeouts.do_refund.assert_called_once()
+
+    def test_refund_without_address_not_retried(self):
+        """A customer with no payments address can't be refunded, so they should be told once and left alone"""
+        session = self._session(SessionState.IDLE_AND_REFUNDABLE, quiet_for=600)
+        last_message = Message.objects.get(customer=session.customer, direction=Direction.RECEIVED)
+        self.payments.get_payments_address.return_value = None
+        self.assertEqual(self.timeouts.expire_idle(), 1)
+        self.assertEqual(DropSession.objects.get(pk=session.pk).state, SessionState.CANCELLED)
+        self.assertEqual(self.timeouts.expire_idle(), 0)
+        self.assertEqual(Message.objects.filter(direction=Direction.SENT, customer=session.customer).count(), 1)
+        # The message it replied to had already been handled
+        self.assertEqual(Message.objects.get(pk=last_message.pk).status, last_message.status)
+
+    def test_scheduler_fires_on_deadline(self):
+        """Deadlines should fire from the heap, pushed back by each new message"""
+        timeouts = Timeouts(self.messenger, self.payments, idle_timeout=1, cancel_timeout=60)
+        scheduler = TimeoutScheduler(timeouts)
+        session = self._session(SessionState.WAITING_FOR_PAYMENT, quiet_for=0)
+        other = self._session(SessionState.COMPLETED, quiet_for=0)
+        self.assertEqual(scheduler.rebuild(), 1)
+
+        # The customer writes again, pushing the deadline back
+        message = self.create_incoming_message(customer=session.customer, text="still here")
+        scheduler.arm_customer(session.customer_id, message.date)
+        self.assertEqual(len(scheduler), 1)
+
+        scheduler.start()
+        try:
+            time.sleep(0.5)
+            self.assertEqual(DropSession.objects.get(pk=session.pk).state, SessionState.WAITING_FOR_PAYMENT)
+            time.sleep(1.5)
+            self.assertEqual(DropSession.objects.get(pk=session.pk).state, SessionState.IDLE)
+            self.assertEqual(DropSession.objects.get(pk=other.pk).state, SessionState.COMPLETED)
+        finally:
+            scheduler.stop()
+
+    def test_scheduler_retries_skipped(self):
+        """A due session that couldn't be moved should be retried later, not forgotten"""
+        session = self._session(SessionState.WAITING_FOR_PAYMENT, quiet_for=120)
+        scheduler = TimeoutScheduler(self.timeouts)
+        self.assertEqual(scheduler.rebuild(), 1)
+        # As if another sweep had the session locked
+        self.timeouts.idle_active = MagicMock(return_value=0)
+        due = scheduler._pop_due(time.time())
+        self.assertEqual(list(due[TimeoutScheduler.IDLE]), [session.pk])
+
+        scheduler._fire(due)
+        retries = [entry for entry in scheduler._heap if entry[2] == session.pk and entry[4] == TimeoutScheduler.IDLE]
+        self.assertEqual(len(retries), 1)
+        self.assertGreater(retries[0][0], time.time() + TimeoutScheduler.RETRY_SECONDS - 5)
+        self.assertEqual(len(scheduler), 1)
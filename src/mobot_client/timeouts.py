@@ -1,23 +1,38 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
 
-import datetime
-import pytz
+import heapq
+import itertools
+import logging
+import threading
 import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-import mobilecoin as mc
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Subquery, QuerySet
+from django.utils import timezone
 
-from mobot_client.models import DropSession, Customer, Message, SessionState
+from mobot_client.models import DropCounters, DropSession, Customer, Message, SessionState
+from mobot_client.models.messages import Direction, PaymentStatus
 from mobot_client.chat_strings import ChatStrings
+from mobot_client.core.context import ChatContext, release_connection
 
-utc = pytz.UTC
+
+IDLE_STATES = {SessionState.IDLE, SessionState.IDLE_AND_REFUNDABLE}
 
 
 class Timeouts:
+    """
+    Moves drop sessions along when customers stop replying: active sessions go idle after idle_timeout seconds
+    without an inbound message, and idle sessions are cancelled (or refunded, if they'd paid) after cancel_timeout.
+    """
 
     def __init__(self, messenger, payments, schedule=30, idle_timeout=60, cancel_timeout=300):
         self.messenger = messenger
         self.schedule = schedule
         self.payments = payments
+        self.logger = logging.getLogger("Timeouts")
 
         # Time before warning
         self.idle_timeout = idle_timeout
@@ -26,91 +41,300 @@ class Timeouts:
         self.cancel_timeout = cancel_timeout
 
     @staticmethod
-    def customer_is_active(customer):
-        session = DropSession.objects.filter(customer=customer).values('state').last()
-        return session is not None and session.state in SessionState.active_states()
+    def live_sessions() -> QuerySet:
+        """Sessions in active or idle states, with the date of their customer's last inbound message"""
+        last_inbound = Message.objects.filter(
+            customer=OuterRef('customer'),
+            direction=Direction.RECEIVED,
+        ).order_by('-date')
+        return DropSession.objects.filter(
+            state__in=SessionState.active_states() | IDLE_STATES,
+        ).annotate(
+            last_inbound=Subquery(last_inbound.values('date')[:1]),
+            last_inbound_id=Subquery(last_inbound.values('pk')[:1]),
+        )
 
     @staticmethod
-    def customer_is_idle(customer):
-        session = DropSession.objects.filter(customer=customer).values('state').last()
-        return session is not None and (session.state == SessionState.IDLE or session.state == SessionState.IDLE_AND_REFUNDABLE)
+    def _quiet_since(cutoff) -> Exists:
+        """The customer hasn't messaged us since cutoff"""
+        return ~Exists(Message.objects.filter(
+            customer=OuterRef('customer'),
+            direction=Direction.RECEIVED,
+            date__gte=cutoff,
+        ))
 
-    @staticmethod
-    def customer_needs_refund(customer):
-        session = DropSession.objects.filter(customer=customer).values('state').last()
-        return session is not None and session.state in SessionState.refundable_states()
+    def _transition(self, states: Iterable[SessionState], timeout: int, new_state: SessionState,
+                    session_ids: Iterable[int] = None) -> List[DropSession]:
+        """Move every session in states whose customer has been quiet for timeout seconds to new_state, in one
+        update. Sessions locked by another sweep are skipped; they'll be picked up next time if still quiet.
 
-    @staticmethod
-    def set_customer_idle(customer):
-        session = DropSession.objects.filter(customer=customer).last()
-        return session is not None and session.state in SessionState.active_states()
+            :return: The sessions moved, as they were before the update
+        """
+        cutoff = timezone.now() - timedelta(seconds=timeout)
+        sessions = self.live_sessions().filter(state__in=states).filter(self._quiet_since(cutoff))
+        if session_ids is not None:
+            sessions = sessions.filter(pk__in=list(session_ids))
+        with transaction.atomic():
+            expired = list(sessions.select_for_update(skip_locked=True, of=('self',)).select_related('drop__item'))
+            if expired:
+                DropSession.objects.filter(pk__in=[session.pk for session in expired]).update(
+                    state=new_state, updated=timezone.now()
+                )
+                self._count_transitions(expired, new_state)
+        return expired
 
     @staticmethod
-    def set_customer_idle(customer):
-        session = DropSession.objects.filter(customer=customer).last()
-        if session is not None and session.state in SessionState.active_states():
-            if session.state in SessionState.refundable_states():
-                session.state = SessionState.IDLE_AND_REFUNDABLE
-            else:
-                session.state = SessionState.IDLE
-            session.save()
+    def _count_transitions(sessions: List[DropSession], new_state: SessionState):
+        """Bulk updates skip DropSession.save(), so keep the drops' counters in step here"""
+        deltas: Dict[int, int] = defaultdict(int)
+        for session in sessions:
+            deltas[session.drop_id] += DropCounters.initial_sent_delta(session.state, new_state)
+        for drop_id, delta in deltas.items():
+            if delta:
+                DropCounters.objects.add(drop_id, initial_sent=delta)
 
-    @staticmethod
-    def set_customer_refunded(customer):
-        session = DropSession.objects.filter(customer=customer).last()
-        if session is not None and (session.state in SessionState.active_states() or session.state == SessionState.IDLE):
-            session.state = SessionState.REFUNDED
-            session.save()
+    def _customers(self, sessions: List[DropSession]) -> Dict[int, Customer]:
+        return Customer.objects.in_bulk({session.customer_id for session in sessions})
 
-    @staticmethod
-    def set_customer_cancelled(customer):
-        session = DropSession.objects.filter(customer=customer).last()
-        if session is not None and (session.state in SessionState.active_states() or session.state == SessionState.IDLE):
-            session.state = SessionState.CANCELLED
-            session.save()
-
-    def do_refund(self, customer):
-        session = DropSession.objects.filter(customer_id=customer.phone_number).last()
-        if session is None:
-            return
-        # Confirm drop session is active
-        # FIXME TODO
+    def _notify(self, sessions: List[DropSession], text: str):
+        customers = self._customers(sessions)
+        for session in sessions:
+            try:
+                self.messenger._log_and_send_message(customers[session.customer_id], text)
+            except Exception:
+                self.logger.exception(f"Exception notifying customer of timeout for session {session.pk}")
+
+    def do_refund(self, session: DropSession) -> SessionState:
+        """Refund the item price, as a reply to the customer's last message.
+
+            :return: The state the session should end up in: REFUNDED once the refund's gone out, IDLE_AND_REFUNDABLE
+                to try again next time, CANCELLED if there's nothing we can send, or REFUNDING if it may have gone
+                out and needs checking by hand
+        """
+        last_message = Message.objects.filter(pk=session.last_inbound_id).select_related('customer').first()
+        if last_message is None or session.drop.item is None:
+            return SessionState.CANCELLED
+        # The customer's last message has already been handled, so leave its status alone
+        with ChatContext(last_message, reply_buffering="off", record_status=False):
+            try:
+                payment = self.payments.send_reply_payment(session.drop.item.price_in_mob, True,
+                                                           memo="Refund - Timed out")
+            except Exception:
+                self.logger.exception(f"Exception refunding session {session.pk}")
+                return SessionState.IDLE_AND_REFUNDABLE
+            if payment is None:
+                # They've no payments address (and have been told so), or it went out without a receipt
+                self.logger.warning(f"Nothing more to refund for session {session.pk}")
+                return SessionState.CANCELLED
+            if payment.status == PaymentStatus.TransactionPending:
+                self.logger.error(f"Refund for session {session.pk} needs manual reconciliation")
+                return SessionState.REFUNDING
+            if payment.status != PaymentStatus.TransactionSuccess:
+                self.logger.error(f"Refund for session {session.pk} failed; will retry")
+                return SessionState.IDLE_AND_REFUNDABLE
+            self.messenger.log_and_send_message(ChatStrings.TIMEOUT_REFUND)
+            return SessionState.REFUNDED
 
-        # Get amount customer paid
-        price = session.drop.item.price_in_mob
+    def _refund(self, session: DropSession) -> bool:
+        """Refund a session claimed as REFUNDING, and move it on to wherever do_refund says.
 
-        self.payments._send_mob_to_customer(customer, customer.phone_number, session.drop.item.price_in_mob, True)
-        self.set_customer_refunded(customer)
+            :return: True unless it's to be retried next time
+        """
+        new_state = self.do_refund(session)
+        if new_state != SessionState.REFUNDING:
+            DropSession.objects.filter(pk=session.pk, state=SessionState.REFUNDING).update(
+                state=new_state, updated=timezone.now()
+            )
+        return new_state != SessionState.IDLE_AND_REFUNDABLE
+
+    def expire_idle(self, session_ids: Iterable[int] = None) -> int:
+        """Cancel or refund idle sessions that have been quiet for cancel_timeout.
+
+            :param session_ids: Only consider these sessions
+            :return: Number of sessions expired
+        """
+        # Claimed as REFUNDING so no other sweep pays them too; only REFUNDED once the payout's gone out
+        refundable = self._transition({SessionState.IDLE_AND_REFUNDABLE}, self.cancel_timeout,
+                                      SessionState.REFUNDING, session_ids)
+        refunded = sum(self._refund(session) for session in refundable)
+        cancelled = self._transition({SessionState.IDLE}, self.cancel_timeout, SessionState.CANCELLED, session_ids)
+        self._notify(cancelled, ChatStrings.TIMEOUT_CANCELLED)
+        return refunded + len(cancelled)
+
+    def idle_active(self, session_ids: Iterable[int] = None) -> int:
+        """Mark active sessions that have been quiet for idle_timeout as idle, and warn their customers.
+
+            :param session_ids: Only consider these sessions
+            :return: Number of sessions made idle
+        """
+        refundable: Set[SessionState] = SessionState.active_states() & SessionState.refundable_states()
+        idle_refundable = self._transition(refundable, self.idle_timeout, SessionState.IDLE_AND_REFUNDABLE,
+                                           session_ids)
+        idle = self._transition(SessionState.active_states() - refundable, self.idle_timeout, SessionState.IDLE,
+                                session_ids)
+        self._notify(idle_refundable + idle, ChatStrings.TIMEOUT)
+        return len(idle_refundable) + len(idle)
+
+    def sweep(self) -> int:
+        """One pass over live sessions. Expire idle sessions before idling active ones, so nothing does both at once.
+
+            :return: Number of sessions moved
+        """
+        return self.expire_idle() + self.idle_active()
 
-    # FIXME: might need to not be a class method in order to get discovered
     def process_timeouts(self):
         while True:
-            for customer in Customer.objects.iterator():
-                # Only need to process timeouts for active customers
+            try:
+                self.sweep()
+            except Exception:
+                self.logger.exception("Exception processing timeouts")
+            time.sleep(self.schedule)
 
-                if not (self.customer_is_active(customer) or self.customer_is_idle(customer)):
-                    continue
 
-                last_message = Message.objects.filter(
-                    direction=0,
-                    customer=customer.phone_number
-                ).values('customer', 'date').order_by('-date').first()
+class TimeoutScheduler:
+    """
+    Fires session timeouts when they're due rather than by scanning for them.
+
+    Each live session has an idle and a cancel deadline on a heap, counted from its customer's last inbound
+    message. Deadlines are re-armed whenever one of the customer's messages is processed, and rebuilt from the DB
+    on start, so the scheduler thread only wakes when the next deadline passes or is moved. Timeouts still checks
+    the DB before moving a session, so a deadline made stale by a message we haven't armed yet does nothing; the
+    session is re-armed from that message instead. Sessions another sweep had locked are retried RETRY_SECONDS later.
+    """
+    IDLE = "idle"
+    CANCEL = "cancel"
+    RETRY_SECONDS = 30
+
+    def __init__(self, timeouts: Timeouts, shard_index: int = 0, shard_count: int = 1):
+        self.timeouts = timeouts
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.logger = logging.getLogger("TimeoutScheduler")
+        self._heap: List[Tuple[float, int, int, float, str]] = []
+        # Last inbound message time each session is armed for; heap entries for any other time are stale
+        self._armed: Dict[int, float] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._run = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._armed)
+
+    def _push(self, session_id: int, last_inbound: float):
+        self._armed[session_id] = last_inbound
+        heapq.heappush(self._heap, (last_inbound + self.timeouts.idle_timeout, next(self._seq), session_id,
+                                    last_inbound, self.IDLE))
+        heapq.heappush(self._heap, (last_inbound + self.timeouts.cancel_timeout, next(self._seq), session_id,
+                                    last_inbound, self.CANCEL))
+
+    def _compact(self):
+        if len(self._heap) > 4 * len(self._armed) + 64:
+            self._heap = [entry for entry in self._heap if self._armed.get(entry[2]) == entry[3]]
+            heapq.heapify(self._heap)
+
+    def arm(self, session_id: int, last_inbound: datetime):
+        """(Re)start a session's deadlines from its customer's last inbound message"""
+        with self._cond:
+            self._push(session_id, last_inbound.timestamp())
+            self._compact()
+            self._cond.notify()
+
+    def arm_customer(self, customer_id: int, last_inbound: datetime):
+        """Re-arm every live session of a customer who just sent us a message"""
+        session_ids = Timeouts.live_sessions().filter(customer_id=customer_id).values_list('pk', flat=True)
+        for session_id in session_ids:
+            self.arm(session_id, last_inbound)
 
-                if last_message is None:
-                    return
+    def rebuild(self) -> int:
+        """Arm every live session in our shard from the DB.
 
-                time_delta = (utc.localize(datetime.datetime.now()) - last_message['date']).seconds
+            :return: Number of sessions armed
+        """
+        sessions = Timeouts.live_sessions()
+        if self.shard_count > 1:
+            sessions = sessions.annotate(shard=F('customer_id') % self.shard_count).filter(shard=self.shard_index)
+        armed = 0
+        with self._cond:
+            self._heap.clear()
+            self._armed.clear()
+            for session_id, last_inbound, created_at in sessions.values_list('pk', 'last_inbound', 'created_at'):
+                self._push(session_id, (last_inbound or created_at).timestamp())
+                armed += 1
+            self._cond.notify()
+        self.logger.info(f"Armed timeouts for {armed} live sessions")
+        return armed
 
-                if time_delta > self.cancel_timeout and self.customer_is_idle(customer):
-                    if self.customer_needs_refund(customer):
-                        self.do_refund(customer)
-                        self.messenger.log_and_send_message(customer, customer.phone_number, ChatStrings.TIMEOUT_REFUND)
+    def _pop_due(self, now: float) -> Dict[str, Dict[int, float]]:
+        """:return: Due session IDs of each kind, with the last inbound time they were armed for"""
+        due = {self.IDLE: {}, self.CANCEL: {}}
+        while self._heap and self._heap[0][0] < now:
+            _, _, session_id, last_inbound, kind = heapq.heappop(self._heap)
+            if self._armed.get(session_id) != last_inbound:
+                continue
+            due[kind][session_id] = last_inbound
+            if kind == self.CANCEL:
+                # Nothing after cancelling; it's re-armed if the customer comes back
+                del self._armed[session_id]
+        return due
+
+    def _retry_skipped(self, due: Dict[str, Dict[int, float]]):
+        """Re-arm fired sessions still waiting on that timeout: from the customer's latest message if they've
+        written since, or RETRY_SECONDS from now if another sweep had them locked or the refund failed
+        """
+        waiting_states = {self.IDLE: SessionState.active_states(), self.CANCEL: IDLE_STATES}
+        for kind, fired in due.items():
+            if not fired:
+                continue
+            skipped = Timeouts.live_sessions().filter(pk__in=list(fired), state__in=waiting_states[kind]) \
+                .values_list('pk', 'last_inbound', 'created_at')
+            retry_at = time.time() + self.RETRY_SECONDS
+            with self._cond:
+                for session_id, last_inbound, created_at in skipped:
+                    armed_for = fired[session_id]
+                    if self._armed.get(session_id, armed_for) != armed_for:
+                        # Re-armed by a new message while we were firing
+                        continue
+                    latest = (last_inbound or created_at).timestamp()
+                    if latest > armed_for:
+                        self._push(session_id, latest)
                     else:
-                        self.set_customer_cancelled(customer)
-                        self.messenger.log_and_send_message(customer, customer.phone_number,
-                                                            ChatStrings.TIMEOUT_CANCELLED)
+                        self._armed[session_id] = armed_for
+                        heapq.heappush(self._heap, (retry_at, next(self._seq), session_id, armed_for, kind))
+                self._cond.notify()
 
-                if time_delta > self.idle_timeout and self.customer_is_active(customer):
-                    self.set_customer_idle(customer)
-                    self.messenger.log_and_send_message(customer, customer.phone_number, ChatStrings.TIMEOUT)
-            time.sleep(self.schedule)
+    def _fire(self, due: Dict[str, Dict[int, float]]):
+        try:
+            if due[self.CANCEL]:
+                self.timeouts.expire_idle(session_ids=due[self.CANCEL])
+            if due[self.IDLE]:
+                self.timeouts.idle_active(session_ids=due[self.IDLE])
+            self._retry_skipped(due)
+        except Exception:
+            self.logger.exception("Exception firing session timeouts")
+        finally:
+            release_connection()
+
+    def run(self):
+        self._run = True
+        while self._run:
+            with self._cond:
+                due = self._pop_due(time.time())
+                if not (due[self.IDLE] or due[self.CANCEL]):
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                    continue
+            self._fire(due)
+
+    def start(self):
+        """Rebuild from the DB and fire deadlines from a background thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.rebuild()
+        self._thread = threading.Thread(target=self.run, name="TimeoutScheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._run = False
+            self._cond.notify()
@@ -0,0 +1,101 @@
+# Copyright (c) 2021 MobileCoin. All rights reserved.
+import hmac
+from typing import Dict, List
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Count
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, JsonResponse
+
+from mobot_client.instrumentation import Histogram, Instrumentation
+from mobot_client.models.messages import Direction, Message, MessageStatus, Payment
+
+# Published snapshots older than this are from processes that have gone away
+METRICS_MAX_AGE_SECONDS = 60
+
+# Received messages in these states are still waiting on us
+QUEUED_STATUSES = (MessageStatus.NOT_PROCESSED, MessageStatus.PROCESSING, MessageStatus.PAYMENT_PENDING)
+
+
+@staff_member_required
+def instrumentation_summary(request: HttpRequest) -> JsonResponse:
+    """Per-message timings merged across every process that's published recently"""
+    max_age = float(request.GET.get('max_age', 300))
+    return JsonResponse(dict(metrics=Instrumentation.summarize(Instrumentation.collect(max_age=max_age))))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels: str) -> str:
+    """Prometheus label set, leaving out empty labels"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in labels.items() if value != ""]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _histogram_lines(name: str, histogram: Histogram, **labels: str) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=repr(float(bound)))} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+    return lines
+
+
+def _authorized(request: HttpRequest) -> bool:
+    if request.user.is_active and request.user.is_staff:
+        return True
+    if not settings.METRICS_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {settings.METRICS_TOKEN}")
+
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    """
+    Prometheus text exposition of queue depth per store, payment stage counts, worker utilisation, and the
+    latency histograms every mobot process publishes, so replicas can be scaled on them
+    """
+    if not _authorized(request):
+        return HttpResponseForbidden()
+    lines = []
+
+    lines += ["# HELP mobot_message_queue Received messages still waiting on a worker, by store and status",
+              "# TYPE mobot_message_queue gauge"]
+    queued = (Message.objects.filter(direction=Direction.RECEIVED, status__in=QUEUED_STATUSES)
+              .values_list('store__phone_number', 'status').annotate(count=Count('id')).order_by())
+    for store, status, count in queued:
+        lines.append(f"mobot_message_queue{_labels(store=str(store), status=MessageStatus(status).name.lower())} "
+                     f"{count}")
+
+    lines += ["# HELP mobot_payments Payments by status", "# TYPE mobot_payments gauge"]
+    payments = Payment.objects.values_list('status').annotate(count=Count('id')).order_by()
+    for status, count in payments:
+        lines.append(f"mobot_payments{_labels(status=status)} {count}")
+
+    gauges: Dict[str, Dict[str, float]] = {}
+    for (metric, label), value in Instrumentation.collect_gauges(max_age=METRICS_MAX_AGE_SECONDS).items():
+        gauges.setdefault(metric, {})[label] = value
+    for metric, values in sorted(gauges.items()):
+        lines.append(f"# TYPE mobot_{metric} gauge")
+        lines += [f"mobot_{metric}{_labels(runtime=label)} {value}" for label, value in sorted(values.items())]
+    if "worker_in_flight" in gauges:
+        lines += ["# HELP mobot_worker_utilisation Busy workers over worker capacity, across every process",
+                  "# TYPE mobot_worker_utilisation gauge"]
+        for runtime, in_flight in sorted(gauges["worker_in_flight"].items()):
+            capacity = gauges.get("worker_capacity", {}).get(runtime, 0)
+            utilisation = in_flight / capacity if capacity else 0.0
+            lines.append(f"mobot_worker_utilisation{_labels(runtime=runtime)} {utilisation}")
+
+    histograms: Dict[str, Dict[str, Histogram]] = {}
+    for (metric, label), histogram in Instrumentation.collect(max_age=METRICS_MAX_AGE_SECONDS).items():
+        histograms.setdefault(metric, {})[label] = histogram
+    for metric, by_handler in sorted(histograms.items()):
+        lines.append(f"# TYPE mobot_{metric} histogram")
+        for handler, histogram in sorted(by_handler.items()):
+            lines += _histogram_lines(f"mobot_{metric}", histogram, handler=handler)
+
+    return HttpResponse("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,14 +1,19 @@
 # Copyright (c) 2021 MobileCoin. All rights reserved.
+import asyncio
 import logging
 import time
 
-from concurrent.futures import Future
-from mobot_client.concurrency import AutoCleanupExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from mobot_client.concurrency import AutoCleanupExecutor, blocking
+from mobot_client.core.notifier import MessageNotifier, get_message_notifier
+from mobot_client.instrumentation import instrumentation
 
 from signald import Signal as _Signal
 from signald.types import Message as SignalMessage
 
-from mobot_client.models.messages import Message
+from mobot_client.models.messages import Message, MessageStatus
 from mobot_client.payments import Payments
 from mobot_client.payments.client import MCClient
 
@@ -21,37 +26,59 @@ class SignalMessageException(Exception):
 class SignalLogger:
     """A signal logger that logs to our DB instead of running callbacks"""
 
-    def __init__(self, signal: _Signal, payments: Payments, *args, **kwargs):
+    def __init__(self, signal: _Signal, payments: Payments, notifier: Optional[MessageNotifier] = None, *args, **kwargs):
         self.logger = logging.getLogger("SignalLogger")
         self._payments = payments
         self._signal = signal
+        self._notifier = notifier if notifier is not None else get_message_notifier()
         self._run = False
 
     def _parse_message(self, message: SignalMessage, auto_send_receipts=True) -> Message:
         if not message.text and not message.payment:
+            # Profile key updates come through as empty messages; the sender may have a new payments address
+            self._invalidate_payments_address(message)
             self.logger.warning(f"Message contained no text or payment. Not processing. {message}")
             raise SignalMessageException(f"Message contained no text or payment. Not processing. {message}")
         else:
             try:
                 stored_message = Message.objects.create_from_signal(message)
                 if message.payment:
-                    payment = self._payments.process_signal_payment(stored_message)
-                    stored_message.payment = payment
+                    # Verified separately by the PaymentVerifier, so a slow ledger doesn't hold up ingestion
+                    stored_message.payment = self._payments.record_signal_payment(stored_message)
+                    stored_message.status = MessageStatus.PAYMENT_PENDING
                 stored_message.save()
             except Exception as e:
                 self.logger.exception("Exception storing message")
             else:
+                self._notify(stored_message)
                 # In case a message came from a group chat
                 group_id = message.group_v2 and message.group_v2.get("id")
                 # mark read and get that sweet filled checkbox
                 try:
                     if auto_send_receipts and not group_id:
-                        self._signal.send_read_receipt(recipient=message.source['number'], timestamps=[message.timestamp])
+                        with instrumentation.timed(instrumentation.SIGNALD):
+                            self._signal.send_read_receipt(recipient=message.source['number'], timestamps=[message.timestamp])
                 except Exception as e:
                     print(e)
                     raise
                 return stored_message
 
+    def _invalidate_payments_address(self, message: SignalMessage):
+        try:
+            if message.source:
+                self._payments.invalidate_payments_address(message.source)
+        except Exception:
+            self.logger.exception("Exception invalidating payments address")
+
+    def _notify(self, message: Message):
+        """Wake any subscribers waiting on this store; they'll fall back to polling if this fails"""
+        if message.status != MessageStatus.NOT_PROCESSED:
+            return
+        try:
+            self._notifier.notify(message.store)
+        except Exception:
+            self.logger.exception("Exception notifying subscribers of new message")
+
     def _done(self, fut: Future[Message]):
         message = fut.result()
         self.logger.info(f"Stored message from {message}")
@@ -86,5 +113,53 @@ class SignalLogger:
                     self._run = False
                     break
 
+    async def listen_async(self, auto_send_receipts=True, stop_when_done=False, max_concurrency=1000,
+                           blocking_workers=None):
+        """
+        Start the chat on an event loop, storing up to max_concurrency messages at once.
+        :param auto_send_receipts: Send read receipts when we've stored a message in the DB
+        :param stop_when_done: If there are no more messages on the iterator, shut down gracefully
+        :param max_concurrency: Maximum number of messages being stored at once
+        :param blocking_workers: Number of threads for blocking calls (DB, signald, full-service); defaults to
+            max_concurrency, since each message being stored holds one
+        """
+        self._run = True
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=blocking_workers or max_concurrency))
+        in_flight = asyncio.Semaphore(max_concurrency)
+        tasks = set()
+        messages = self._signal.receive_messages()
+        parse = blocking(self._parse_message)
+        done = object()
+
+        async def store(signal_message: SignalMessage):
+            try:
+                message = await parse(signal_message, auto_send_receipts=auto_send_receipts)
+                self.logger.info(f"Stored message from {message}")
+            except SignalMessageException as e:
+                self.logger.exception(f"Error parsing message from signal")
+            except Exception as e:
+                self.logger.exception(f"Error storing message from signal")
+            finally:
+                in_flight.release()
 
+        while self._run:
+            signal_message = await loop.run_in_executor(None, next, messages, done)
+            if signal_message is done:
+                self.logger.error(f"Signal no longer sending messages!")
+                if stop_when_done:
+                    self._run = False
+                    break
+                await asyncio.sleep(0.5)
+                continue
+            self.logger.info(f"Signal received message {signal_message}... Processing!")
+            await in_flight.acquire()
+            task = asyncio.create_task(store(signal_message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
 
+    def listen_with_asyncio(self, auto_send_receipts=True, stop_when_done=False, max_concurrency=1000):
+        """Entrypoint for running listen_async in its own process"""
+        asyncio.run(self.listen_async(auto_send_receipts, stop_when_done, max_concurrency))